@@ -0,0 +1,174 @@
+import math
+import os
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from typing import Dict, Hashable, Iterable, Iterator, Optional, Tuple
+
+import metrics
+from logger_config import setup_logger
+
+logger = setup_logger(__name__)
+
+
+class RateLimited(Exception):
+    """A rate limit was hit; the request should be answered with 429 and `retry_after`."""
+
+    def __init__(self, message: str, scope: str, retry_after: float):
+        super().__init__(message)
+        self.scope = scope
+        self.retry_after = retry_after
+
+
+class Overloaded(Exception):
+    """A backend lane is saturated; the request should be shed with 503 and `retry_after`."""
+
+    def __init__(self, message: str, lane: str, retry_after: float):
+        super().__init__(message)
+        self.lane = lane
+        self.retry_after = retry_after
+
+
+def retry_after_header(seconds: float) -> str:
+    return str(max(1, math.ceil(seconds)))
+
+
+class RateLimiter:
+    """Token-bucket limits per scope (e.g. `client` and `subject`), with one bucket per key.
+
+    A scope allows `per_minute` requests on average and bursts of up to `burst`; a rate of
+    0 disables it. A request takes one token from the bucket of every key it names, and
+    only if all of them have one, so a rejected request costs nothing. Buckets are kept
+    for at most `max_keys` keys, least recently used first out (an evicted bucket comes
+    back full, which only errs on the lenient side).
+    """
+
+    def __init__(self, limits: Dict[str, Tuple[float, float]], max_keys: int = 100000):
+        self.limits = {
+            scope: (per_minute / 60, max(burst, 1))
+            for scope, (per_minute, burst) in limits.items()
+            if per_minute > 0
+        }
+        self.max_keys = max_keys
+        self._buckets: "OrderedDict[Tuple[str, Hashable], Tuple[float, float]]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_env(cls) -> "RateLimiter":
+        return cls({
+            "client": (
+                float(os.getenv("RATE_LIMIT_CLIENT_PER_MINUTE", "60")),
+                float(os.getenv("RATE_LIMIT_CLIENT_BURST", "30"))
+            ),
+            "subject": (
+                float(os.getenv("RATE_LIMIT_SUBJECT_PER_MINUTE", "600")),
+                float(os.getenv("RATE_LIMIT_SUBJECT_BURST", "100"))
+            ),
+        })
+
+    def acquire(self, keys: Iterable[Tuple[str, Hashable]]):
+        """Take a token for each (scope, key), or raise `RateLimited` for the first scope without one."""
+        keys = [(scope, key) for scope, key in keys if scope in self.limits]
+        if not keys:
+            return
+        now = time.monotonic()
+        with self._lock:
+            levels = {}
+            for scope, key in keys:
+                rate, burst = self.limits[scope]
+                tokens, updated_at = self._buckets.get((scope, key), (burst, now))
+                tokens = min(burst, tokens + (now - updated_at) * rate)
+                if tokens < 1:
+                    metrics.RATE_LIMITED.labels(scope=scope).inc()
+                    raise RateLimited(f"Rate limit exceeded for this {scope}", scope, (1 - tokens) / rate)
+                levels[(scope, key)] = tokens
+            for bucket, tokens in levels.items():
+                self._buckets[bucket] = (tokens - 1, now)
+                self._buckets.move_to_end(bucket)
+            while len(self._buckets) > self.max_keys:
+                self._buckets.popitem(last=False)
+
+
+class Lane:
+    """Admission for an expensive step: `slots` callers at a time, at most `max_queue` waiting.
+
+    A caller that finds the queue full is shed at once. One that waits longer than
+    `queue_timeout` is shed too, so a saturated backend turns into fast 503s instead of
+    a pile of blocked worker threads. Retry-After is estimated from the queue length and
+    the recent time per call.
+    """
+
+    def __init__(self, name: str, slots: int, max_queue: int, queue_timeout: float):
+        self.name = name
+        self.slots = slots
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self.active = 0
+        self.waiting = 0
+        self.average_seconds = 1.0  # moving average of time spent holding a slot
+        self._semaphore = threading.BoundedSemaphore(slots)
+        self._lock = threading.Lock()
+
+    def retry_after(self) -> float:
+        return self.average_seconds * (self.waiting / self.slots + 1)
+
+    def _shed(self, reason: str):
+        metrics.ADMISSION_SHED.labels(lane=self.name, reason=reason).inc()
+        logger.warning(f"Shedding request from the {self.name} lane ({reason}): {self.active} active, {self.waiting} waiting")
+        raise Overloaded(f"The {self.name} backend is overloaded, please retry later", self.name, self.retry_after())
+
+    def acquire(self) -> float:
+        """Take a slot (raising `Overloaded` if none frees up in time); returns the time it was taken."""
+        if not self._semaphore.acquire(blocking=False):
+            with self._lock:
+                if self.waiting >= self.max_queue:
+                    self._shed("queue_full")
+                self.waiting += 1
+                metrics.ADMISSION_QUEUE_DEPTH.labels(lane=self.name).set(self.waiting)
+            try:
+                acquired = self._semaphore.acquire(timeout=self.queue_timeout)
+            finally:
+                with self._lock:
+                    self.waiting -= 1
+                    metrics.ADMISSION_QUEUE_DEPTH.labels(lane=self.name).set(self.waiting)
+            if not acquired:
+                self._shed("timeout")
+        with self._lock:
+            self.active += 1
+            metrics.ADMISSION_ACTIVE.labels(lane=self.name).set(self.active)
+        return time.perf_counter()
+
+    def release(self, acquired_at: float):
+        with self._lock:
+            self.active -= 1
+            metrics.ADMISSION_ACTIVE.labels(lane=self.name).set(self.active)
+            self.average_seconds = 0.8 * self.average_seconds + 0.2 * (time.perf_counter() - acquired_at)
+        self._semaphore.release()
+
+    @contextmanager
+    def admit(self) -> Iterator[None]:
+        acquired_at = self.acquire()
+        try:
+            yield
+        finally:
+            self.release(acquired_at)
+
+    def stats(self) -> Dict[str, float]:
+        with self._lock:
+            return {
+                "slots": self.slots,
+                "active": self.active,
+                "waiting": self.waiting,
+                "max_queue": self.max_queue,
+                "average_seconds": round(self.average_seconds, 3),
+            }
+
+
+def check_backlog(lane: str, depth: int, limit: Optional[int], retry_after: float = 1.0):
+    """Shed with `Overloaded` when a queue outside our control (e.g. the embedding batcher) is deeper than `limit`."""
+    metrics.ADMISSION_QUEUE_DEPTH.labels(lane=lane).set(depth)
+    if limit and depth > limit:
+        metrics.ADMISSION_SHED.labels(lane=lane, reason="backlog").inc()
+        logger.warning(f"Shedding request: {lane} backlog {depth} exceeds {limit}")
+        raise Overloaded(f"The {lane} backend is overloaded, please retry later", lane, retry_after)
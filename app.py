@@ -1,25 +1,160 @@
-from fastapi import FastAPI, Depends, HTTPException, UploadFile, File, Form
+from fastapi import FastAPI, Depends, HTTPException, Request, Response
+from fastapi.responses import JSONResponse, PlainTextResponse, StreamingResponse
+from sqlalchemy import text
 from sqlalchemy.orm import Session
-from typing import List
+from typing import AsyncIterator, Callable, List
 import models
 import database
-from database import engine, get_db
+from database import engine, get_db, init_db
 from document_processor import DocumentProcessor
 from rag_service import RAGService
-import shutil
+from llm_gateway import LLMError, LLMRateLimited, LLMTimeout
+from admission import Overloaded, RateLimited, RateLimiter, retry_after_header
+from ingestion import IngestionJob, IngestionQueue, IngestionQueueFull, ingest_document
+from uploads import UPLOAD_DIR, UPLOAD_REQUEST_BODY, SpooledUpload, UploadError, receive_upload
 import os
-from logger_config import setup_logger
+import json
+import math
+import time
+import threading
+import uuid
+from contextlib import asynccontextmanager
+from logger_config import setup_logger, request_id_var
+import metrics
+from metrics import timed
 
 logger = setup_logger(__name__)
 
 
-models.Base.metadata.create_all(bind=engine)
-
-app = FastAPI(title="RAG Chatbot API")
 rag_service = RAGService()
+ingestion_queue = IngestionQueue()
+warm_up_state = {"status": "pending", "error": None, "seconds": None}
+
+def warm_up():
+    """Load the embedding model and open the stores in the background so the process can serve liveness checks immediately."""
+    started = time.perf_counter()
+    warm_up_state["status"] = "running"
+    try:
+        rag_service.warm_up()
+        warm_up_state["status"] = "done"
+    except Exception as e:
+        logger.error(f"Warm-up failed: {str(e)}")
+        warm_up_state.update(status="failed", error=str(e))
+    warm_up_state["seconds"] = round(time.perf_counter() - started, 3)
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    init_db(models.Base.metadata)
+    if os.getenv("WARM_UP_ON_STARTUP", "true").lower() == "true":
+        threading.Thread(target=warm_up, name="warm-up", daemon=True).start()
+    yield
+    ingestion_queue.shutdown(wait=False)
+    rag_service.close()
+
+app = FastAPI(title="RAG Chatbot API", lifespan=lifespan)
 
-UPLOAD_DIR = "uploads"
 os.makedirs(UPLOAD_DIR, exist_ok=True)
+MULTI_SUBJECT_MAX = int(os.getenv("MULTI_SUBJECT_MAX", "50"))
+# Header naming the calling tenant for per-client rate limits. Unset by default, so clients are keyed by
+# their address; set it only behind a trusted proxy or auth layer, since any client can send any header.
+RATE_LIMIT_CLIENT_HEADER = os.getenv("RATE_LIMIT_CLIENT_HEADER", "")
+chat_limiter = RateLimiter.from_env()
+
+def llm_http_error(e: LLMError) -> HTTPException:
+    """Map an LLM failure to 503 (rate limited, with Retry-After), 504 (deadline passed) or 502."""
+    if isinstance(e, LLMRateLimited):
+        retry_after = str(max(1, math.ceil(e.retry_after or 1)))
+        return HTTPException(status_code=503, detail=str(e), headers={"Retry-After": retry_after})
+    if isinstance(e, LLMTimeout):
+        return HTTPException(status_code=504, detail=str(e))
+    return HTTPException(status_code=502, detail=str(e))
+
+def overloaded_http_error(e: Overloaded) -> HTTPException:
+    return HTTPException(status_code=503, detail=str(e), headers={"Retry-After": retry_after_header(e.retry_after)})
+
+def admit_chat(http_request: Request, subject_ids: List[int]):
+    """Apply the per-client and per-subject chat rate limits (429 with Retry-After when exceeded)."""
+    client_id = http_request.headers.get(RATE_LIMIT_CLIENT_HEADER) if RATE_LIMIT_CLIENT_HEADER else None
+    if not client_id:
+        client_id = http_request.client.host if http_request.client else "unknown"
+    try:
+        chat_limiter.acquire([("client", client_id)] + [("subject", subject_id) for subject_id in subject_ids])
+    except RateLimited as e:
+        logger.warning(f"Rate limited chat request from {client_id}: {str(e)}")
+        raise HTTPException(status_code=429, detail=str(e), headers={"Retry-After": retry_after_header(e.retry_after)})
+
+async def _finish_after(body: AsyncIterator[bytes], finish: Callable[[], None]) -> AsyncIterator[bytes]:
+    try:
+        async for chunk in body:
+            yield chunk
+    finally:
+        finish()
+
+@app.middleware("http")
+async def instrument_requests(request: Request, call_next):
+    """Assign a request id, collect per-stage spans, and record request metrics and a structured log line.
+
+    The metrics and the log line are recorded once the response body has been sent, so a
+    streamed answer is timed to its last token and its log line includes the generation spans.
+    """
+    request_id = request.headers.get("X-Request-ID") or uuid.uuid4().hex
+    request_id_token = request_id_var.set(request_id)
+    spans = []
+    spans_token = metrics.request_spans.set(spans)
+    started = time.perf_counter()
+
+    def finish(status: int):
+        duration = time.perf_counter() - started
+        route = getattr(request.scope.get("route"), "path", "unmatched")
+        metrics.HTTP_REQUESTS.labels(method=request.method, route=route, status=status).inc()
+        metrics.HTTP_REQUEST_SECONDS.labels(method=request.method, route=route).observe(duration)
+        # The body may be sent after the request's context was reset, so set the id for this line.
+        token = request_id_var.set(request_id)
+        try:
+            logger.info(
+                f"{request.method} {request.url.path} {status} {duration * 1000:.1f}ms",
+                extra={
+                    "method": request.method,
+                    "route": route,
+                    "status": status,
+                    "duration_ms": round(duration * 1000, 3),
+                    "spans": spans,
+                }
+            )
+        finally:
+            request_id_var.reset(token)
+
+    try:
+        response = await call_next(request)
+    except BaseException:
+        finish(500)
+        raise
+    finally:
+        metrics.request_spans.reset(spans_token)
+        request_id_var.reset(request_id_token)
+    response.headers["X-Request-ID"] = request_id
+    response.body_iterator = _finish_after(response.body_iterator, lambda: finish(response.status_code))
+    return response
+
+@app.get("/health/live")
+def liveness():
+    """The process is up and serving requests."""
+    return {"status": "alive"}
+
+@app.get("/health/ready")
+def readiness():
+    """Ready for traffic once the database answers and the model and vector store are loaded; 503 until then."""
+    checks = rag_service.readiness()
+    try:
+        with engine.connect() as connection:
+            connection.execute(text("SELECT 1"))
+        checks["database"] = True
+    except Exception as e:
+        logger.error(f"Readiness database check failed: {str(e)}")
+        checks["database"] = False
+    ready = all(checks.values())
+    body = {"status": "ready" if ready else "not_ready", "checks": checks, "warm_up": warm_up_state}
+    return JSONResponse(status_code=200 if ready else 503, content=body)
 
 @app.post("/subjects/", response_model=models.SubjectResponse)
 def create_subject(subject: models.SubjectCreate, db: Session = Depends(get_db)):
@@ -49,68 +184,280 @@ def get_subject(subject_id: int, db: Session = Depends(get_db)):
         raise HTTPException(status_code=404, detail="Subject not found")
     return subject
 
-@app.post("/subjects/{subject_id}/documents/")
+def read_upload(request: Request) -> SpooledUpload:
+    """Spool the request's `file` part to disk in one pass (see `uploads.receive_upload`)."""
+    try:
+        return receive_upload(request, accept=DocumentProcessor.is_supported)
+    except UploadError as e:
+        logger.warning(f"Upload rejected: {str(e)}")
+        raise HTTPException(status_code=e.status_code, detail=str(e))
+
+def queue_ingestion(job: IngestionJob, upload: SpooledUpload, *args):
+    try:
+        ingestion_queue.submit(job, ingest_document, rag_service, upload.path, upload.file_hash, *args)
+    except IngestionQueueFull as e:
+        logger.warning(str(e))
+        upload.discard()
+        raise HTTPException(status_code=503, detail=str(e), headers={"Retry-After": "30"})
+
+def get_subject_document(db: Session, subject_id: int, document_id: int) -> models.Document:
+    document = db.query(models.Document).filter(
+        models.Document.id == document_id,
+        models.Document.subject_id == subject_id
+    ).first()
+    if not document:
+        logger.warning(f"Document {document_id} not found in subject {subject_id}")
+        raise HTTPException(status_code=404, detail="Document not found")
+    return document
+
+@app.get("/subjects/{subject_id}/documents/", response_model=List[models.DocumentResponse])
+def list_documents(subject_id: int, db: Session = Depends(get_db)):
+    if not db.query(models.Subject).filter(models.Subject.id == subject_id).first():
+        raise HTTPException(status_code=404, detail="Subject not found")
+    return db.query(models.Document).filter(models.Document.subject_id == subject_id).order_by(models.Document.id).all()
+
+@app.get("/subjects/{subject_id}/documents/{document_id}", response_model=models.DocumentDetailResponse)
+def get_document(subject_id: int, document_id: int, db: Session = Depends(get_db)):
+    return get_subject_document(db, subject_id, document_id)
+
+@app.put(
+    "/subjects/{subject_id}/documents/{document_id}",
+    response_model=models.UploadResponse,
+    status_code=202,
+    openapi_extra=UPLOAD_REQUEST_BODY
+)
+def replace_document(
+    subject_id: int,
+    document_id: int,
+    request: Request,
+    response: Response,
+    db: Session = Depends(get_db)
+):
+    """Replace a document's content (and optionally its filename) with a new version."""
+    document = get_subject_document(db, subject_id, document_id)
+    upload = read_upload(request)
+    if upload.filename != document.filename:
+        clash = db.query(models.Document).filter(
+            models.Document.subject_id == subject_id,
+            models.Document.filename == upload.filename
+        ).first()
+        if clash:
+            upload.discard()
+            raise HTTPException(status_code=409, detail=f"Another document is already named {upload.filename}")
+
+    logger.info(f"Replacing document {document_id} ({document.filename}) with {upload.filename}")
+    if upload.file_hash == document.file_hash and upload.filename == document.filename:
+        upload.discard()
+        response.status_code = 200
+        return {"message": "Document content unchanged", "status": "skipped", "document_id": document.id}
+
+    job = IngestionJob(subject_id, upload.filename)
+    queue_ingestion(job, upload, document.id)
+    return {"message": "Document replacement queued", "job_id": job.id, "status": job.status, "document_id": document.id}
+
+@app.delete("/subjects/{subject_id}/documents/{document_id}", response_model=models.DocumentDeleteResponse)
+def delete_document(subject_id: int, document_id: int, db: Session = Depends(get_db)):
+    """Delete a document, its version history and all of its chunks."""
+    document = get_subject_document(db, subject_id, document_id)
+    filename = document.filename
+    removed = rag_service.delete_document(subject_id, filename)
+    db.delete(document)
+    db.commit()
+    upload_path = f"{UPLOAD_DIR}/{subject_id}_{filename}"
+    if os.path.exists(upload_path):
+        os.remove(upload_path)
+    logger.info(f"Deleted document {document_id} ({filename}) and {removed} chunks from subject {subject_id}")
+    return {"document_id": document_id, "filename": filename, "removed_chunks": removed}
+
+@app.post("/subjects/{subject_id}/compact", response_model=models.CompactionResponse)
+def compact_subject(subject_id: int, db: Session = Depends(get_db)):
+    """Rebuild the subject's vector and keyword indexes without deleted or orphaned chunks; reports sizes before and after."""
+    if not db.query(models.Subject).filter(models.Subject.id == subject_id).first():
+        raise HTTPException(status_code=404, detail="Subject not found")
+    filenames = [row.filename for row in db.query(models.Document.filename).filter(models.Document.subject_id == subject_id)]
+    return rag_service.compact_subject(subject_id, filenames)
+
+@app.post(
+    "/subjects/{subject_id}/documents/",
+    response_model=models.UploadResponse,
+    status_code=202,
+    openapi_extra=UPLOAD_REQUEST_BODY
+)
 def upload_document(
     subject_id: int, 
-    file: UploadFile = File(...), 
+    request: Request,
+    response: Response,
     db: Session = Depends(get_db)
 ):
     subject = db.query(models.Subject).filter(models.Subject.id == subject_id).first()
     if not subject:
         logger.warning(f"Subject not found for document upload: {subject_id}")
         raise HTTPException(status_code=404, detail="Subject not found")
-    
-    logger.info(f"Uploading document {file.filename} for subject {subject_id}")
-
-
-    file_location = f"{UPLOAD_DIR}/{subject_id}_{file.filename}"
-    with open(file_location, "wb") as buffer:
-        shutil.copyfileobj(file.file, buffer)
-    
-    with open(file_location, "rb") as f:
-        content = f.read()
 
-    try:
+    upload = read_upload(request)
+    logger.info(f"Uploaded document {upload.filename} for subject {subject_id}")
 
-        text = DocumentProcessor.process_file(content, file.filename)
-        
+    existing = db.query(models.Document).filter(
+        models.Document.subject_id == subject_id,
+        models.Document.file_hash == upload.file_hash
+    ).first()
+    if existing:
+        logger.info(f"Skipping {upload.filename}: identical content already ingested as document {existing.id}")
+        upload.discard()
+        response.status_code = 200
+        return {"message": "Document already ingested", "status": "skipped", "document_id": existing.id}
 
-        chunks = DocumentProcessor.chunk_text(text)
-        
+    job = IngestionJob(subject_id, upload.filename)
+    queue_ingestion(job, upload)
 
-        metadatas = [{"filename": file.filename, "subject_id": subject_id} for _ in chunks]
-        rag_service.add_documents(subject_id, chunks, metadatas)
-        
+    return {"message": "Document queued for processing", "job_id": job.id, "status": job.status}
 
-        new_doc = models.Document(
-            subject_id=subject_id,
-            filename=file.filename,
-            file_type=file.filename.split('.')[-1]
-        )
-        db.add(new_doc)
-        db.commit()
-        db.refresh(new_doc)
-        
-        return {"message": "Document uploaded and processed successfully", "document_id": new_doc.id}
-
-    except Exception as e:
-        logger.error(f"Error processing document upload: {str(e)}")
-        raise HTTPException(status_code=500, detail=str(e))
+@app.get("/jobs/{job_id}", response_model=models.JobResponse)
+def get_job(job_id: str):
+    job = ingestion_queue.get(job_id)
+    if not job:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return job.to_dict()
 
 @app.post("/subjects/{subject_id}/chat", response_model=models.ChatResponse)
 def chat_with_subject(
     subject_id: int,
     request: models.ChatRequest,
+    http_request: Request,
     db: Session = Depends(get_db)
 ):
-    subject = db.query(models.Subject).filter(models.Subject.id == subject_id).first()
-    print("SUBJECT", subject)
+    admit_chat(http_request, [subject_id])
+    with timed("db_lookup"):
+        subject = db.query(models.Subject).filter(models.Subject.id == subject_id).first()
     if not subject:
         logger.warning(f"Subject not found for chat: {subject_id}")
         raise HTTPException(status_code=404, detail="Subject not found")
     
     logger.info(f"Chat request for subject {subject_id}: {request.question}")
     
-    response = rag_service.query(subject_id, request.question)
-    print('EEEEEEEEEEEE',response)
-    return response
+    try:
+        return rag_service.query(
+            subject_id,
+            request.question,
+            retrieval_mode=request.retrieval_mode,
+            token_budget=request.token_budget,
+            session_id=request.session_id,
+            n_results=request.top_k or 5,
+            rerank=request.rerank,
+            rerank_depth=request.rerank_depth
+        )
+    except LLMError as e:
+        raise llm_http_error(e)
+    except Overloaded as e:
+        raise overloaded_http_error(e)
+
+@app.post("/chat", response_model=models.MultiChatResponse)
+def chat_with_subjects(request: models.MultiChatRequest, http_request: Request, db: Session = Depends(get_db)):
+    """Ask one question across several subjects; answered with a single LLM call and per-subject sources."""
+    subject_ids = list(dict.fromkeys(request.subject_ids))
+    if not subject_ids:
+        raise HTTPException(status_code=400, detail="At least one subject_id is required")
+    if len(subject_ids) > MULTI_SUBJECT_MAX:
+        raise HTTPException(status_code=400, detail=f"At most {MULTI_SUBJECT_MAX} subjects can be queried at once")
+    admit_chat(http_request, subject_ids)
+
+    with timed("db_lookup"):
+        rows = db.query(models.Subject).filter(models.Subject.id.in_(subject_ids)).all()
+    names = {row.id: row.name for row in rows}
+    missing = [subject_id for subject_id in subject_ids if subject_id not in names]
+    if missing:
+        logger.warning(f"Subjects not found for chat: {missing}")
+        raise HTTPException(status_code=404, detail=f"Subjects not found: {missing}")
+
+    logger.info(f"Chat request for subjects {subject_ids}: {request.question}")
+
+    try:
+        return rag_service.query_multi(
+            {subject_id: names[subject_id] for subject_id in subject_ids},
+            request.question,
+            retrieval_mode=request.retrieval_mode,
+            token_budget=request.token_budget,
+            session_id=request.session_id,
+            n_results=request.top_k or 5,
+            rerank=request.rerank,
+            rerank_depth=request.rerank_depth
+        )
+    except LLMError as e:
+        raise llm_http_error(e)
+    except Overloaded as e:
+        raise overloaded_http_error(e)
+
+@app.post("/subjects/{subject_id}/chat/stream")
+def chat_with_subject_stream(
+    subject_id: int,
+    request: models.ChatRequest,
+    http_request: Request,
+    db: Session = Depends(get_db)
+):
+    """Server-sent events: one `sources` event, `token` events as they arrive, then `done` (or `error`)."""
+    admit_chat(http_request, [subject_id])
+    with timed("db_lookup"):
+        subject = db.query(models.Subject).filter(models.Subject.id == subject_id).first()
+    if not subject:
+        logger.warning(f"Subject not found for chat: {subject_id}")
+        raise HTTPException(status_code=404, detail="Subject not found")
+
+    logger.info(f"Streaming chat request for subject {subject_id}: {request.question}")
+
+    def event_stream():
+        events = rag_service.query_stream(
+            subject_id,
+            request.question,
+            retrieval_mode=request.retrieval_mode,
+            token_budget=request.token_budget,
+            session_id=request.session_id,
+            n_results=request.top_k or 5,
+            rerank=request.rerank,
+            rerank_depth=request.rerank_depth
+        )
+        try:
+            for event in events:
+                yield f"data: {json.dumps(event)}\n\n"
+        except Overloaded as e:
+            # The response has started, so overload is reported in-stream, like an LLM error.
+            yield f"data: {json.dumps({'type': 'error', 'detail': str(e), 'retry_after': e.retry_after})}\n\n"
+
+    return StreamingResponse(
+        event_stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+@app.get("/sessions/{session_id}", response_model=models.ConversationResponse)
+def get_session(session_id: str):
+    conversation = rag_service.conversations.get(session_id, create=False)
+    if conversation is None:
+        raise HTTPException(status_code=404, detail="Session not found")
+    return conversation.to_dict()
+
+@app.delete("/sessions/{session_id}", status_code=204)
+def delete_session(session_id: str):
+    if not rag_service.conversations.delete(session_id):
+        raise HTTPException(status_code=404, detail="Session not found")
+
+@app.get("/cache/stats")
+def get_cache_stats():
+    return rag_service.cache_stats()
+
+@app.get("/admission/stats")
+def get_admission_stats():
+    return {"llm": rag_service.llm_lane.stats(), "embedding_pending": rag_service.embedder.pending}
+
+@app.get("/embeddings/stats")
+def get_embedding_stats():
+    return rag_service.embedder.stats()
+
+@app.get("/metrics", response_class=PlainTextResponse)
+def get_metrics():
+    """Prometheus scrape endpoint."""
+    for cache_name, stats in rag_service.cache_stats().items():
+        for event in ("hits", "misses", "evictions"):
+            metrics.CACHE_EVENTS.labels(cache=cache_name, event=event).set(stats[event])
+        metrics.CACHE_SIZE.labels(cache=cache_name).set(stats["size"])
+    metrics.ADMISSION_QUEUE_DEPTH.labels(lane="embedding").set(rag_service.embedder.pending)
+    return PlainTextResponse(metrics.REGISTRY.render(), media_type="text/plain; version=0.0.4")
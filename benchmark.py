@@ -0,0 +1,378 @@
+"""Benchmark ingestion, retrieval and end-to-end chat latency.
+
+Generates a synthetic corpus (TXT and/or PDF), runs it through the real FastAPI app in an
+isolated temporary directory with a stub LLM in place of Groq, and reports throughput,
+p50/p95/p99 latency and peak RSS per stage as JSON.
+
+    python benchmark.py --docs 20 --doc-kb 40 --format mixed --queries 100 --output bench.json
+    python benchmark.py --baseline bench.json        # compare a new run with a previous one
+"""
+import argparse
+import json
+import os
+import platform
+import random
+import resource
+import shutil
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+VOCABULARY = (
+    "policy employee travel reimbursement expense approval manager budget invoice payment vendor "
+    "contract leave holiday salary payroll benefit insurance claim receipt allowance quarter report "
+    "audit compliance department finance human resources onboarding training laptop equipment "
+    "security access badge office remote schedule overtime bonus pension tax deduction form request"
+).split()
+
+
+def make_text(rng: random.Random, size_bytes: int) -> str:
+    """Pseudo-natural text of roughly `size_bytes`, with an occasional form code for keyword search."""
+    sentences, size = [], 0
+    while size < size_bytes:
+        words = rng.choices(VOCABULARY, k=rng.randint(8, 20))
+        if rng.random() < 0.1:
+            words.append(f"FORM-{rng.randint(1000, 9999)}")
+        sentence = " ".join(words).capitalize() + "."
+        sentences.append(sentence)
+        size += len(sentence) + 1
+    return " ".join(sentences)
+
+
+def make_pdf(pages: List[str], line_chars: int = 90) -> bytes:
+    """Minimal uncompressed PDF with one Helvetica text stream per page (no external dependencies)."""
+    def escape(line: str) -> str:
+        return line.replace("\\", "\\\\").replace("(", "\\(").replace(")", "\\)")
+
+    objects = ["<< /Type /Catalog /Pages 2 0 R >>"]
+    kids = " ".join(f"{3 + 2 * i} 0 R" for i in range(len(pages)))
+    objects.append(f"<< /Type /Pages /Kids [{kids}] /Count {len(pages)} >>")
+    font_id = 3 + 2 * len(pages)
+    for i, text in enumerate(pages):
+        lines = [text[j:j + line_chars] for j in range(0, len(text), line_chars)]
+        body = " T* ".join(f"({escape(line)}) Tj" for line in lines)
+        stream = f"BT /F1 9 Tf 11 TL 40 760 Td {body} ET"
+        objects.append(
+            f"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 612 792] "
+            f"/Resources << /Font << /F1 {font_id} 0 R >> >> /Contents {4 + 2 * i} 0 R >>"
+        )
+        objects.append(f"<< /Length {len(stream)} >>\nstream\n{stream}\nendstream")
+    objects.append("<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>")
+
+    out = bytearray(b"%PDF-1.4\n")
+    offsets = []
+    for number, obj in enumerate(objects, start=1):
+        offsets.append(len(out))
+        out += f"{number} 0 obj\n{obj}\nendobj\n".encode("latin-1")
+    xref = len(out)
+    out += f"xref\n0 {len(objects) + 1}\n0000000000 65535 f \n".encode()
+    for offset in offsets:
+        out += f"{offset:010d} 00000 n \n".encode()
+    out += f"trailer\n<< /Size {len(objects) + 1} /Root 1 0 R >>\nstartxref\n{xref}\n%%EOF\n".encode()
+    return bytes(out)
+
+
+def build_corpus(rng: random.Random, n_docs: int, doc_kb: int, fmt: str) -> List[Tuple[str, bytes]]:
+    corpus = []
+    for i in range(n_docs):
+        text = make_text(rng, doc_kb * 1024)
+        as_pdf = fmt == "pdf" or (fmt == "mixed" and i % 2 == 1)
+        if as_pdf:
+            pages = [text[j:j + 3000] for j in range(0, len(text), 3000)]
+            corpus.append((f"doc_{i:05d}.pdf", make_pdf(pages)))
+        else:
+            corpus.append((f"doc_{i:05d}.txt", text.encode("utf-8")))
+    return corpus
+
+
+def current_rss_bytes() -> int:
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError):
+        # ru_maxrss is KiB on Linux, bytes on macOS; it is a lifetime peak rather than a sample.
+        scale = 1 if sys.platform == "darwin" else 1024
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * scale
+
+
+class Stage:
+    """Times a benchmark stage, collects per-operation latencies and samples peak RSS."""
+
+    def __init__(self, name: str, sample_interval: float = 0.01):
+        self.name = name
+        self.latencies: List[float] = []
+        self.extra: Dict[str, Any] = {}
+        self.sample_interval = sample_interval
+        self.peak_rss = 0
+        self._stop = threading.Event()
+
+    def _sample(self):
+        while not self._stop.is_set():
+            self.peak_rss = max(self.peak_rss, current_rss_bytes())
+            self._stop.wait(self.sample_interval)
+
+    def __enter__(self) -> "Stage":
+        self.peak_rss = current_rss_bytes()
+        self._sampler = threading.Thread(target=self._sample, daemon=True)
+        self._sampler.start()
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.total_seconds = time.perf_counter() - self.started
+        self._stop.set()
+        self._sampler.join()
+        self.peak_rss = max(self.peak_rss, current_rss_bytes())
+
+    def timed(self, fn: Callable, *args, **kwargs):
+        started = time.perf_counter()
+        result = fn(*args, **kwargs)
+        self.latencies.append(time.perf_counter() - started)
+        return result
+
+    def summary(self) -> Dict[str, Any]:
+        ordered = sorted(self.latencies)
+        summary = {
+            "operations": len(ordered),
+            "total_seconds": round(self.total_seconds, 4),
+            "throughput_per_second": round(len(ordered) / self.total_seconds, 3) if self.total_seconds else None,
+            "p50_ms": percentile_ms(ordered, 50),
+            "p95_ms": percentile_ms(ordered, 95),
+            "p99_ms": percentile_ms(ordered, 99),
+            "max_ms": round(ordered[-1] * 1000, 3) if ordered else None,
+            "peak_rss_mb": round(self.peak_rss / (1024 * 1024), 1),
+        }
+        summary.update(self.extra)
+        return summary
+
+
+def percentile_ms(ordered: List[float], pct: float) -> Optional[float]:
+    if not ordered:
+        return None
+    rank = (len(ordered) - 1) * pct / 100
+    low = int(rank)
+    high = min(low + 1, len(ordered) - 1)
+    value = ordered[low] + (ordered[high] - ordered[low]) * (rank - low)
+    return round(value * 1000, 3)
+
+
+def prepare_environment(workdir: str, args: argparse.Namespace):
+    os.environ.update({
+        "DATABASE_URL": f"sqlite:///{os.path.join(workdir, 'bench.db')}",
+        "CHROMA_PERSIST_DIR": os.path.join(workdir, "chroma_db"),
+        "VECTOR_STORE_DIR": os.path.join(workdir, "vector_store"),
+        "VECTOR_BACKEND": args.vector_backend,
+        "CHUNKER": args.chunker,
+        "VECTOR_STORE_DTYPE": args.vector_dtype,
+        "RERANK_ENABLED": "true" if args.rerank_depth else "false",
+        "RERANK_DEPTH": str(args.rerank_depth or 50),
+        "KEYWORD_INDEX_DIR": os.path.join(workdir, "keyword_index"),
+        "GROQ_API_KEY": "",
+        "ANONYMIZED_TELEMETRY": "False",
+        # All requests come from one test client; rate limits would turn most of them into 429s.
+        "RATE_LIMIT_CLIENT_PER_MINUTE": "0",
+        "RATE_LIMIT_SUBJECT_PER_MINUTE": "0",
+    })
+    if not args.with_cache:
+        os.environ["EMBEDDING_CACHE_SIZE"] = "0"
+        os.environ["ANSWER_CACHE_SIZE"] = "0"
+        os.environ["RERANK_CACHE_SIZE"] = "0"
+    os.chdir(workdir)
+
+
+def run(args: argparse.Namespace) -> Dict[str, Any]:
+    rng = random.Random(args.seed)
+    workdir = tempfile.mkdtemp(prefix="rag-bench-")
+    prepare_environment(workdir, args)
+
+    from fastapi.testclient import TestClient
+
+    import_started = time.perf_counter()
+    import app as app_module
+    import_seconds = time.perf_counter() - import_started
+    from document_processor import DocumentProcessor
+    from stub_llm import StubLLMClient
+
+    rag_service = app_module.rag_service
+    rag_service.client = StubLLMClient(
+        first_token_latency=args.llm_latency_ms / 1000,
+        tokens_per_second=args.llm_tokens_per_second or None
+    )
+    rag_service.model = "stub"
+    client = TestClient(app_module.app)
+    client.__enter__()
+    live_seconds = time.perf_counter() - import_started
+    while client.get("/health/ready").status_code != 200:
+        time.sleep(0.05)
+    startup = {
+        "import_seconds": round(import_seconds, 3),
+        "live_seconds": round(live_seconds, 3),
+        "ready_seconds": round(time.perf_counter() - import_started, 3),
+    }
+
+    corpus = build_corpus(rng, args.docs, args.doc_kb, args.format)
+    corpus_bytes = sum(len(content) for _, content in corpus)
+    questions = [" ".join(rng.choices(VOCABULARY, k=rng.randint(3, 8))) + "?" for _ in range(args.queries)]
+    stages: Dict[str, Dict[str, Any]] = {}
+
+    def create_subject(name: str) -> int:
+        return client.post("/subjects/", json={"name": name, "description": "benchmark"}).json()["id"]
+
+    with Stage("extract") as stage:
+        texts = [
+            stage.timed(lambda c=content, f=filename: "".join(DocumentProcessor.iter_pages(c, f)))
+            for filename, content in corpus
+        ]
+    stages["extract"] = stage.summary()
+    stages["extract"]["megabytes_per_second"] = round(corpus_bytes / (1024 * 1024) / stage.total_seconds, 3)
+
+    chunker = rag_service.chunker
+    with Stage("chunk_text") as stage:
+        chunk_counts = [len(stage.timed(lambda t=text: list(chunker.iter_chunks([t])))) for text in texts]
+    stages["chunk_text"] = stage.summary()
+    stages["chunk_text"]["chunks"] = sum(chunk_counts)
+
+    direct_subject = create_subject("bench-direct")
+    with Stage("add_documents") as stage:
+        for (filename, _), text in zip(corpus, texts):
+            stage.timed(
+                rag_service.add_documents_stream,
+                direct_subject,
+                chunker.iter_chunks([text]),
+                {"filename": filename, "subject_id": direct_subject}
+            )
+    stages["add_documents"] = stage.summary()
+    stages["add_documents"]["chunks_per_second"] = round(sum(chunk_counts) / stage.total_seconds, 2)
+
+    api_subject = create_subject("bench-api")
+
+    def upload(filename: str, content: bytes) -> Dict[str, Any]:
+        job_id = client.post(f"/subjects/{api_subject}/documents/", files={"file": (filename, content)}).json()["job_id"]
+        while True:
+            job = client.get(f"/jobs/{job_id}").json()
+            if job["status"] in ("completed", "failed"):
+                return job
+            time.sleep(0.005)
+
+    with Stage("upload") as stage:
+        with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+            jobs = list(executor.map(lambda item: stage.timed(upload, *item), corpus))
+    stages["upload"] = stage.summary()
+    stages["upload"]["failed"] = sum(1 for job in jobs if job["status"] != "completed")
+    stages["upload"]["megabytes_per_second"] = round(corpus_bytes / (1024 * 1024) / stage.total_seconds, 3)
+
+    with Stage("query") as stage:
+        for question in questions:
+            stage.timed(rag_service.query, direct_subject, question)
+    stages["query"] = stage.summary()
+
+    def chat(question: str) -> Optional[float]:
+        """Latency of a successful chat call; None for an error response (which is not a latency sample)."""
+        started = time.perf_counter()
+        status = client.post(f"/subjects/{api_subject}/chat", json={"question": question}).status_code
+        return time.perf_counter() - started if status == 200 else None
+
+    with Stage("chat") as stage:
+        with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+            results = list(executor.map(chat, questions))
+        stage.latencies = [seconds for seconds in results if seconds is not None]
+    stages["chat"] = stage.summary()
+    stages["chat"]["errors"] = len(results) - len(stage.latencies)
+
+    def time_to_first_token(question: str) -> Optional[float]:
+        """Seconds until the first token event; None if the request failed or streamed no token."""
+        started = time.perf_counter()
+        with client.stream("POST", f"/subjects/{api_subject}/chat/stream", json={"question": question}) as response:
+            if response.status_code != 200:
+                return None
+            for line in response.iter_lines():
+                if line.startswith("data: ") and json.loads(line[len("data: "):])["type"] == "token":
+                    return time.perf_counter() - started
+        return None
+
+    with Stage("chat_stream_ttft") as stage:
+        results = [time_to_first_token(q) for q in questions[:max(1, len(questions) // 4)]]
+        stage.latencies = [seconds for seconds in results if seconds is not None]
+    stages["chat_stream_ttft"] = stage.summary()
+    stages["chat_stream_ttft"]["errors"] = len(results) - len(stage.latencies)
+
+    app_module.ingestion_queue.shutdown(wait=True)
+    client.__exit__(None, None, None)
+    shutil.rmtree(workdir, ignore_errors=True)
+
+    return {
+        "created_at": datetime.utcnow().isoformat(),
+        "environment": {
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpu_count": os.cpu_count(),
+        },
+        "config": {key: value for key, value in vars(args).items() if key not in ("output", "baseline")},
+        "corpus": {"documents": len(corpus), "bytes": corpus_bytes, "chunks": sum(chunk_counts)},
+        "startup": startup,
+        "stages": stages,
+    }
+
+
+def compare(current: Dict[str, Any], baseline: Dict[str, Any]) -> str:
+    """Human-readable per-stage deltas against a previous run (negative latency change is better)."""
+    lines = [f"{'stage':<18}{'metric':<24}{'baseline':>12}{'current':>12}{'change':>10}"]
+    for stage, metrics in current["stages"].items():
+        previous = baseline.get("stages", {}).get(stage)
+        if not previous:
+            continue
+        for metric in ("throughput_per_second", "p50_ms", "p95_ms", "p99_ms", "peak_rss_mb"):
+            old, new = previous.get(metric), metrics.get(metric)
+            if not old or new is None:
+                continue
+            lines.append(f"{stage:<18}{metric:<24}{old:>12}{new:>12}{(new - old) / old * 100:>9.1f}%")
+    return "\n".join(lines)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--docs", type=int, default=10, help="number of synthetic documents")
+    parser.add_argument("--doc-kb", type=int, default=20, help="approximate size of each document in KiB")
+    parser.add_argument("--format", choices=["txt", "pdf", "mixed"], default="mixed")
+    parser.add_argument("--queries", type=int, default=50, help="number of distinct questions")
+    parser.add_argument("--concurrency", type=int, default=4, help="client threads for upload and chat stages")
+    parser.add_argument("--llm-latency-ms", type=float, default=0.0, help="stub LLM time to first token")
+    parser.add_argument("--llm-tokens-per-second", type=float, default=0.0, help="stub LLM generation rate (0 = instant)")
+    parser.add_argument("--with-cache", action="store_true", help="keep embedding/answer caches enabled")
+    parser.add_argument("--vector-backend", choices=["chroma", "memmap"], default="chroma")
+    parser.add_argument("--vector-dtype", choices=["int8", "float16"], default="int8", help="memmap backend storage type")
+    parser.add_argument("--chunker", choices=["structured", "character"], default="structured")
+    parser.add_argument("--rerank-depth", type=int, default=0, help="re-rank this many candidates with the cross-encoder (0 = off)")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--output", help="write the JSON report to this file")
+    parser.add_argument("--baseline", help="previous JSON report to compare against")
+    args = parser.parse_args()
+
+    if args.output:
+        args.output = os.path.abspath(args.output)
+    if args.baseline:
+        args.baseline = os.path.abspath(args.baseline)
+
+    report = run(args)
+    rendered = json.dumps(report, indent=2)
+    if args.output:
+        # Application logs also go to stdout, so the report is only printed when not written to a file.
+        with open(args.output, "w") as f:
+            f.write(rendered)
+        print(f"Benchmark report written to {args.output}")
+    else:
+        print(rendered)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            print(compare(report, json.load(f)))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,299 @@
+"""Bulk-load a directory or zip archive of PDF/TXT files into a subject.
+
+    python bulk_ingest.py ./legacy_pdfs --subject "Finance" --create-subject
+    python bulk_ingest.py archive.zip --subject-id 3 --processes 16 --batch-docs 128
+
+Text extraction and chunking run in a process pool (one task per file). The parent
+embeds each batch of documents in one pass, writes the vectors and keyword index in
+bulk, and records the batch's `Document` rows in one transaction. Finished files are
+appended to a checkpoint file after each batch, so an interrupted run resumes where it
+stopped when started again with the same arguments.
+"""
+import argparse
+import hashlib
+import json
+import multiprocessing
+import os
+import sys
+import time
+import zipfile
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+from typing import Any, Dict, Iterator, List, Optional
+
+# Chunking runs in forked workers after the tokenizer has been used in the parent.
+os.environ.setdefault("TOKENIZERS_PARALLELISM", "false")
+
+import models
+from chunking import create_chunker
+from database import SessionLocal, init_db
+from document_processor import DocumentProcessor
+from embedding_service import EmbeddingService
+from logger_config import setup_logger
+
+logger = setup_logger(__name__)
+
+_worker_chunker = None
+_worker_zip: Optional[zipfile.ZipFile] = None
+
+
+def _init_worker(source: str, chunker_name: str, model_name: str):
+    global _worker_chunker, _worker_zip
+    token_counter, max_tokens = EmbeddingService(model_name).token_counter() if chunker_name == "structured" else (None, None)
+    _worker_chunker = create_chunker(chunker_name, token_counter, max_tokens)
+    _worker_zip = zipfile.ZipFile(source) if zipfile.is_zipfile(source) else None
+
+
+def _process_file(source: str, name: str) -> Dict[str, Any]:
+    """Read, hash, extract and chunk one file (runs in a worker process)."""
+    try:
+        if _worker_zip is not None:
+            content = _worker_zip.read(name)
+        else:
+            with open(os.path.join(source, name), "rb") as f:
+                content = f.read()
+        pages = DocumentProcessor.iter_pages(content, name, processes=0)
+        chunks = list(_worker_chunker.iter_chunks(pages))
+        if not chunks:
+            raise ValueError("No text could be extracted from the document")
+        return {
+            "name": name,
+            "file_hash": hashlib.sha256(content).hexdigest(),
+            "size": len(content),
+            "chunks": chunks,
+        }
+    except Exception as e:
+        return {"name": name, "error": str(e)}
+
+
+def iter_source_files(source: str) -> Iterator[str]:
+    """Supported files in a directory (recursively) or zip archive, as paths relative to it, in sorted order."""
+    if zipfile.is_zipfile(source):
+        with zipfile.ZipFile(source) as archive:
+            names = [info.filename for info in archive.infolist() if not info.is_dir()]
+    elif os.path.isdir(source):
+        names = []
+        for root, dirs, files in os.walk(source):
+            dirs.sort()
+            for filename in files:
+                names.append(os.path.relpath(os.path.join(root, filename), source).replace(os.sep, "/"))
+    else:
+        raise ValueError(f"{source} is neither a directory nor a zip archive")
+    for name in sorted(names):
+        if DocumentProcessor.is_supported(name) and not os.path.basename(name).startswith("."):
+            yield name
+
+
+class Checkpoint:
+    """Append-only JSON-lines record of the files a run has finished (stored, skipped or failed)."""
+
+    def __init__(self, path: str):
+        self.path = path
+        self.done: Dict[str, str] = {}
+        if os.path.exists(path):
+            with open(path, encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        continue  # a line cut short by a crash
+                    self.done[entry["name"]] = entry["status"]
+
+    def record(self, entries: List[Dict[str, Any]]):
+        with open(self.path, "a", encoding="utf-8") as f:
+            for entry in entries:
+                f.write(json.dumps(entry) + "\n")
+                self.done[entry["name"]] = entry["status"]
+            f.flush()
+            os.fsync(f.fileno())
+
+
+def resolve_subject(db, subject_id: Optional[int], name: Optional[str], create: bool) -> models.Subject:
+    query = db.query(models.Subject)
+    subject = query.filter(models.Subject.id == subject_id).first() if subject_id else query.filter(models.Subject.name == name).first()
+    if subject:
+        return subject
+    if not create or not name:
+        raise SystemExit(f"Subject {subject_id or name!r} not found (use --subject NAME --create-subject to create it)")
+    subject = models.Subject(name=name, description="Bulk import")
+    db.add(subject)
+    db.commit()
+    db.refresh(subject)
+    logger.info(f"Created subject {subject.name} ({subject.id})")
+    return subject
+
+
+def store_batch(rag_service, subject_id: int, results: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """Skip duplicates, store the batch's chunks, and record its Document rows in one transaction."""
+    db = SessionLocal()
+    try:
+        hashes = {result["file_hash"] for result in results}
+        names = [result["name"] for result in results]
+        known_hashes = {
+            row.file_hash for row in db.query(models.Document.file_hash).filter(
+                models.Document.subject_id == subject_id, models.Document.file_hash.in_(hashes)
+            )
+        }
+        existing = {
+            document.filename: document for document in db.query(models.Document).filter(
+                models.Document.subject_id == subject_id, models.Document.filename.in_(names)
+            )
+        }
+
+        entries, to_store, seen_hashes = [], [], set()
+        for result in results:
+            if result["file_hash"] in known_hashes or result["file_hash"] in seen_hashes:
+                entries.append({"name": result["name"], "status": "skipped", "file_hash": result["file_hash"]})
+                continue
+            seen_hashes.add(result["file_hash"])
+            to_store.append(result)
+
+        if to_store:
+            rag_service.add_document_batch(
+                subject_id,
+                [
+                    {
+                        "metadata": {"filename": result["name"], "subject_id": subject_id, "file_hash": result["file_hash"]},
+                        "chunks": result["chunks"],
+                    }
+                    for result in to_store
+                ],
+                replace=[result["name"] for result in to_store if result["name"] in existing]
+            )
+
+        documents = []
+        for result in to_store:
+            document = existing.get(result["name"])
+            if document is None:
+                document = models.Document(
+                    subject_id=subject_id,
+                    filename=result["name"],
+                    file_type=result["name"].split('.')[-1]
+                )
+                db.add(document)
+            document.uploaded_at = datetime.utcnow()
+            document.file_hash = result["file_hash"]
+            document.chunk_count = len(result["chunks"])
+            document.record_version()
+            documents.append((result, document))
+        db.commit()
+
+        for result, document in documents:
+            entries.append({
+                "name": result["name"],
+                "status": "stored",
+                "file_hash": result["file_hash"],
+                "document_id": document.id,
+                "chunks": len(result["chunks"]),
+            })
+        return entries
+    finally:
+        db.close()
+
+
+def run(args: argparse.Namespace) -> Dict[str, Any]:
+    from rag_service import RAGService
+
+    init_db(models.Base.metadata)
+    db = SessionLocal()
+    try:
+        subject = resolve_subject(db, args.subject_id, args.subject, args.create_subject)
+        subject_id = subject.id
+    finally:
+        db.close()
+
+    checkpoint_path = args.checkpoint or f"{os.path.basename(os.path.normpath(args.source))}.subject{subject_id}.checkpoint.jsonl"
+    checkpoint = Checkpoint(checkpoint_path)
+    retry = {"failed"} if args.retry_failed else set()
+    names = [name for name in iter_source_files(args.source) if checkpoint.done.get(name) in (None, *retry)]
+    logger.info(
+        f"Bulk ingesting {len(names)} files from {args.source} into subject {subject_id} "
+        f"({len(checkpoint.done)} already in checkpoint {checkpoint_path})"
+    )
+
+    rag_service = RAGService()
+    rag_service.chunker  # load the tokenizer (and model weights) before forking the workers
+    chunker_name = os.getenv("CHUNKER", "structured")
+    context = multiprocessing.get_context("fork") if "fork" in multiprocessing.get_all_start_methods() else None
+
+    totals = {"stored": 0, "skipped": 0, "failed": 0, "chunks": 0, "bytes": 0}
+    started = time.perf_counter()
+    batch: List[Dict[str, Any]] = []
+    batch_chunks = 0
+
+    def flush():
+        nonlocal batch, batch_chunks
+        if not batch:
+            return
+        entries = store_batch(rag_service, subject_id, batch)
+        checkpoint.record(entries)
+        for entry in entries:
+            totals[entry["status"]] += 1
+            totals["chunks"] += entry.get("chunks", 0)
+        elapsed = time.perf_counter() - started
+        done = totals["stored"] + totals["skipped"] + totals["failed"]
+        logger.info(
+            f"{done}/{len(names)} files, {totals['chunks']} chunks stored "
+            f"({done / elapsed:.1f} files/s, {totals['chunks'] / elapsed:.1f} chunks/s)"
+        )
+        batch, batch_chunks = [], 0
+
+    with ProcessPoolExecutor(
+        max_workers=args.processes,
+        mp_context=context,
+        initializer=_init_worker,
+        initargs=(args.source, chunker_name, rag_service.embedder.model_name)
+    ) as executor:
+        pending = iter(names)
+        in_flight = deque()
+        for name in pending:
+            in_flight.append(executor.submit(_process_file, args.source, name))
+            if len(in_flight) >= args.processes * 4:
+                break
+        while in_flight:
+            result = in_flight.popleft().result()
+            next_name = next(pending, None)
+            if next_name is not None:
+                in_flight.append(executor.submit(_process_file, args.source, next_name))
+
+            if "error" in result:
+                logger.error(f"Failed to process {result['name']}: {result['error']}")
+                checkpoint.record([{"name": result["name"], "status": "failed", "error": result["error"]}])
+                totals["failed"] += 1
+                continue
+            totals["bytes"] += result["size"]
+            batch.append(result)
+            batch_chunks += len(result["chunks"])
+            if len(batch) >= args.batch_docs or batch_chunks >= args.batch_chunks:
+                flush()
+        flush()
+
+    rag_service.close()
+    elapsed = time.perf_counter() - started
+    summary = dict(totals, seconds=round(elapsed, 2), subject_id=subject_id, checkpoint=checkpoint_path)
+    logger.info(f"Bulk ingestion finished: {summary}")
+    return summary
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("source", help="directory or .zip archive of PDF/TXT files")
+    target = parser.add_mutually_exclusive_group(required=True)
+    target.add_argument("--subject-id", type=int)
+    target.add_argument("--subject", help="subject name")
+    parser.add_argument("--create-subject", action="store_true", help="create the subject named by --subject if missing")
+    parser.add_argument("--processes", type=int, default=os.cpu_count() or 1, help="extraction/chunking processes")
+    parser.add_argument("--batch-docs", type=int, default=64, help="documents per embedding/write/commit batch")
+    parser.add_argument("--batch-chunks", type=int, default=4096, help="also flush a batch once it has this many chunks")
+    parser.add_argument("--checkpoint", help="checkpoint file (default: <source>.subject<id>.checkpoint.jsonl)")
+    parser.add_argument("--retry-failed", action="store_true", help="retry files recorded as failed in the checkpoint")
+    args = parser.parse_args(argv)
+
+    summary = run(args)
+    print(json.dumps(summary))
+    return 1 if summary["failed"] else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
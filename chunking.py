@@ -0,0 +1,274 @@
+import bisect
+import math
+import os
+import re
+from typing import Any, Callable, Dict, Iterable, Iterator, List, NamedTuple, Optional, Tuple
+
+from logger_config import setup_logger
+
+logger = setup_logger(__name__)
+
+TokenCounter = Callable[[List[str]], List[int]]
+
+_LINE_RE = re.compile(r"[^\n]*\n?")
+_SENTENCE_RE = re.compile(r"\S.*?(?:[.!?]+[\"')\]]*(?=\s)|\Z)", re.S)
+_WORD_RE = re.compile(r"\S+")
+_NUMBERED_HEADING_RE = re.compile(r"^(?:\d+(?:\.\d+)*\.?|[IVXLC]+\.|[A-Z]\.)\s+\S")
+# Page furniture that looks like a heading: "Page 3", "Page 3 of 10", "3 / 10", "- 3 -".
+_PAGE_NUMBER_RE = re.compile(r"^(?:page\s+)?[-–—]?\s*\d+\s*[-–—]?(?:\s*(?:of|/)\s*\d+)?$", re.I)
+
+
+def estimate_token_counts(texts: List[str]) -> List[int]:
+    """Fallback token counter (about four characters per token) when no tokenizer is available."""
+    return [math.ceil(len(text) / 4) for text in texts]
+
+
+def is_heading(line: str) -> bool:
+    """Markdown headings, and short unpunctuated lines that are numbered, ALL CAPS or Title Case.
+
+    Page numbers and "Page 3 of 10" footers are not headings.
+    """
+    if line.startswith("#"):
+        return True
+    if _PAGE_NUMBER_RE.match(line.strip()):
+        return False
+    words = line.split()
+    if len(line) > 80 or len(words) > 12 or line[-1] in ".,;:!?" or not any(c.isalpha() for c in line):
+        return False
+    if _NUMBERED_HEADING_RE.match(line) or line.isupper():
+        return True
+    significant = [word for word in words if len(word) > 3]
+    return bool(significant) and all(word[0].isupper() for word in significant)
+
+
+class Chunk(NamedTuple):
+    text: str
+    page: int
+    page_offset: int
+    page_end: int
+    heading: Optional[str] = None
+
+    def metadata(self) -> Dict[str, Any]:
+        """Metadata stored with the chunk (vector stores do not accept None values)."""
+        metadata = {"page": self.page, "page_offset": self.page_offset, "page_end": self.page_end}
+        if self.heading:
+            metadata["heading"] = self.heading
+        return metadata
+
+
+class _Unit(NamedTuple):
+    text: str
+    page: int
+    offset: int
+    separator: str
+    tokens: int
+    heading: bool
+
+
+CHUNKERS: Dict[str, type] = {}
+
+
+def register_chunker(name: str):
+    """Class decorator making a `Chunker` selectable by name (`CHUNKER` env var)."""
+    def decorator(cls):
+        CHUNKERS[name] = cls
+        return cls
+    return decorator
+
+
+class Chunker:
+    """Turns a stream of page texts into `Chunk`s in one pass."""
+
+    def iter_chunks(self, pages: Iterable[str]) -> Iterator[Chunk]:
+        raise NotImplementedError
+
+    @classmethod
+    def from_env(cls, token_counter: Optional[TokenCounter] = None, model_max_tokens: Optional[int] = None) -> "Chunker":
+        return cls()
+
+
+def create_chunker(
+    name: Optional[str] = None,
+    token_counter: Optional[TokenCounter] = None,
+    model_max_tokens: Optional[int] = None
+) -> Chunker:
+    name = name or os.getenv("CHUNKER", "structured")
+    try:
+        cls = CHUNKERS[name]
+    except KeyError:
+        raise ValueError(f"Unknown chunker: {name}. Available: {', '.join(sorted(CHUNKERS))}")
+    return cls.from_env(token_counter, model_max_tokens)
+
+
+@register_chunker("character")
+class CharacterChunker(Chunker):
+    """Fixed-size character windows with overlap (the original chunking), plus page metadata."""
+
+    def __init__(self, chunk_size: int = 500, overlap: int = 50):
+        if chunk_size <= overlap:
+            raise ValueError("chunk_size must be greater than overlap")
+        self.chunk_size = chunk_size
+        self.overlap = overlap
+
+    @classmethod
+    def from_env(cls, token_counter=None, model_max_tokens=None) -> "CharacterChunker":
+        return cls(int(os.getenv("CHUNK_SIZE", "500")), int(os.getenv("CHUNK_OVERLAP", "50")))
+
+    def iter_chunks(self, pages: Iterable[str]) -> Iterator[Chunk]:
+        step = self.chunk_size - self.overlap
+        buffer, buffer_start = "", 0
+        page_starts: List[int] = []
+        page_numbers: List[int] = []
+
+        def make_chunk(start: int) -> Chunk:
+            text = buffer[start:start + self.chunk_size]
+            first = bisect.bisect_right(page_starts, buffer_start + start) - 1
+            last = bisect.bisect_right(page_starts, buffer_start + start + max(len(text) - 1, 0)) - 1
+            return Chunk(text, page_numbers[first], buffer_start + start - page_starts[first], page_numbers[last])
+
+        for page_number, page in enumerate(pages, start=1):
+            page_starts.append(buffer_start + len(buffer))
+            page_numbers.append(page_number)
+            buffer += page
+            start = 0
+            while len(buffer) - start >= self.chunk_size:
+                yield make_chunk(start)
+                start += step
+            buffer, buffer_start = buffer[start:], buffer_start + start
+            # Forget pages that end before the buffer.
+            keep = max(bisect.bisect_right(page_starts, buffer_start) - 1, 0)
+            del page_starts[:keep], page_numbers[:keep]
+
+        start = 0
+        while start < len(buffer):
+            yield make_chunk(start)
+            start += step
+
+
+@register_chunker("structured")
+class StructuredChunker(Chunker):
+    """Sentence-, paragraph- and heading-aware chunks sized in embedding-model tokens.
+
+    Pages are split into lines once; blank lines end paragraphs, heading lines start a
+    new section (and a new chunk), and paragraphs are split into sentences. Sentences are
+    token-counted in one batch per page and packed greedily into chunks of at most
+    `max_tokens`; the next chunk repeats whole trailing sentences worth up to
+    `overlap_tokens`. A sentence longer than `max_tokens` is split between words. Each
+    chunk records its start page, offset within that page, end page and section heading.
+    """
+
+    def __init__(self, max_tokens: int = 254, overlap_tokens: int = 32, token_counter: Optional[TokenCounter] = None):
+        if max_tokens <= overlap_tokens:
+            raise ValueError("max_tokens must be greater than overlap_tokens")
+        self.max_tokens = max_tokens
+        self.overlap_tokens = overlap_tokens
+        self.count_tokens = token_counter or estimate_token_counts
+
+    @classmethod
+    def from_env(cls, token_counter=None, model_max_tokens=None) -> "StructuredChunker":
+        # Leave room for the [CLS]/[SEP] tokens the model adds, so chunks are never truncated when embedded.
+        default_max = (model_max_tokens - 2) if model_max_tokens else 254
+        return cls(
+            max_tokens=int(os.getenv("CHUNK_MAX_TOKENS", str(default_max))),
+            overlap_tokens=int(os.getenv("CHUNK_OVERLAP_TOKENS", "32")),
+            token_counter=token_counter
+        )
+
+    def _page_units(self, page: str, page_number: int) -> List[_Unit]:
+        spans: List[Tuple[int, int, str, bool]] = []  # start, end, separator, heading
+
+        def add_paragraph(start: int, end: int):
+            separator = "\n"
+            for match in _SENTENCE_RE.finditer(page, start, end):
+                spans.append((match.start(), match.end(), separator, False))
+                separator = " "
+
+        paragraph_start = paragraph_end = None
+        for match in _LINE_RE.finditer(page):
+            if match.start() == len(page):
+                break
+            line = match.group().rstrip("\n")
+            stripped = line.strip()
+            if not stripped or is_heading(stripped):
+                if paragraph_start is not None:
+                    add_paragraph(paragraph_start, paragraph_end)
+                    paragraph_start = None
+                if stripped:
+                    start = match.start() + len(line) - len(line.lstrip())
+                    spans.append((start, start + len(stripped), "\n", True))
+                continue
+            if paragraph_start is None:
+                paragraph_start = match.start()
+            paragraph_end = match.start() + len(line)
+        if paragraph_start is not None:
+            add_paragraph(paragraph_start, paragraph_end)
+
+        texts = [page[start:end].rstrip() for start, end, _, _ in spans]
+        counts = self.count_tokens(texts) if texts else []
+        return [
+            _Unit(text, page_number, start, separator, tokens, heading)
+            for text, (start, _, separator, heading), tokens in zip(texts, spans, counts)
+            if text
+        ]
+
+    def _split_long(self, unit: _Unit) -> List[_Unit]:
+        """Split one over-long sentence between words into pieces of at most `max_tokens`."""
+        words = list(_WORD_RE.finditer(unit.text))
+        counts = self.count_tokens([word.group() for word in words])
+        pieces, start, tokens = [], 0, 0
+        for i, count in enumerate(counts):
+            if tokens and tokens + count > self.max_tokens:
+                pieces.append((start, i, tokens))
+                start, tokens = i, 0
+            tokens += count
+        pieces.append((start, len(words), tokens))
+        return [
+            _Unit(
+                unit.text[words[first].start():words[end - 1].end()],
+                unit.page,
+                unit.offset + words[first].start(),
+                unit.separator if first == 0 else " ",
+                tokens,
+                False
+            )
+            for first, end, tokens in pieces
+        ]
+
+    @staticmethod
+    def _make_chunk(units: List[_Unit], heading: Optional[str]) -> Chunk:
+        text = units[0].text + "".join(unit.separator + unit.text for unit in units[1:])
+        return Chunk(text, units[0].page, units[0].offset, units[-1].page, heading)
+
+    def iter_chunks(self, pages: Iterable[str]) -> Iterator[Chunk]:
+        current: List[_Unit] = []
+        current_tokens = 0
+        heading: Optional[str] = None
+        fresh = 0  # units in `current` not already emitted as overlap of the previous chunk
+
+        for page_number, page in enumerate(pages, start=1):
+            for unit in self._page_units(page, page_number):
+                if unit.heading:
+                    if fresh:
+                        yield self._make_chunk(current, heading)
+                    current, current_tokens, fresh = [], 0, 0
+                    heading = unit.text.lstrip("#").strip()
+
+                for piece in (self._split_long(unit) if unit.tokens > self.max_tokens else [unit]):
+                    if current and current_tokens + piece.tokens > self.max_tokens:
+                        if fresh:
+                            yield self._make_chunk(current, heading)
+                        overlap, overlap_tokens = [], 0
+                        for previous in reversed(current):
+                            if previous.heading or overlap_tokens + previous.tokens > self.overlap_tokens:
+                                break
+                            overlap.insert(0, previous)
+                            overlap_tokens += previous.tokens
+                        if overlap_tokens + piece.tokens > self.max_tokens:
+                            overlap, overlap_tokens = [], 0
+                        current, current_tokens, fresh = overlap, overlap_tokens, 0
+                    current.append(piece)
+                    current_tokens += piece.tokens
+                    fresh += 1
+
+        if fresh:
+            yield self._make_chunk(current, heading)
@@ -0,0 +1,137 @@
+import math
+import os
+import re
+from typing import Any, Dict, List, Optional
+
+from logger_config import setup_logger
+
+logger = setup_logger(__name__)
+
+_WORD_RE = re.compile(r"\w+")
+
+
+def estimate_tokens(text: str, chars_per_token: float = 4.0) -> int:
+    """Cheap token estimate for LLM prompts (about four characters per token for English text)."""
+    return math.ceil(len(text) / chars_per_token) if text else 0
+
+
+def _merge_overlap(left: str, right: str, min_overlap: int = 20, max_overlap: int = 256) -> str:
+    """Join two consecutive chunks, dropping the longest suffix of `left` that prefixes `right`.
+
+    Overlaps shorter than `min_overlap` characters are treated as coincidence (a shared
+    letter or word), so the chunks are joined on a new line instead.
+    """
+    for size in range(min(len(left), len(right), max_overlap), max(min_overlap, 1) - 1, -1):
+        if right.startswith(left[-size:]):
+            return left + right[size:]
+    return left + "\n" + right
+
+
+def _shingles(text: str, size: int = 3) -> set:
+    words = _WORD_RE.findall(text.lower())
+    if len(words) < size:
+        return {" ".join(words)} if words else set()
+    return {" ".join(words[i:i + size]) for i in range(len(words) - size + 1)}
+
+
+class ContextBuilder:
+    """Turns ranked retrieval results into the context passed to the LLM.
+
+    Adjacent chunks of the same file are merged with their overlap (of at least `min_overlap`
+    characters) removed, segments that are near-duplicates (word-shingle Jaccard >=
+    `dedupe_threshold`) of a better-ranked one are dropped, and the rest are packed in
+    relevance order until `token_budget` is spent.
+    """
+
+    def __init__(
+        self,
+        token_budget: Optional[int] = None,
+        dedupe_threshold: Optional[float] = None,
+        chars_per_token: Optional[float] = None,
+        min_overlap: Optional[int] = None
+    ):
+        self.token_budget = token_budget or int(os.getenv("CONTEXT_TOKEN_BUDGET", "2000"))
+        self.dedupe_threshold = dedupe_threshold or float(os.getenv("CONTEXT_DEDUPE_THRESHOLD", "0.9"))
+        self.chars_per_token = chars_per_token or float(os.getenv("CHARS_PER_TOKEN", "4"))
+        self.min_overlap = min_overlap if min_overlap is not None else int(os.getenv("CONTEXT_MIN_OVERLAP_CHARS", "20"))
+
+    def count_tokens(self, text: str) -> int:
+        return estimate_tokens(text, self.chars_per_token)
+
+    def _merge_adjacent(self, ids: List[str], documents: List[str], metadatas: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        segments = []
+        by_file: Dict[tuple, List[Dict[str, Any]]] = {}
+        for rank, (chunk_id, doc, metadata) in enumerate(zip(ids, documents, metadatas)):
+            item = {"rank": rank, "ids": [chunk_id], "text": doc, "metadata": metadata}
+            if metadata.get("chunk_index") is None:
+                segments.append(item)
+            else:
+                key = (metadata.get("subject_id"), metadata.get("filename", ""))
+                by_file.setdefault(key, []).append(item)
+
+        for items in by_file.values():
+            items.sort(key=lambda item: item["metadata"]["chunk_index"])
+            current = items[0]
+            for item in items[1:]:
+                if item["metadata"]["chunk_index"] == current["metadata"]["chunk_index"] + len(current["ids"]):
+                    current["text"] = _merge_overlap(current["text"], item["text"], self.min_overlap)
+                    current["ids"].extend(item["ids"])
+                    current["rank"] = min(current["rank"], item["rank"])
+                else:
+                    segments.append(current)
+                    current = item
+            segments.append(current)
+
+        segments.sort(key=lambda segment: segment["rank"])
+        return segments
+
+    def build(
+        self,
+        ids: List[str],
+        documents: List[str],
+        metadatas: List[Dict[str, Any]],
+        token_budget: Optional[int] = None
+    ) -> Dict[str, Any]:
+        """Return the packed `documents`, the chunk `ids` and `metadatas` they came from, and token counts."""
+        if token_budget is None:
+            token_budget = self.token_budget
+        segments = self._merge_adjacent(ids, documents, metadatas)
+
+        kept, kept_shingles = [], []
+        duplicates = 0
+        for segment in segments:
+            shingles = _shingles(segment["text"])
+            if any(
+                shingles and len(shingles & other) / len(shingles | other) >= self.dedupe_threshold
+                for other in kept_shingles
+            ):
+                duplicates += 1
+                continue
+            kept.append(segment)
+            kept_shingles.append(shingles)
+
+        packed, used_tokens, over_budget = [], 0, 0
+        for segment in kept:
+            tokens = self.count_tokens(segment["text"])
+            if used_tokens + tokens <= token_budget:
+                packed.append(segment)
+                used_tokens += tokens
+            elif not packed:
+                # Always send something: truncate the best segment to the budget.
+                text = segment["text"][:max(0, int(token_budget * self.chars_per_token))]
+                packed.append(dict(segment, text=text))
+                used_tokens += self.count_tokens(text)
+            else:
+                over_budget += 1
+
+        if duplicates or over_budget:
+            logger.info(f"Context packing dropped {duplicates} near-duplicates and {over_budget} over-budget segments")
+
+        return {
+            "documents": [segment["text"] for segment in packed],
+            "ids": [chunk_id for segment in packed for chunk_id in segment["ids"]],
+            "metadatas": [segment["metadata"] for segment in packed],
+            "context_tokens": used_tokens,
+            "retrieved_chunks": len(ids),
+            "segments": len(packed),
+        }
@@ -0,0 +1,197 @@
+import os
+import re
+import threading
+from collections import deque
+from typing import Any, Callable, Deque, Dict, Hashable, List, NamedTuple, Optional, Tuple
+
+import numpy as np
+
+from cache import LRUCache
+from logger_config import setup_logger
+
+logger = setup_logger(__name__)
+
+_WORD_RE = re.compile(r"[A-Za-z']+")
+_SENTENCE_END_RE = re.compile(r"(?<=[.!?])\s")
+_FOLLOW_UP_OPENERS = ("and ", "but ", "or ", "also ", "what about", "how about", "same ", "then ", "so ")
+_REFERRING_WORDS = {
+    "it", "its", "they", "them", "their", "this", "that", "these", "those",
+    "he", "she", "him", "her", "his", "one", "ones", "same", "former", "latter",
+}
+# Question and function words: a question made only of these and referring words has no topic of its own.
+_FUNCTION_WORDS = {
+    "what", "which", "who", "whom", "whose", "why", "how", "when", "where", "is", "are", "was", "were", "do",
+    "does", "did", "can", "could", "should", "would", "will", "about", "much", "many", "long", "else", "more",
+    "a", "an", "the", "of", "for", "to", "in", "on", "with", "i", "we", "you", "me", "us", "there", "too",
+}
+
+
+def is_follow_up(question: str) -> bool:
+    """Whether a question probably depends on the previous turn ("and for contractors?", "who approves them?").
+
+    Only clear references count: a follow-up opener, a referring word as the first word
+    after the question words ("how does it work?", "that one?") or as the last word
+    ("how long do I have for it?"), or nothing but question and referring words ("why?").
+    A short but self-contained question ("What is entropy?") is not a follow-up.
+    """
+    text = question.strip().lower()
+    words = _WORD_RE.findall(text)
+    if not words or text.startswith(_FOLLOW_UP_OPENERS) or words[-1] in _REFERRING_WORDS:
+        return True
+    topic = next((word for word in words if word not in _FUNCTION_WORDS), None)
+    return topic is None or topic in _REFERRING_WORDS
+
+
+def clip(text: str, max_chars: int) -> str:
+    """Shorten `text` to at most `max_chars`, preferring to cut at a sentence end."""
+    text = " ".join(text.split())
+    if len(text) <= max_chars:
+        return text
+    cut = text[:max_chars]
+    ends = [match.start() for match in _SENTENCE_END_RE.finditer(cut)]
+    return cut[:ends[-1]] if ends and ends[-1] > max_chars // 3 else cut.rsplit(" ", 1)[0] + " ..."
+
+
+class Turn(NamedTuple):
+    question: str
+    standalone_question: str
+    answer: str  # clipped to `ConversationStore.answer_chars`
+    subject_key: Hashable  # subject id, or a tuple of ids for multi-subject chat
+    chunk_ids: Tuple[str, ...]
+    embedding: Optional[np.ndarray]  # float32 embedding of `standalone_question`
+    retrieval_key: Hashable = None  # retrieval settings (top k, mode, re-ranking) that found `chunk_ids`
+
+
+class Conversation:
+    """One chat session: the last `max_turns` turns verbatim, plus a bounded summary of older ones.
+
+    A turn pushed out of the window is folded into the summary as a one-line question
+    and answer gist; the oldest summary lines are dropped once the summary exceeds
+    `summary_tokens`. The memory held per session, and the history put into a prompt,
+    therefore stays bounded however long the conversation runs.
+    """
+
+    def __init__(self, session_id: str, max_turns: int, summary_tokens: int, count_tokens: Callable[[str], int]):
+        self.session_id = session_id
+        self.turns: Deque[Turn] = deque(maxlen=max_turns)
+        self.summary: Deque[str] = deque()
+        self.summary_tokens = summary_tokens
+        self.count_tokens = count_tokens
+        self.turn_count = 0
+        self._lock = threading.Lock()
+
+    def add(self, turn: Turn):
+        with self._lock:
+            if len(self.turns) == self.turns.maxlen:
+                oldest = self.turns[0]
+                self.summary.append(f"- {clip(oldest.standalone_question, 160)} -> {clip(oldest.answer, 160)}")
+                while len(self.summary) > 1 and sum(self.count_tokens(line) for line in self.summary) > self.summary_tokens:
+                    self.summary.popleft()
+            self.turns.append(turn)
+            self.turn_count += 1
+
+    def last_turn(self) -> Optional[Turn]:
+        with self._lock:
+            return self.turns[-1] if self.turns else None
+
+    def history(self, token_budget: int) -> str:
+        """Summary and recent turns as prompt text, newest turns kept first when over `token_budget`."""
+        with self._lock:
+            turns, summary = list(self.turns), list(self.summary)
+        lines: List[str] = []
+        used = 0
+        for turn in reversed(turns):
+            line = f"User: {turn.question}\nAssistant: {turn.answer}"
+            tokens = self.count_tokens(line)
+            if used + tokens > token_budget:
+                break
+            lines.insert(0, line)
+            used += tokens
+        else:
+            if summary:
+                text = "Earlier in the conversation:\n" + "\n".join(summary)
+                if used + self.count_tokens(text) <= token_budget:
+                    lines.insert(0, text)
+        return "\n".join(lines)
+
+    def to_dict(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "session_id": self.session_id,
+                "turn_count": self.turn_count,
+                "summary": list(self.summary),
+                "turns": [
+                    {
+                        "question": turn.question,
+                        "standalone_question": turn.standalone_question,
+                        "answer": turn.answer,
+                        "chunk_ids": list(turn.chunk_ids),
+                    }
+                    for turn in self.turns
+                ],
+            }
+
+
+class ConversationStore:
+    """In-memory chat sessions keyed by a client-chosen id, expiring `CONVERSATION_TTL` seconds after their last turn."""
+
+    def __init__(
+        self,
+        count_tokens: Callable[[str], int],
+        max_sessions: Optional[int] = None,
+        ttl: Optional[float] = None,
+        max_turns: Optional[int] = None,
+        summary_tokens: Optional[int] = None,
+        answer_chars: Optional[int] = None
+    ):
+        self.count_tokens = count_tokens
+        self.max_turns = max_turns or int(os.getenv("CONVERSATION_MAX_TURNS", "4"))
+        self.summary_tokens = summary_tokens or int(os.getenv("CONVERSATION_SUMMARY_TOKENS", "200"))
+        self.answer_chars = answer_chars or int(os.getenv("CONVERSATION_ANSWER_CHARS", "600"))
+        self._sessions = LRUCache(
+            maxsize=max_sessions or int(os.getenv("CONVERSATION_MAX_SESSIONS", "10000")),
+            ttl=ttl or float(os.getenv("CONVERSATION_TTL", "86400"))
+        )
+        self._lock = threading.Lock()
+
+    def get(self, session_id: str, create: bool = True) -> Optional[Conversation]:
+        with self._lock:
+            conversation = self._sessions.get(session_id)
+            if conversation is None and create:
+                conversation = Conversation(session_id, self.max_turns, self.summary_tokens, self.count_tokens)
+                self._sessions.set(session_id, conversation)
+            return conversation
+
+    def record(
+        self,
+        conversation: Conversation,
+        question: str,
+        standalone_question: str,
+        answer: str,
+        subject_key: Hashable,
+        chunk_ids: List[str],
+        embedding: Optional[List[float]] = None,
+        retrieval_key: Hashable = None
+    ):
+        conversation.add(Turn(
+            question,
+            standalone_question,
+            clip(answer, self.answer_chars),
+            subject_key,
+            tuple(chunk_ids),
+            np.asarray(embedding, dtype=np.float32) if embedding is not None else None,
+            retrieval_key
+        ))
+        # Refresh the session's expiry.
+        self._sessions.set(conversation.session_id, conversation)
+
+    def delete(self, session_id: str) -> bool:
+        return self._sessions.invalidate(lambda key: key == session_id) > 0
+
+    def stats(self) -> Dict[str, Any]:
+        return self._sessions.stats()
+
+
+def cosine_similarity(a: np.ndarray, b: np.ndarray) -> float:
+    norm = float(np.linalg.norm(a) * np.linalg.norm(b))
+    return float(np.dot(a, b)) / norm if norm else 0.0
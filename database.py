@@ -1,4 +1,4 @@
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, inspect, text
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker
 import os
@@ -19,6 +19,30 @@ SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 logger.info("SessionLocal created")
 Base = declarative_base()
 logger.info("Base created")
+
+def init_db(metadata, bind=engine):
+    """Create missing tables, then add the columns and indexes that were added to existing tables since.
+
+    `create_all` only creates tables that do not exist yet, so a database created by an
+    older version would otherwise lack new columns (e.g. `documents.file_hash`). New
+    columns are added as nullable and backfilled with their scalar default. Safe to run
+    on every startup.
+    """
+    metadata.create_all(bind=bind)
+    existing = {table: {column["name"] for column in inspect(bind).get_columns(table)} for table in metadata.tables}
+    with bind.begin() as connection:
+        for table in metadata.sorted_tables:
+            for column in table.columns:
+                if column.name in existing[table.name]:
+                    continue
+                column_type = column.type.compile(dialect=bind.dialect)
+                connection.execute(text(f"ALTER TABLE {table.name} ADD COLUMN {column.name} {column_type}"))
+                if column.default is not None and column.default.is_scalar:
+                    connection.execute(text(f"UPDATE {table.name} SET {column.name} = :value"), {"value": column.default.arg})
+                logger.info(f"Added column {table.name}.{column.name}")
+            for index in table.indexes:
+                index.create(connection, checkfirst=True)
+
 def get_db():
     db = SessionLocal()
     try:
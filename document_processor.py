@@ -1,39 +1,134 @@
 import PyPDF2
 import io
-from typing import List
+import mmap
+import os
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import ExitStack, contextmanager
+from typing import Iterable, Iterator, List, Optional, Tuple, Union
+from chunking import CharacterChunker
 from logger_config import setup_logger
 
 logger = setup_logger(__name__)
 
+# File content, or the path of the file: a path is memory-mapped rather than read into memory.
+Source = Union[bytes, str]
+
+_worker_pdf_reader = None
+
+
+@contextmanager
+def _open_source(source: Source):
+    """A read-only buffer over `source`: the bytes themselves, or a memory map of the file at that path."""
+    if not isinstance(source, str):
+        yield source
+        return
+    with open(source, "rb") as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            yield b""  # an empty file cannot be mapped
+            return
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+            yield mapped
+
+
+def _pdf_reader(buffer) -> PyPDF2.PdfReader:
+    return PyPDF2.PdfReader(buffer if isinstance(buffer, mmap.mmap) else io.BytesIO(buffer))
+
+
+def _init_pdf_worker(source: Source):
+    """Parse the PDF once per worker process so tasks only carry page ranges (and, for a path, not even the file)."""
+    global _worker_pdf_reader
+    if isinstance(source, str):
+        with open(source, "rb") as f:
+            mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        _worker_pdf_reader = PyPDF2.PdfReader(mapped)
+    else:
+        _worker_pdf_reader = _pdf_reader(source)
+
+
+def _extract_page_range(start: int, end: int) -> List[str]:
+    return [(_worker_pdf_reader.pages[i].extract_text() or "") + "\n" for i in range(start, end)]
+
 class DocumentProcessor:
+    SUPPORTED_EXTENSIONS = ('.pdf', '.txt')
+
+    @staticmethod
+    def is_supported(filename: str) -> bool:
+        """Return True if the file extension can be processed."""
+        return filename.lower().endswith(DocumentProcessor.SUPPORTED_EXTENSIONS)
+
     @staticmethod
     def extract_text_from_pdf(file_content: bytes) -> str:
         """Extract text from a PDF file content."""
+        return "".join(DocumentProcessor.iter_pdf_pages(file_content))
+
+    @staticmethod
+    def iter_pdf_pages(file_content: Source, processes: Optional[int] = None, pages_per_task: int = 8) -> Iterator[str]:
+        """Yield the text of each PDF page in order.
+
+        With `processes` > 1 pages are extracted in a process pool, keeping at most
+        two tasks per worker in flight so memory stays bounded on large files.
+        """
+        _, pages = DocumentProcessor.open_pdf_pages(file_content, processes, pages_per_task)
+        yield from pages
+
+    @staticmethod
+    def open_pdf_pages(
+        source: Source, processes: Optional[int] = None, pages_per_task: int = 8
+    ) -> Tuple[int, Iterator[str]]:
+        """Parse a PDF once; return its page count and an iterator over the page texts (see `iter_pdf_pages`)."""
+        if processes is None:
+            processes = int(os.getenv("PDF_EXTRACT_PROCESSES", "0"))
+        opened = ExitStack()
         try:
-            pdf_reader = PyPDF2.PdfReader(io.BytesIO(file_content))
-            text = ""
-            for page in pdf_reader.pages:
-                text += page.extract_text() + "\n"
-            return text
-            return text
+            pdf_reader = _pdf_reader(opened.enter_context(_open_source(source)))
+            page_count = len(pdf_reader.pages)
         except Exception as e:
-            logger.error(f"Error extracting text from PDF: {str(e)}")
+            opened.close()
+            logger.error(f"Error reading PDF: {str(e)}")
             raise ValueError(f"Error extracting text from PDF: {str(e)}")
 
+        def pages() -> Iterator[str]:
+            try:
+                if processes <= 1 or page_count <= pages_per_task:
+                    for page in pdf_reader.pages:
+                        yield (page.extract_text() or "") + "\n"
+                    return
+
+                # Workers map the file themselves when given its path; only bytes are ever pickled to them.
+                ranges = [(start, min(start + pages_per_task, page_count)) for start in range(0, page_count, pages_per_task)]
+                with ProcessPoolExecutor(max_workers=processes, initializer=_init_pdf_worker, initargs=(source,)) as executor:
+                    in_flight = deque()
+                    for start, end in ranges:
+                        in_flight.append(executor.submit(_extract_page_range, start, end))
+                        if len(in_flight) >= processes * 2:
+                            yield from in_flight.popleft().result()
+                    while in_flight:
+                        yield from in_flight.popleft().result()
+            except Exception as e:
+                logger.error(f"Error extracting text from PDF: {str(e)}")
+                raise ValueError(f"Error extracting text from PDF: {str(e)}")
+            finally:
+                opened.close()
+
+        return page_count, pages()
+
     @staticmethod
-    def extract_text_from_txt(file_content: bytes) -> str:
-        """Extract text from a TXT file content."""
+    def extract_text_from_txt(file_content: Source) -> str:
+        """Extract text from a TXT file content (decoded straight from the memory map when given a path)."""
         try:
-            return file_content.decode("utf-8")
-        except UnicodeDecodeError:
-            # Try latin-1 if utf-8 fails
-            return file_content.decode("latin-1")
+            with _open_source(file_content) as buffer:
+                try:
+                    return str(buffer, "utf-8")
+                except UnicodeDecodeError:
+                    # Try latin-1 if utf-8 fails
+                    return str(buffer, "latin-1")
         except Exception as e:
             logger.error(f"Error extracting text from TXT: {str(e)}")
             raise ValueError(f"Error extracting text from TXT: {str(e)}")
 
     @staticmethod
-    def process_file(file_content: bytes, filename: str) -> str:
+    def process_file(file_content: Source, filename: str) -> str:
         """Process file based on extension and return extracted text."""
         if filename.lower().endswith('.pdf'):
             logger.info(f"Processing PDF file: {filename}")
@@ -45,21 +140,48 @@ class DocumentProcessor:
             logger.warning(f"Unsupported file format: {filename}")
             raise ValueError("Unsupported file format. Only PDF and TXT are supported.")
 
+    @staticmethod
+    def iter_pages(file_content: Source, filename: str, processes: Optional[int] = None) -> Iterator[str]:
+        """Yield the document text page by page (a TXT file is a single page)."""
+        return DocumentProcessor.open_pages(file_content, filename, processes)[1]
+
+    @staticmethod
+    def open_pages(file_content: Source, filename: str, processes: Optional[int] = None) -> Tuple[int, Iterator[str]]:
+        """Page count and page texts of a document from a single parse (see `iter_pages`)."""
+        if filename.lower().endswith('.pdf'):
+            logger.info(f"Processing PDF file: {filename}")
+            return DocumentProcessor.open_pdf_pages(file_content, processes=processes)
+        elif filename.lower().endswith('.txt'):
+            logger.info(f"Processing TXT file: {filename}")
+            return 1, iter([DocumentProcessor.extract_text_from_txt(file_content)])
+        else:
+            logger.warning(f"Unsupported file format: {filename}")
+            raise ValueError("Unsupported file format. Only PDF and TXT are supported.")
+
     @staticmethod
     def chunk_text(text: str, chunk_size: int = 500, overlap: int = 50) -> List[str]:
-        """Split text into chunks with overlap."""
+        """Split text into chunks with overlap (the texts of `CharacterChunker`'s chunks)."""
         if not text:
             return []
         
-        chunks = []
-        start = 0
-        text_len = len(text)
-
-        while start < text_len:
-            end = start + chunk_size
-            chunk = text[start:end]
-            chunks.append(chunk)
-            start += chunk_size - overlap
+        chunks = list(DocumentProcessor.iter_chunks([text], chunk_size, overlap))
         
         logger.info(f"Split text into {len(chunks)} chunks")
         return chunks
+
+    @staticmethod
+    def iter_chunks(pages: Iterable[str], chunk_size: int = 500, overlap: int = 50) -> Iterator[str]:
+        """Chunk a stream of text exactly like `chunk_text` on the joined text (see `CharacterChunker`)."""
+        return (chunk.text for chunk in CharacterChunker(chunk_size, overlap).iter_chunks(pages))
+
+    @staticmethod
+    def iter_batches(items: Iterable, batch_size: int) -> Iterator[List]:
+        """Group an iterable into lists of at most `batch_size` items."""
+        batch = []
+        for item in items:
+            batch.append(item)
+            if len(batch) >= batch_size:
+                yield batch
+                batch = []
+        if batch:
+            yield batch
@@ -0,0 +1,247 @@
+import os
+import queue
+import threading
+import time
+from concurrent.futures import Future, ProcessPoolExecutor
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from logger_config import setup_logger
+from metrics import Histogram
+
+logger = setup_logger(__name__)
+
+# The configured embedding model, shared by the service and the pre-fork preload in gunicorn.conf.py.
+EMBEDDING_MODEL = os.getenv("EMBEDDING_MODEL", "all-MiniLM-L6-v2")
+
+_worker_model = None
+_models: Dict[str, Any] = {}
+_models_lock = threading.Lock()
+
+
+def load_model(model_name: str = EMBEDDING_MODEL):
+    """Load (once per process) and return the sentence-transformer model.
+
+    Call this before forking worker processes (see `gunicorn.conf.py`) and the workers
+    inherit the loaded weights copy-on-write instead of each loading their own copy.
+    """
+    with _models_lock:
+        model = _models.get(model_name)
+        if model is None:
+            # Imported here: importing sentence_transformers (and torch) alone takes seconds.
+            from sentence_transformers import SentenceTransformer
+
+            started = time.perf_counter()
+            model = _models[model_name] = SentenceTransformer(model_name)
+            logger.info(f"Loaded embedding model {model_name} in {time.perf_counter() - started:.2f}s")
+        return model
+
+
+def _init_embedding_worker(model_name: str):
+    global _worker_model
+    _worker_model = load_model(model_name)
+
+
+def _encode_in_worker(texts: List[str], batch_size: int) -> List[List[float]]:
+    return _worker_model.encode(texts, batch_size=batch_size).tolist()
+
+
+class _EncodeRequest:
+    __slots__ = ("texts", "future", "enqueued_at")
+
+    def __init__(self, texts: List[str]):
+        self.texts = texts
+        self.future: Future = Future()
+        self.enqueued_at = time.perf_counter()
+
+
+class EmbeddingService:
+    """Sentence-transformer encoder that coalesces concurrent small requests into batched forward passes.
+
+    `encode` calls made within `max_wait_ms` of each other (up to `max_batch_size` texts)
+    share one model call. With `processes` > 0 the model runs in a process pool so
+    encoding does not hold the API process's GIL; otherwise it runs in a dispatcher thread.
+
+    Nothing heavy happens in the constructor: the model, the process pool and the
+    dispatcher thread are created on first use (or by `warm_up`), so the service can be
+    constructed before a fork and used safely in the forked workers.
+    """
+
+    def __init__(
+        self,
+        model_name: str = EMBEDDING_MODEL,
+        max_batch_size: Optional[int] = None,
+        max_wait_ms: Optional[float] = None,
+        processes: Optional[int] = None
+    ):
+        self.model_name = model_name
+        self.max_batch_size = max_batch_size or int(os.getenv("EMBEDDING_MAX_BATCH", "32"))
+        self.max_wait = (max_wait_ms if max_wait_ms is not None else float(os.getenv("EMBEDDING_MAX_WAIT_MS", "5"))) / 1000
+        self.processes = processes if processes is not None else int(os.getenv("EMBEDDING_PROCESSES", "0"))
+
+        self.batch_size_histogram = Histogram(
+            "embedding_batch_size", "Texts per batched forward pass",
+            [1, 2, 4, 8, 16, 32, 64, 128, 256]
+        )
+        self.direct_batch_size_histogram = Histogram(
+            "embedding_direct_batch_size", "Texts per direct encode_batch call (document ingestion)",
+            [1, 8, 32, 64, 128, 256, 512, 1024, 4096]
+        )
+        self.queue_wait_histogram = Histogram(
+            "embedding_queue_wait_seconds", "Time an encode request waited before its batch started",
+            [0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0]
+        )
+
+        self._model = None
+        self._pool: Optional[ProcessPoolExecutor] = None
+        self._queue: "queue.Queue[Optional[_EncodeRequest]]" = queue.Queue()
+        self._dispatcher: Optional[threading.Thread] = None
+        self._start_lock = threading.Lock()
+        self._pending = 0  # encode requests not yet answered (queued, batching or in a worker process)
+        self._pending_lock = threading.Lock()
+        self.ready = False
+
+    @property
+    def model(self):
+        if self._model is None and self.processes <= 0:
+            self._model = load_model(self.model_name)
+        return self._model
+
+    def _start(self):
+        if self._dispatcher is not None:
+            return
+        with self._start_lock:
+            if self._dispatcher is not None:
+                return
+            if self.processes > 0:
+                self._pool = ProcessPoolExecutor(
+                    max_workers=self.processes,
+                    initializer=_init_embedding_worker,
+                    initargs=(self.model_name,)
+                )
+                logger.info(f"Embedding model {self.model_name} running in {self.processes} worker processes")
+            dispatcher = threading.Thread(target=self._dispatch_loop, name="embedding-batcher", daemon=True)
+            dispatcher.start()
+            self._dispatcher = dispatcher
+
+    def warm_up(self):
+        """Load the model and run a dummy encode so the first real request does not pay for it."""
+        started = time.perf_counter()
+        self.encode(["warm up"])
+        logger.info(f"Embedding service warm in {time.perf_counter() - started:.2f}s")
+
+    def encode(self, texts: List[str]) -> List[List[float]]:
+        """Encode a few texts (e.g. a query), batched together with other concurrent callers."""
+        self._start()
+        request = _EncodeRequest(list(texts))
+        with self._pending_lock:
+            self._pending += 1
+        self._queue.put(request)
+        embeddings = request.future.result()
+        self.ready = True
+        return embeddings
+
+    def encode_batch(self, texts: List[str], batch_size: int = 32) -> List[List[float]]:
+        """Encode an already-large batch (e.g. document chunks) directly, bypassing the batching window."""
+        self._start()
+        self.direct_batch_size_histogram.observe(len(texts))
+        if self._pool is not None:
+            return self._pool.submit(_encode_in_worker, texts, batch_size).result()
+        return self.model.encode(texts, batch_size=batch_size).tolist()
+
+    def token_counter(self) -> Tuple[Callable[[List[str]], List[int]], int]:
+        """A function counting the model's tokens per text (without special tokens), and the model's max sequence length.
+
+        Loads the model in this process even when encoding runs in worker processes.
+        """
+        model = load_model(self.model_name)
+        tokenizer = model.tokenizer
+
+        def count(texts: List[str]) -> List[int]:
+            return [len(ids) for ids in tokenizer(texts, add_special_tokens=False)["input_ids"]]
+
+        return count, model.max_seq_length
+
+    @property
+    def pending(self) -> int:
+        """Encode requests not answered yet.
+
+        Counted from `encode` until the request is resolved, so batches already handed
+        to the process pool (where the real backlog builds up) are included.
+        """
+        return self._pending
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "model": self.model_name,
+            "processes": self.processes,
+            "ready": self.ready,
+            "max_batch_size": self.max_batch_size,
+            "max_wait_ms": self.max_wait * 1000,
+            "pending": self.pending,
+            "batch_size": self.batch_size_histogram.snapshot(),
+            "direct_batch_size": self.direct_batch_size_histogram.snapshot(),
+            "queue_wait_seconds": self.queue_wait_histogram.snapshot(),
+        }
+
+    def close(self):
+        self._queue.put(None)
+        if self._pool is not None:
+            self._pool.shutdown(wait=True, cancel_futures=True)
+
+    def _collect_batch(self, first: _EncodeRequest) -> List[_EncodeRequest]:
+        batch = [first]
+        size = len(first.texts)
+        deadline = time.perf_counter() + self.max_wait
+        while size < self.max_batch_size:
+            remaining = deadline - time.perf_counter()
+            if remaining <= 0:
+                break
+            try:
+                request = self._queue.get(timeout=remaining)
+            except queue.Empty:
+                break
+            if request is None:
+                self._queue.put(None)
+                break
+            batch.append(request)
+            size += len(request.texts)
+        return batch
+
+    def _dispatch_loop(self):
+        while True:
+            first = self._queue.get()
+            if first is None:
+                return
+            batch = self._collect_batch(first)
+
+            started = time.perf_counter()
+            for request in batch:
+                self.queue_wait_histogram.observe(started - request.enqueued_at)
+            texts = [text for request in batch for text in request.texts]
+            self.batch_size_histogram.observe(len(texts))
+
+            future = Future()
+            try:
+                if self._pool is not None:
+                    future = self._pool.submit(_encode_in_worker, texts, self.max_batch_size)
+                    future.add_done_callback(lambda f, batch=batch: self._resolve(batch, f))
+                    continue
+                future.set_result(self.model.encode(texts, batch_size=len(texts)).tolist())
+            except Exception as e:
+                future.set_exception(e)
+            self._resolve(batch, future)
+
+    def _resolve(self, batch: List[_EncodeRequest], result: Future):
+        with self._pending_lock:
+            self._pending -= len(batch)
+        error = result.exception()
+        if error is not None:
+            logger.error(f"Embedding batch of {len(batch)} requests failed: {str(error)}")
+            for request in batch:
+                request.future.set_exception(error)
+            return
+        embeddings = result.result()
+        offset = 0
+        for request in batch:
+            request.future.set_result(embeddings[offset:offset + len(request.texts)])
+            offset += len(request.texts)
@@ -0,0 +1,328 @@
+"""Offline retrieval-quality evaluation over a grid of configurations.
+
+    python evaluate.py --dataset eval.jsonl --documents eval_docs \\
+        --grid CHUNKER=structured,character CHUNK_MAX_TOKENS=128,254 n_results=3,5,10 --output eval.json
+
+The dataset is JSON lines of `{"subject", "question", "source"[, "passage"]}`: the file
+expected to answer the question and, optionally, a short passage the answering chunk
+must contain. Documents live in `<documents>/<subject>/`.
+
+Grid keys in UPPER case are environment settings that change the index (`CHUNKER`,
+`CHUNK_SIZE`, `CHUNK_OVERLAP`, `CHUNK_MAX_TOKENS`, `EMBEDDING_MODEL`, `VECTOR_BACKEND`,
+...). Each combination of them is ingested from scratch in its own process, and the
+combinations run in parallel. Lower-case keys are `RAGService.query` arguments
+(`n_results`, `retrieval_mode`, `rerank`, `rerank_depth`, `token_budget`), and every
+combination of them is evaluated against each index. A stub LLM stands in for Groq, and
+caches are off, so latencies are those of retrieval and prompt assembly.
+
+For each configuration the report gives recall@k and MRR, ingestion time split into
+extract/chunk/store, per-stage query latency percentiles and prompt token counts. It
+also recommends the fastest configuration whose quality is within `--tolerance` of the
+best.
+"""
+import argparse
+import itertools
+import json
+import multiprocessing
+import os
+import platform
+import re
+import shutil
+import sys
+import tempfile
+import time
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Tuple
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from benchmark import percentile_ms
+
+QUERY_SETTINGS = {"n_results": int, "retrieval_mode": str, "rerank": lambda v: v.lower() == "true", "rerank_depth": int, "token_budget": int}
+
+
+def load_dataset(path: str) -> List[Dict[str, str]]:
+    items = []
+    with open(path, encoding="utf-8") as f:
+        for number, line in enumerate(f, start=1):
+            if not line.strip():
+                continue
+            item = json.loads(line)
+            missing = {"subject", "question", "source"} - set(item)
+            if missing:
+                raise ValueError(f"{path}:{number} is missing {', '.join(sorted(missing))}")
+            items.append(item)
+    return items
+
+
+def parse_grid(specs: List[str]) -> Tuple[List[Dict[str, str]], List[Dict[str, Any]]]:
+    """Split `KEY=v1,v2` specs into the index-setting and query-setting combinations they span."""
+    index_axes: Dict[str, List[str]] = {}
+    query_axes: Dict[str, List[Any]] = {}
+    for spec in specs:
+        key, sep, values = spec.partition("=")
+        if not sep or not values:
+            raise ValueError(f"Grid entries look like KEY=value1,value2 (got {spec!r})")
+        if key.isupper():
+            index_axes[key] = values.split(",")
+        elif key in QUERY_SETTINGS:
+            query_axes[key] = [QUERY_SETTINGS[key](value) for value in values.split(",")]
+        else:
+            raise ValueError(f"Unknown grid key {key!r}: use an environment setting or one of {', '.join(QUERY_SETTINGS)}")
+    query_axes.setdefault("n_results", [5])
+
+    def product(axes: Dict[str, List[Any]]) -> List[Dict[str, Any]]:
+        return [dict(zip(axes, values)) for values in itertools.product(*axes.values())]
+
+    return product(index_axes), product(query_axes)
+
+
+def normalize(text: str) -> str:
+    return " ".join(re.findall(r"\w+", text.lower()))
+
+
+class _Stopwatch:
+    """Accumulates the time spent inside an iterator's `next()` calls."""
+
+    def __init__(self, items: Iterable[Any]):
+        self.items = iter(items)
+        self.seconds = 0.0
+
+    def __iter__(self) -> Iterator[Any]:
+        while True:
+            started = time.perf_counter()
+            try:
+                item = next(self.items)
+            except StopIteration:
+                self.seconds += time.perf_counter() - started
+                return
+            self.seconds += time.perf_counter() - started
+            yield item
+
+
+def ingest(rag_service, documents_dir: str, subjects: Dict[str, int]) -> Tuple[Dict[str, Any], Dict[str, Tuple[str, str]]]:
+    """Index every subject's documents; returns ingestion stats and each chunk's (filename, normalized text) by id."""
+    from document_processor import DocumentProcessor
+
+    chunk_lookup: Dict[str, Tuple[str, str]] = {}
+    totals = {"documents": 0, "chunks": 0, "extract_seconds": 0.0, "chunk_seconds": 0.0, "store_seconds": 0.0}
+    started = time.perf_counter()
+    for subject, subject_id in subjects.items():
+        directory = os.path.join(documents_dir, subject)
+        for filename in sorted(os.listdir(directory)):
+            if not DocumentProcessor.is_supported(filename):
+                continue
+            _, pages = DocumentProcessor.open_pages(os.path.join(directory, filename), filename)
+            pages = _Stopwatch(pages)
+            chunks = _Stopwatch(rag_service.chunker.iter_chunks(pages))
+
+            def recorded(chunks=chunks, filename=filename, subject_id=subject_id):
+                for chunk in chunks:
+                    chunk_id = rag_service._chunk_id(subject_id, filename, rag_service.hash_text(chunk.text))
+                    chunk_lookup[chunk_id] = (filename, normalize(chunk.text))
+                    yield chunk
+
+            document_started = time.perf_counter()
+            stats = rag_service.add_documents_stream(subject_id, recorded(), {"filename": filename, "subject_id": subject_id})
+            totals["documents"] += 1
+            totals["chunks"] += stats["chunks"]
+            totals["extract_seconds"] += pages.seconds
+            totals["chunk_seconds"] += chunks.seconds - pages.seconds
+            totals["store_seconds"] += time.perf_counter() - document_started - chunks.seconds
+    totals["total_seconds"] = time.perf_counter() - started
+    return {key: round(value, 4) if isinstance(value, float) else value for key, value in totals.items()}, chunk_lookup
+
+
+def score_queries(
+    rag_service,
+    dataset: List[Dict[str, str]],
+    subjects: Dict[str, int],
+    chunk_lookup: Dict[str, Tuple[str, str]],
+    settings: Dict[str, Any],
+    ks: List[int]
+) -> Dict[str, Any]:
+    n_results = settings["n_results"]
+    ks = sorted({k for k in ks if k <= n_results} | {n_results})
+    hits = {k: 0 for k in ks}
+    reciprocal_ranks = 0.0
+    latencies: Dict[str, List[float]] = defaultdict(list)
+    prompt_tokens: List[int] = []
+    context_tokens: List[int] = []
+
+    for item in dataset:
+        passage = normalize(item.get("passage", ""))
+        started = time.perf_counter()
+        result = rag_service.query(subjects[item["subject"]], item["question"], **settings)
+        latencies["query"].append(time.perf_counter() - started)
+        for stage, ms in result.get("timings", {}).items():
+            latencies[stage[:-len("_ms")]].append(ms / 1000)
+        usage = result.get("usage", {})
+        prompt_tokens.append(usage.get("prompt_tokens", 0))
+        context_tokens.append(usage.get("context_tokens", 0))
+
+        rank = next(
+            (
+                position for position, chunk_id in enumerate(result.get("chunk_ids", []), start=1)
+                if chunk_lookup.get(chunk_id, ("", ""))[0] == item["source"] and passage in chunk_lookup[chunk_id][1]
+            ),
+            None
+        )
+        if rank is not None:
+            reciprocal_ranks += 1 / rank
+            for k in ks:
+                hits[k] += rank <= k
+
+    count = max(len(dataset), 1)
+    report: Dict[str, Any] = {f"recall@{k}": round(hits[k] / count, 4) for k in ks}
+    report["mrr"] = round(reciprocal_ranks / count, 4)
+    for stage, values in latencies.items():
+        ordered = sorted(values)
+        report[f"{stage}_p50_ms"] = percentile_ms(ordered, 50)
+        report[f"{stage}_p95_ms"] = percentile_ms(ordered, 95)
+    report["prompt_tokens_mean"] = round(sum(prompt_tokens) / count, 1)
+    report["prompt_tokens_max"] = max(prompt_tokens, default=0)
+    report["context_tokens_mean"] = round(sum(context_tokens) / count, 1)
+    return report
+
+
+def evaluate_index(
+    index_settings: Dict[str, str],
+    query_grid: List[Dict[str, Any]],
+    dataset: List[Dict[str, str]],
+    documents_dir: str,
+    ks: List[int]
+) -> List[Dict[str, Any]]:
+    """Build one index configuration in a fresh working directory and score every query configuration against it.
+
+    Runs in its own process: the settings are environment variables read when the
+    service is created.
+    """
+    workdir = tempfile.mkdtemp(prefix="rag-eval-")
+    os.environ.update({
+        "CHROMA_PERSIST_DIR": os.path.join(workdir, "chroma_db"),
+        "VECTOR_STORE_DIR": os.path.join(workdir, "vector_store"),
+        "KEYWORD_INDEX_DIR": os.path.join(workdir, "keyword_index"),
+        "GROQ_API_KEY": "",
+        "ANONYMIZED_TELEMETRY": "False",
+        "EMBEDDING_CACHE_SIZE": "0",
+        "ANSWER_CACHE_SIZE": "0",
+        "RERANK_CACHE_SIZE": "0",
+    })
+    os.environ.update(index_settings)
+    try:
+        from rag_service import RAGService
+        from stub_llm import StubLLMClient
+
+        rag_service = RAGService()
+        rag_service.client = StubLLMClient()
+        rag_service.model = "stub"
+        rag_service.warm_up()
+        if any(settings.get("rerank") for settings in query_grid):
+            rag_service.reranker.warm_up()
+
+        subjects = {subject: subject_id for subject_id, subject in enumerate(sorted({item["subject"] for item in dataset}), start=1)}
+        ingestion, chunk_lookup = ingest(rag_service, documents_dir, subjects)
+        rows = [
+            {
+                "config": dict(index_settings, **settings),
+                "ingestion": ingestion,
+                "metrics": score_queries(rag_service, dataset, subjects, chunk_lookup, settings, ks),
+            }
+            for settings in query_grid
+        ]
+        rag_service.close()
+        return rows
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+def recommend(rows: List[Dict[str, Any]], metric: str, tolerance: float) -> Optional[Dict[str, Any]]:
+    """The fastest configuration (p50 query latency, then prompt tokens) scoring within `tolerance` of the best."""
+    scored = [row for row in rows if metric in row["metrics"]]
+    if not scored:
+        return None
+    best = max(row["metrics"][metric] for row in scored)
+    keeping = [row for row in scored if row["metrics"][metric] >= best - tolerance]
+    return min(keeping, key=lambda row: (row["metrics"]["query_p50_ms"], row["metrics"]["prompt_tokens_mean"]))
+
+
+def run(args: argparse.Namespace) -> Dict[str, Any]:
+    dataset = load_dataset(args.dataset)
+    index_grid, query_grid = parse_grid(args.grid)
+    missing = sorted({item["subject"] for item in dataset if not os.path.isdir(os.path.join(args.documents, item["subject"]))})
+    if missing:
+        raise SystemExit(f"No document directory for subjects: {', '.join(missing)} (expected {args.documents}/<subject>/)")
+
+    started = time.perf_counter()
+    # A fresh process per index configuration: settings are read once per process, and modules keep state.
+    with ProcessPoolExecutor(
+        max_workers=min(args.parallel, len(index_grid)),
+        mp_context=multiprocessing.get_context("spawn"),
+        max_tasks_per_child=1
+    ) as executor:
+        futures = [
+            executor.submit(evaluate_index, settings, query_grid, dataset, os.path.abspath(args.documents), args.k)
+            for settings in index_grid
+        ]
+        rows = [row for future in futures for row in future.result()]
+
+    metric = args.metric or f"recall@{min(args.k)}"
+    return {
+        "created_at": datetime.utcnow().isoformat(),
+        "environment": {
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpu_count": os.cpu_count(),
+        },
+        "dataset": {"path": args.dataset, "questions": len(dataset)},
+        "seconds": round(time.perf_counter() - started, 2),
+        "results": rows,
+        "recommended": recommend(rows, metric, args.tolerance),
+        "selection": {"metric": metric, "tolerance": args.tolerance},
+    }
+
+
+def render(report: Dict[str, Any]) -> str:
+    """One line per configuration: quality, query latency, prompt size and index build time."""
+    rows = report["results"]
+    quality = sorted({key for row in rows for key in row["metrics"] if key.startswith("recall@")}, key=lambda key: int(key[7:]))
+    columns = quality + ["mrr", "query_p50_ms", "retrieval_p50_ms", "prompt_tokens_mean"]
+    configs = [" ".join(f"{key}={value}" for key, value in row["config"].items()) for row in rows]
+    width = max(len(config) for config in configs + ["config"]) + 2
+    lines = [f"{'config':<{width}}" + "".join(f"{column:>{len(column) + 2}}" for column in columns) + f"{'ingest_s':>10}"]
+    for config, row in zip(configs, rows):
+        values = "".join(f"{str(row['metrics'].get(column, '-')):>{len(column) + 2}}" for column in columns)
+        lines.append(f"{config:<{width}}{values}{row['ingestion']['total_seconds']:>10}")
+    if report["recommended"]:
+        selection = report["selection"]
+        lines.append(
+            f"recommended ({selection['metric']} within {selection['tolerance']} of best, then fastest): "
+            + " ".join(f"{key}={value}" for key, value in report["recommended"]["config"].items())
+        )
+    return "\n".join(lines)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--dataset", required=True, help="JSON lines of subject, question, source[, passage]")
+    parser.add_argument("--documents", required=True, help="directory with one sub-directory of documents per subject")
+    parser.add_argument("--grid", nargs="*", default=[], help="KEY=value1,value2 ... (see above)")
+    parser.add_argument("--k", type=lambda v: [int(k) for k in v.split(",")], default=[1, 3, 5], help="recall cut-offs")
+    parser.add_argument("--parallel", type=int, default=2, help="index configurations evaluated at once")
+    parser.add_argument("--metric", help="quality metric for the recommendation (default: recall@<smallest k>)")
+    parser.add_argument("--tolerance", type=float, default=0.02, help="allowed drop from the best metric value")
+    parser.add_argument("--output", help="write the JSON report to this file")
+    args = parser.parse_args()
+
+    report = run(args)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+        print(f"Evaluation report written to {args.output}")
+    print(render(report))
+
+
+if __name__ == "__main__":
+    main()
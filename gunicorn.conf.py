@@ -0,0 +1,29 @@
+"""Preload/fork serving mode: `gunicorn app:app -c gunicorn.conf.py`.
+
+The master imports the app and loads the embedding model once, then forks the uvicorn
+workers, which inherit the model weights copy-on-write instead of each loading their own
+copy. Everything else (vector store, LLM client, background threads) is created lazily
+in each worker after the fork.
+
+One worker by default: ingestion jobs, chat sessions, rate-limit buckets and the Chroma
+index are per process, and index files are only locked within a process (see README).
+"""
+import gc
+import os
+
+bind = f"0.0.0.0:{os.getenv('PORT', '8000')}"
+workers = int(os.getenv("WEB_CONCURRENCY", "1"))
+worker_class = "uvicorn.workers.UvicornWorker"
+preload_app = True
+timeout = int(os.getenv("GUNICORN_TIMEOUT", "120"))
+
+
+def when_ready(server):
+    from embedding_service import EMBEDDING_MODEL, load_model
+
+    # Weights only: the warm-up encode runs in each worker, since running torch before fork is unsafe.
+    # Same model as RAGService's EmbeddingService, so the workers find it already loaded.
+    load_model(EMBEDDING_MODEL)
+    # Keep the preloaded objects out of garbage collection so workers do not touch (and copy) their pages.
+    gc.freeze()
+    server.log.info("Embedding model preloaded; forking workers")
@@ -0,0 +1,230 @@
+import os
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from typing import Any, Callable, Dict, Iterator, Optional
+
+import models
+from database import SessionLocal
+from document_processor import DocumentProcessor
+from logger_config import setup_logger
+from metrics import STAGE_SECONDS
+from uploads import discard_upload, retain_upload
+
+logger = setup_logger(__name__)
+
+
+class IngestionQueueFull(Exception):
+    """Raised when the ingestion backlog has reached its configured limit."""
+
+
+class IngestionJob:
+    """Tracks the stage, progress and timing of a single document ingestion."""
+
+    def __init__(self, subject_id: int, filename: str):
+        self.id = uuid.uuid4().hex
+        self.subject_id = subject_id
+        self.filename = filename
+        self.status = "queued"
+        self.stage = "queued"
+        self.progress = 0.0
+        self.error: Optional[str] = None
+        self.document_id: Optional[int] = None
+        self.chunk_count: Optional[int] = None
+        self.embedded_count: Optional[int] = None
+        self.created_at = datetime.utcnow()
+        self.started_at: Optional[datetime] = None
+        self.finished_at: Optional[datetime] = None
+        self.stage_timings: Dict[str, float] = {}
+        self._stage_started = time.perf_counter()
+        self._lock = threading.Lock()
+
+    def set_stage(self, stage: str, progress: float):
+        """Move the job to a new stage, recording how long the previous one took."""
+        with self._lock:
+            now = time.perf_counter()
+            if self.status == "running":
+                self.stage_timings[self.stage] = round(now - self._stage_started, 4)
+            else:
+                self.status = "running"
+                self.started_at = datetime.utcnow()
+            self.stage = stage
+            self.progress = progress
+            self._stage_started = now
+
+    def finish(self, error: Optional[str] = None):
+        with self._lock:
+            if self.status == "running":
+                self.stage_timings[self.stage] = round(time.perf_counter() - self._stage_started, 4)
+            self.finished_at = datetime.utcnow()
+            for stage, seconds in self.stage_timings.items():
+                STAGE_SECONDS.labels(stage=f"ingest_{stage}").observe(seconds)
+            if error is None:
+                self.status = "completed"
+                self.stage = "completed"
+                self.progress = 1.0
+            else:
+                self.status = "failed"
+                self.error = error
+
+    @property
+    def done(self) -> bool:
+        return self.status in ("completed", "failed")
+
+    def to_dict(self) -> Dict[str, Any]:
+        with self._lock:
+            end = self.finished_at or datetime.utcnow()
+            duration = (end - self.started_at).total_seconds() if self.started_at else None
+            return {
+                "id": self.id,
+                "subject_id": self.subject_id,
+                "filename": self.filename,
+                "status": self.status,
+                "stage": self.stage,
+                "progress": round(self.progress, 3),
+                "error": self.error,
+                "document_id": self.document_id,
+                "chunk_count": self.chunk_count,
+                "embedded_count": self.embedded_count,
+                "created_at": self.created_at,
+                "started_at": self.started_at,
+                "finished_at": self.finished_at,
+                "duration_seconds": duration,
+                "stage_timings": dict(self.stage_timings),
+            }
+
+
+class IngestionQueue:
+    """Bounded worker pool that runs document ingestion off the request path."""
+
+    def __init__(self, max_workers: Optional[int] = None, max_pending: Optional[int] = None, history_limit: int = 1000):
+        self.max_workers = max_workers or int(os.getenv("INGESTION_WORKERS", "2"))
+        self.max_pending = max_pending or int(os.getenv("INGESTION_MAX_PENDING", "100"))
+        self.history_limit = history_limit
+        self._executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix="ingest")
+        self._jobs: "OrderedDict[str, IngestionJob]" = OrderedDict()
+        self._lock = threading.Lock()
+        logger.info(f"Ingestion queue started with {self.max_workers} workers")
+
+    def pending(self) -> int:
+        with self._lock:
+            return sum(1 for job in self._jobs.values() if not job.done)
+
+    def submit(self, job: IngestionJob, fn: Callable[..., None], *args) -> IngestionJob:
+        """Queue `fn(job, *args)` for execution, rejecting it if the backlog is full."""
+        with self._lock:
+            active = sum(1 for j in self._jobs.values() if not j.done)
+            if active >= self.max_pending:
+                raise IngestionQueueFull(f"Ingestion backlog is full ({active} jobs pending)")
+            self._jobs[job.id] = job
+            self._prune()
+        self._executor.submit(self._run, job, fn, *args)
+        logger.info(f"Queued ingestion job {job.id} for {job.filename} (subject {job.subject_id})")
+        return job
+
+    def get(self, job_id: str) -> Optional[IngestionJob]:
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def shutdown(self, wait: bool = True):
+        self._executor.shutdown(wait=wait)
+
+    def _prune(self):
+        finished = [job_id for job_id, job in self._jobs.items() if job.done]
+        excess = len(self._jobs) - self.history_limit
+        for job_id in finished[:max(excess, 0)]:
+            del self._jobs[job_id]
+
+    def _run(self, job: IngestionJob, fn: Callable[..., None], *args):
+        try:
+            fn(job, *args)
+            job.finish()
+            logger.info(f"Ingestion job {job.id} completed in {job.to_dict()['duration_seconds']:.2f}s")
+        except Exception as e:
+            logger.error(f"Ingestion job {job.id} failed: {str(e)}")
+            job.finish(error=str(e))
+
+
+def ingest_document(job: IngestionJob, rag_service, file_location: str, file_hash: str, document_id: Optional[int] = None):
+    """Stream an uploaded file through extract -> chunk -> embed -> store, then record its Document row.
+
+    A file with the same name already in the subject is treated as a new revision: its
+    row is updated in place and only chunks whose content changed are re-embedded.
+    With `document_id` the file replaces that document (which may have had another
+    name, whose chunks are then deleted). Every stored revision adds a version entry.
+    `file_location` is the upload's own spool file; it is renamed to the retained name
+    only once the document is stored, and deleted if ingestion fails.
+    """
+    job.set_stage("extracting", 0.05)
+    try:
+        # The file is memory-mapped and parsed once; nothing reads it into memory first.
+        total_pages, pages = DocumentProcessor.open_pages(file_location, job.filename)
+        _store_document(job, rag_service, total_pages, pages, file_hash, document_id)
+    except BaseException:
+        discard_upload(file_location)
+        raise
+    retain_upload(file_location, job.subject_id, job.filename)
+
+
+def _store_document(job: IngestionJob, rag_service, total_pages: int, pages: Iterator[str], file_hash: str, document_id: Optional[int]):
+    job.set_stage("embedding", 0.1)
+    pages_done = 0
+
+    def tracked_pages():
+        nonlocal pages_done
+        for page in pages:
+            yield page
+            pages_done += 1
+
+    def on_batch(stored: int):
+        job.chunk_count = stored
+        job.progress = 0.1 + 0.85 * min(pages_done / max(total_pages, 1), 1.0)
+
+    stats = rag_service.add_documents_stream(
+        job.subject_id,
+        rag_service.chunker.iter_chunks(tracked_pages()),
+        {"filename": job.filename, "subject_id": job.subject_id, "file_hash": file_hash},
+        on_batch=on_batch
+    )
+    if not stats["chunks"]:
+        raise ValueError("No text could be extracted from the document")
+    job.chunk_count = stats["chunks"]
+    job.embedded_count = stats["embedded"]
+
+    job.set_stage("recording", 0.95)
+    # Under the subject lock, so concurrent uploads of one filename update a single row instead of each inserting one.
+    with rag_service.subject_lock(job.subject_id):
+        db = SessionLocal()
+        try:
+            if document_id is not None:
+                document = db.query(models.Document).filter(models.Document.id == document_id).first()
+            else:
+                document = db.query(models.Document).filter(
+                    models.Document.subject_id == job.subject_id,
+                    models.Document.filename == job.filename
+                ).first()
+            if document:
+                logger.info(f"Updating document {document.id} ({job.filename}) to new revision {file_hash[:12]}")
+                if document.filename != job.filename:
+                    rag_service.delete_document(job.subject_id, document.filename)
+                    document.filename = job.filename
+                    document.file_type = job.filename.split('.')[-1]
+                document.uploaded_at = datetime.utcnow()
+            else:
+                document = models.Document(
+                    subject_id=job.subject_id,
+                    filename=job.filename,
+                    file_type=job.filename.split('.')[-1]
+                )
+                db.add(document)
+            document.file_hash = file_hash
+            document.chunk_count = stats["chunks"]
+            document.record_version()
+            db.commit()
+            db.refresh(document)
+            job.document_id = document.id
+        finally:
+            db.close()
@@ -0,0 +1,201 @@
+import heapq
+import math
+import os
+import pickle
+import re
+import threading
+from collections import Counter
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from logger_config import setup_logger
+
+logger = setup_logger(__name__)
+
+_TOKEN_RE = re.compile(r"[a-z0-9]+(?:[-_./][a-z0-9]+)*")
+_STOPWORDS = frozenset(
+    "a an and are as at be by for from has have in is it its of on or that the this to was were what when "
+    "where which who why will with how do does can i you we our".split()
+)
+
+
+def tokenize(text: str) -> List[str]:
+    """Lowercase word tokens. Codes like `FIN-2023/04` are kept whole and also split into their parts."""
+    tokens = []
+    for match in _TOKEN_RE.findall(text.lower()):
+        if match in _STOPWORDS:
+            continue
+        tokens.append(match)
+        if not match.isalnum():
+            tokens.extend(part for part in re.split(r"[-_./]", match) if part and part not in _STOPWORDS)
+    return tokens
+
+
+class BM25Index:
+    """In-memory BM25 inverted index for one subject, persisted as a pickle file.
+
+    Only the postings of the query's terms are scored, so lookups stay fast on large
+    subjects. Terms with more than `max_postings` documents (very common words) only
+    contribute their highest-impact postings; those impact-ordered lists and the document
+    length normalisation factors are cached until the next update.
+
+    Single writer per file: `save` re-pickles the whole index (O(size of the subject) per
+    write) and replaces the file, and writes are serialized only within one process (by
+    the caller's subject lock). `is_stale` lets readers in other processes reload after
+    a write, but it is not a lock, so two processes writing the same subject can lose
+    each other's updates. Ingest into a subject from one process at a time.
+    """
+
+    def __init__(self, path: Optional[str] = None, k1: float = 1.5, b: float = 0.75, max_postings: int = 1000):
+        self.path = path
+        self.k1 = k1
+        self.b = b
+        self.max_postings = max_postings
+        self.postings: Dict[str, Dict[str, int]] = {}
+        self.doc_terms: Dict[str, Tuple[str, ...]] = {}
+        self.doc_lengths: Dict[str, int] = {}
+        self.total_length = 0
+        self._norms: Optional[Dict[str, float]] = None
+        self._top_impacts: Dict[str, List[Tuple[str, float]]] = {}
+        self._lock = threading.RLock()
+        # mtime of the file this index was loaded from or last saved to, to detect writes by other processes.
+        self.mtime: Optional[int] = None
+
+    def __len__(self) -> int:
+        return len(self.doc_lengths)
+
+    def add(self, ids: Iterable[str], texts: Iterable[str]):
+        with self._lock:
+            for doc_id, text in zip(ids, texts):
+                if doc_id in self.doc_lengths:
+                    self._remove_one(doc_id)
+                counts = Counter(tokenize(text))
+                for term, tf in counts.items():
+                    self.postings.setdefault(term, {})[doc_id] = tf
+                self.doc_terms[doc_id] = tuple(counts)
+                length = sum(counts.values())
+                self.doc_lengths[doc_id] = length
+                self.total_length += length
+            self._invalidate()
+
+    def remove(self, ids: Iterable[str]):
+        with self._lock:
+            for doc_id in ids:
+                if doc_id in self.doc_lengths:
+                    self._remove_one(doc_id)
+            self._invalidate()
+
+    def _invalidate(self):
+        self._norms = None
+        self._top_impacts = {}
+
+    def _remove_one(self, doc_id: str):
+        for term in self.doc_terms.pop(doc_id, ()):
+            docs = self.postings.get(term)
+            if docs is not None:
+                docs.pop(doc_id, None)
+                if not docs:
+                    del self.postings[term]
+        self.total_length -= self.doc_lengths.pop(doc_id)
+
+    def _doc_norms(self) -> Dict[str, float]:
+        if self._norms is None:
+            avg_length = self.total_length / len(self.doc_lengths) if self.doc_lengths else 0.0
+            self._norms = {
+                doc_id: self.k1 * (1 - self.b + self.b * length / avg_length) if avg_length else self.k1
+                for doc_id, length in self.doc_lengths.items()
+            }
+        return self._norms
+
+    def _impact(self, tf: int, norm: float) -> float:
+        return tf * (self.k1 + 1) / (tf + norm)
+
+    def _postings_for(self, term: str, docs: Dict[str, int], norms: Dict[str, float]):
+        if len(docs) <= self.max_postings:
+            return ((doc_id, self._impact(tf, norms[doc_id])) for doc_id, tf in docs.items())
+        top = self._top_impacts.get(term)
+        if top is None:
+            top = heapq.nlargest(
+                self.max_postings,
+                ((doc_id, self._impact(tf, norms[doc_id])) for doc_id, tf in docs.items()),
+                key=lambda item: item[1]
+            )
+            self._top_impacts[term] = top
+        return top
+
+    def warm(self):
+        """Rebuild cached normalisation factors and common-term lists so the next search does not pay for them."""
+        with self._lock:
+            norms = self._doc_norms()
+            for term, docs in self.postings.items():
+                if len(docs) > self.max_postings:
+                    self._postings_for(term, docs, norms)
+
+    def search(self, query: str, k: int = 10) -> List[Tuple[str, float]]:
+        """Return up to `k` (chunk id, BM25 score) pairs, best first."""
+        with self._lock:
+            n_docs = len(self.doc_lengths)
+            if not n_docs:
+                return []
+            norms = self._doc_norms()
+            scores: Dict[str, float] = {}
+            for term in set(tokenize(query)):
+                docs = self.postings.get(term)
+                if not docs:
+                    continue
+                idf = math.log(1 + (n_docs - len(docs) + 0.5) / (len(docs) + 0.5))
+                for doc_id, impact in self._postings_for(term, docs, norms):
+                    scores[doc_id] = scores.get(doc_id, 0.0) + idf * impact
+            return heapq.nlargest(k, scores.items(), key=lambda item: item[1])
+
+    def save(self):
+        if not self.path:
+            return
+        with self._lock:
+            state = {
+                "k1": self.k1,
+                "b": self.b,
+                "postings": self.postings,
+                "doc_terms": self.doc_terms,
+                "doc_lengths": self.doc_lengths,
+                "total_length": self.total_length,
+            }
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            tmp_path = f"{self.path}.tmp"
+            with open(tmp_path, "wb") as f:
+                pickle.dump(state, f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp_path, self.path)
+            self.mtime = os.stat(self.path).st_mtime_ns
+
+    def is_stale(self) -> bool:
+        """True if the file on disk was written by someone else since this index was loaded or saved."""
+        try:
+            return os.stat(self.path).st_mtime_ns != self.mtime
+        except (FileNotFoundError, TypeError):
+            return False
+
+    @classmethod
+    def load(cls, path: str) -> "BM25Index":
+        index = cls(path)
+        if os.path.exists(path):
+            try:
+                with open(path, "rb") as f:
+                    state = pickle.load(f)
+                index.k1 = state["k1"]
+                index.b = state["b"]
+                index.postings = state["postings"]
+                index.doc_terms = state["doc_terms"]
+                index.doc_lengths = state["doc_lengths"]
+                index.total_length = state["total_length"]
+                index.mtime = os.stat(path).st_mtime_ns
+            except Exception as e:
+                logger.error(f"Could not load keyword index {path}: {str(e)}")
+        return index
+
+
+def rrf_scores(rankings: List[List[str]], k: int = 60) -> Dict[str, float]:
+    """Each id scores sum(1 / (k + rank)) over the ranked lists it appears in."""
+    scores: Dict[str, float] = {}
+    for ranking in rankings:
+        for rank, doc_id in enumerate(ranking, start=1):
+            scores[doc_id] = scores.get(doc_id, 0.0) + 1.0 / (k + rank)
+    return scores
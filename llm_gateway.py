@@ -0,0 +1,284 @@
+import asyncio
+import hashlib
+import json
+import os
+import queue
+import random
+import threading
+import time
+from types import SimpleNamespace
+from typing import Any, AsyncIterator, Dict, Iterator, List, Optional
+
+import httpx
+
+from logger_config import setup_logger
+from metrics import LLM_COALESCED, LLM_IN_FLIGHT, LLM_RETRIES
+
+logger = setup_logger(__name__)
+
+GROQ_BASE_URL = "https://api.groq.com/openai/v1"
+
+
+class LLMError(Exception):
+    """The LLM call failed (bad request, upstream error, or retries exhausted)."""
+
+
+class LLMRateLimited(LLMError):
+    def __init__(self, message: str, retry_after: Optional[float] = None):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class LLMTimeout(LLMError):
+    """The request deadline passed before the LLM answered."""
+
+
+def _retry_after(response: httpx.Response) -> Optional[float]:
+    value = response.headers.get("retry-after")
+    try:
+        return max(0.0, float(value)) if value is not None else None
+    except ValueError:
+        return None
+
+
+class _Completions:
+    def __init__(self, gateway: "LLMGateway"):
+        self._gateway = gateway
+
+    def create(self, messages: List[Dict[str, str]], model: str, stream: bool = False, **params: Any):
+        if stream:
+            return self._gateway.stream(messages, model, **params)
+        return self._gateway.complete(messages, model, **params)
+
+
+class _StreamIterator:
+    """Blocking iterator over chunks produced by an async generator running on the gateway loop."""
+
+    _END = object()
+
+    def __init__(self, gateway: "LLMGateway", agen: AsyncIterator[str]):
+        self._queue: "queue.Queue[Any]" = queue.Queue()
+        self._future = asyncio.run_coroutine_threadsafe(self._pump(agen), gateway._loop)
+
+    async def _pump(self, agen: AsyncIterator[str]):
+        try:
+            async for token in agen:
+                self._queue.put(token)
+        except BaseException as e:
+            self._queue.put(e)
+            if isinstance(e, asyncio.CancelledError):
+                raise
+        finally:
+            self._queue.put(self._END)
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        item = self._queue.get()
+        if item is self._END:
+            raise StopIteration
+        if isinstance(item, BaseException):
+            raise item
+        return SimpleNamespace(choices=[SimpleNamespace(delta=SimpleNamespace(content=item))])
+
+    def close(self):
+        self._future.cancel()
+
+    def __del__(self):
+        self.close()
+
+
+class LLMGateway:
+    """Async client for an OpenAI-compatible chat completions API (Groq by default).
+
+    All calls run on one event loop in a background thread and share a pooled
+    `httpx.AsyncClient`. At most `max_concurrency` upstream requests are in flight;
+    429 and 5xx responses (and connection errors) are retried with exponential backoff
+    and jitter, honouring `Retry-After`; every request has a `timeout` deadline that
+    covers queueing, retries and the response. Identical non-streaming requests that
+    are in flight at the same time share a single upstream call.
+
+    `chat.completions.create(...)` mirrors the Groq SDK surface for synchronous callers;
+    `acomplete` and `astream` are the async equivalents. Point `base_url` at a local
+    server (see `stub_llm.StubLLMServer`) to test without the real API.
+    """
+
+    def __init__(
+        self,
+        api_key: str,
+        base_url: Optional[str] = None,
+        max_concurrency: Optional[int] = None,
+        max_retries: Optional[int] = None,
+        timeout: Optional[float] = None,
+        backoff_base: Optional[float] = None,
+        backoff_max: float = 10.0,
+        max_connections: Optional[int] = None
+    ):
+        self.base_url = (base_url or os.getenv("LLM_BASE_URL", GROQ_BASE_URL)).rstrip("/")
+        self.max_concurrency = max_concurrency or int(os.getenv("LLM_MAX_CONCURRENCY", "8"))
+        self.max_retries = int(os.getenv("LLM_MAX_RETRIES", "3")) if max_retries is None else max_retries
+        self.timeout = timeout or float(os.getenv("LLM_TIMEOUT", "60"))
+        self.backoff_base = backoff_base or float(os.getenv("LLM_BACKOFF_BASE", "0.5"))
+        self.backoff_max = backoff_max
+        max_connections = max_connections or int(os.getenv("LLM_MAX_CONNECTIONS", str(self.max_concurrency * 2)))
+        self._headers = {"Authorization": f"Bearer {api_key}"}
+        self._limits = httpx.Limits(max_connections=max_connections, max_keepalive_connections=max_connections)
+        self._inflight: Dict[str, asyncio.Future] = {}
+        self.chat = SimpleNamespace(completions=_Completions(self))
+
+        self._loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self._loop.run_forever, name="llm-gateway", daemon=True)
+        self._thread.start()
+        asyncio.run_coroutine_threadsafe(self._setup(), self._loop).result()
+
+    async def _setup(self):
+        # Created on the gateway loop: asyncio primitives bind to the running loop on older Pythons.
+        self._semaphore = asyncio.Semaphore(self.max_concurrency)
+        self._http = httpx.AsyncClient(
+            base_url=self.base_url,
+            headers=self._headers,
+            limits=self._limits,
+            timeout=httpx.Timeout(self.timeout, connect=min(self.timeout, 10.0))
+        )
+
+    def close(self):
+        if self._loop.is_closed():
+            return
+        asyncio.run_coroutine_threadsafe(self._http.aclose(), self._loop).result()
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join()
+        self._loop.close()
+
+    # -- synchronous facade -------------------------------------------------------
+
+    def complete(self, messages: List[Dict[str, str]], model: str, **params: Any) -> SimpleNamespace:
+        """Blocking chat completion; returns an object shaped like the Groq SDK response."""
+        future = asyncio.run_coroutine_threadsafe(self.acomplete(messages, model, **params), self._loop)
+        data = future.result()
+        usage = data.get("usage") or {}
+        return SimpleNamespace(
+            choices=[SimpleNamespace(message=SimpleNamespace(content=data["choices"][0]["message"]["content"]))],
+            usage=SimpleNamespace(
+                prompt_tokens=usage.get("prompt_tokens", 0),
+                completion_tokens=usage.get("completion_tokens", 0)
+            ) if usage else None
+        )
+
+    def stream(self, messages: List[Dict[str, str]], model: str, **params: Any) -> Iterator[SimpleNamespace]:
+        """Blocking iterator of streamed chunks shaped like the Groq SDK's (`chunk.choices[0].delta.content`)."""
+        return _StreamIterator(self, self.astream(messages, model, **params))
+
+    # -- async API ---------------------------------------------------------------
+
+    async def acomplete(self, messages: List[Dict[str, str]], model: str, **params: Any) -> Dict[str, Any]:
+        """Chat completion response JSON; identical concurrent requests share one upstream call."""
+        payload = dict(params, model=model, messages=messages)
+        key = hashlib.sha256(json.dumps(payload, sort_keys=True).encode("utf-8")).hexdigest()
+        shared = self._inflight.get(key)
+        if shared is not None:
+            LLM_COALESCED.inc()
+            return await asyncio.shield(shared)
+
+        deadline = time.monotonic() + self.timeout
+        task = asyncio.ensure_future(self._post(payload, deadline))
+        self._inflight[key] = task
+        task.add_done_callback(lambda _: self._inflight.pop(key, None))
+        return await asyncio.shield(task)
+
+    async def astream(self, messages: List[Dict[str, str]], model: str, **params: Any) -> AsyncIterator[str]:
+        """Yield content tokens. Failures before the first token are retried like `acomplete`.
+
+        Once a token has been yielded the stream is never restarted, since the caller has
+        already consumed part of an answer; a dropped connection then raises `LLMError`.
+        """
+        payload = dict(params, model=model, messages=messages, stream=True)
+        deadline = time.monotonic() + self.timeout
+        attempt = 0
+        started = False
+        while True:
+            await self._acquire(deadline)
+            LLM_IN_FLIGHT.inc()
+            try:
+                async with self._http.stream("POST", "/chat/completions", json=payload) as response:
+                    if response.status_code < 400:
+                        async for line in response.aiter_lines():
+                            if not line.startswith("data:"):
+                                continue
+                            data = line[len("data:"):].strip()
+                            if data == "[DONE]":
+                                return
+                            choices = json.loads(data).get("choices") or [{}]
+                            token = choices[0].get("delta", {}).get("content")
+                            if token:
+                                started = True
+                                yield token
+                        return
+                    await response.aread()
+                    error = self._error_for(response)
+            except httpx.TimeoutException:
+                raise LLMTimeout(f"LLM request timed out after {self.timeout:.1f}s")
+            except httpx.TransportError as e:
+                if started:
+                    raise LLMError(f"LLM stream interrupted: {str(e)}")
+                error = LLMError(f"LLM connection error: {str(e)}")
+            finally:
+                LLM_IN_FLIGHT.dec()
+                self._semaphore.release()
+            await self._backoff(error, attempt, deadline)
+            attempt += 1
+
+    # -- internals -----------------------------------------------------------------
+
+    async def _acquire(self, deadline: float):
+        try:
+            await asyncio.wait_for(self._semaphore.acquire(), timeout=max(0.0, deadline - time.monotonic()))
+        except asyncio.TimeoutError:
+            raise LLMTimeout("Timed out waiting for an LLM request slot")
+
+    async def _post(self, payload: Dict[str, Any], deadline: float) -> Dict[str, Any]:
+        attempt = 0
+        while True:
+            await self._acquire(deadline)
+            LLM_IN_FLIGHT.inc()
+            try:
+                response = await asyncio.wait_for(
+                    self._http.post("/chat/completions", json=payload),
+                    timeout=max(0.0, deadline - time.monotonic())
+                )
+                if response.status_code < 400:
+                    return response.json()
+                error = self._error_for(response)
+            except (asyncio.TimeoutError, httpx.TimeoutException):
+                raise LLMTimeout(f"LLM request timed out after {self.timeout:.1f}s")
+            except httpx.TransportError as e:
+                error = LLMError(f"LLM connection error: {str(e)}")
+            finally:
+                LLM_IN_FLIGHT.dec()
+                self._semaphore.release()
+            await self._backoff(error, attempt, deadline)
+            attempt += 1
+
+    @staticmethod
+    def _error_for(response: httpx.Response) -> LLMError:
+        detail = f"LLM returned HTTP {response.status_code}: {response.text[:200]}"
+        if response.status_code == 429:
+            return LLMRateLimited(detail, _retry_after(response))
+        if response.status_code >= 500:
+            return LLMError(detail)
+        # Other 4xx responses will not succeed on retry.
+        raise LLMError(detail)
+
+    async def _backoff(self, error: LLMError, attempt: int, deadline: float):
+        """Sleep before the next attempt, or raise `error` if retries or time have run out."""
+        if attempt >= self.max_retries:
+            raise error
+        delay = getattr(error, "retry_after", None)
+        if delay is None:
+            delay = min(self.backoff_max, self.backoff_base * 2 ** attempt) * random.uniform(0.5, 1.0)
+        if time.monotonic() + delay >= deadline:
+            raise error
+        reason = "rate_limited" if isinstance(error, LLMRateLimited) else "upstream_error"
+        LLM_RETRIES.labels(reason=reason).inc()
+        logger.warning(f"{error}; retrying in {delay:.2f}s (attempt {attempt + 1}/{self.max_retries})")
+        await asyncio.sleep(delay)
@@ -1,5 +1,44 @@
+import json
 import logging
+import os
 import sys
+from contextvars import ContextVar
+from datetime import datetime, timezone
+from typing import Optional
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# Set per HTTP request by the middleware in app.py; included in every log record.
+request_id_var: ContextVar[Optional[str]] = ContextVar("request_id", default=None)
+
+_RESERVED_ATTRS = set(logging.LogRecord("", 0, "", 0, "", (), None).__dict__) | {"message", "asctime", "request_id"}
+
+
+class RequestIdFilter(logging.Filter):
+    def filter(self, record: logging.LogRecord) -> bool:
+        record.request_id = request_id_var.get()
+        return True
+
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per line; fields passed via `extra=` are included as top-level keys."""
+
+    def format(self, record: logging.LogRecord) -> str:
+        payload = {
+            "timestamp": datetime.fromtimestamp(record.created, tz=timezone.utc).isoformat(),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+            "request_id": getattr(record, "request_id", None),
+        }
+        for key, value in record.__dict__.items():
+            if key not in _RESERVED_ATTRS and not key.startswith("_"):
+                payload[key] = value
+        if record.exc_info:
+            payload["exception"] = self.formatException(record.exc_info)
+        return json.dumps(payload, default=str)
+
 
 def setup_logger(name: str):
     logger = logging.getLogger(name)
@@ -9,10 +48,14 @@ def setup_logger(name: str):
         
         handler = logging.StreamHandler(sys.stdout)
         handler.setLevel(logging.INFO)
+        handler.addFilter(RequestIdFilter())
         
-        formatter = logging.Formatter(
-            '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
-        )
+        if os.getenv("LOG_FORMAT", "text").lower() == "json":
+            formatter = JsonFormatter()
+        else:
+            formatter = logging.Formatter(
+                '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+            )
         handler.setFormatter(formatter)
         
         logger.addHandler(handler)
@@ -0,0 +1,236 @@
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Any, Dict, Iterator, List, Optional, Sequence, Tuple
+
+# Per-request list of (stage, seconds) spans, set by the request middleware.
+request_spans: ContextVar[Optional[List[Tuple[str, float]]]] = ContextVar("request_spans", default=None)
+
+LATENCY_BUCKETS = [0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0]
+
+
+class Registry:
+    """Holds metrics by name; re-registering a name replaces the previous metric."""
+
+    def __init__(self):
+        self._metrics: Dict[str, "_Metric"] = {}
+        self._lock = threading.Lock()
+
+    def register(self, metric: "_Metric"):
+        with self._lock:
+            self._metrics[metric.name] = metric
+
+    def render(self) -> str:
+        """Prometheus text exposition format (version 0.0.4)."""
+        with self._lock:
+            metrics = list(self._metrics.values())
+        lines = []
+        for metric in metrics:
+            lines.append(f"# HELP {metric.name} {metric.description}")
+            lines.append(f"# TYPE {metric.name} {metric.type}")
+            lines.extend(metric.samples())
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+
+def _escape(value: Any) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(labels: Dict[str, str]) -> str:
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{key}="{_escape(value)}"' for key, value in labels.items()) + "}"
+
+
+class _Metric:
+    type = "untyped"
+
+    def __init__(self, name: str, description: str, labelnames: Sequence[str] = (), registry: Optional[Registry] = REGISTRY):
+        self.name = name
+        self.description = description
+        self.labelnames = tuple(labelnames)
+        self._children: Dict[Tuple[str, ...], Any] = {}
+        self._lock = threading.Lock()
+        if not self.labelnames:
+            self.labels()
+        if registry is not None:
+            registry.register(self)
+
+    def _new_child(self):
+        raise NotImplementedError
+
+    def labels(self, **labels: Any):
+        key = tuple(str(labels[name]) for name in self.labelnames)
+        with self._lock:
+            child = self._children.get(key)
+            if child is None:
+                child = self._children[key] = self._new_child()
+            return child
+
+    def _default(self):
+        return self.labels()
+
+    def _series(self) -> List[Tuple[Dict[str, str], Any]]:
+        with self._lock:
+            return [(dict(zip(self.labelnames, key)), child) for key, child in self._children.items()]
+
+
+class _CounterChild:
+    def __init__(self):
+        self.value = 0.0
+        self._lock = threading.Lock()
+
+    def inc(self, amount: float = 1.0):
+        with self._lock:
+            self.value += amount
+
+    def set(self, value: float):
+        with self._lock:
+            self.value = value
+
+    def dec(self, amount: float = 1.0):
+        self.inc(-amount)
+
+
+class Counter(_Metric):
+    type = "counter"
+
+    def _new_child(self):
+        return _CounterChild()
+
+    def inc(self, amount: float = 1.0):
+        self._default().inc(amount)
+
+    @property
+    def value(self) -> float:
+        return self._default().value
+
+    def samples(self) -> List[str]:
+        return [f"{self.name}{_format_labels(labels)} {child.value}" for labels, child in self._series()]
+
+
+class Gauge(Counter):
+    type = "gauge"
+
+    def set(self, value: float):
+        self._default().set(value)
+
+    def dec(self, amount: float = 1.0):
+        self._default().dec(amount)
+
+
+class _HistogramChild:
+    def __init__(self, buckets: Sequence[float]):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0.0
+        self._lock = threading.Lock()
+
+    def observe(self, value: float):
+        with self._lock:
+            self.count += 1
+            self.sum += value
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    self.counts[i] += 1
+
+    def snapshot(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "buckets": {str(bound): count for bound, count in zip(self.buckets, self.counts)},
+                "count": self.count,
+                "sum": round(self.sum, 6),
+            }
+
+
+class Histogram(_Metric):
+    """Thread-safe cumulative-bucket histogram (Prometheus semantics)."""
+
+    type = "histogram"
+
+    def __init__(
+        self,
+        name: str,
+        description: str,
+        buckets: Sequence[float] = LATENCY_BUCKETS,
+        labelnames: Sequence[str] = (),
+        registry: Optional[Registry] = REGISTRY
+    ):
+        self.buckets = sorted(buckets)
+        super().__init__(name, description, labelnames, registry)
+
+    def _new_child(self):
+        return _HistogramChild(self.buckets)
+
+    def observe(self, value: float):
+        self._default().observe(value)
+
+    def snapshot(self) -> Dict[str, Any]:
+        return self._default().snapshot()
+
+    def samples(self) -> List[str]:
+        lines = []
+        for labels, child in self._series():
+            snapshot = child.snapshot()
+            for bound, count in snapshot["buckets"].items():
+                lines.append(f"{self.name}_bucket{_format_labels(dict(labels, le=bound))} {count}")
+            lines.append(f"{self.name}_bucket{_format_labels(dict(labels, le='+Inf'))} {snapshot['count']}")
+            lines.append(f"{self.name}_sum{_format_labels(labels)} {snapshot['sum']}")
+            lines.append(f"{self.name}_count{_format_labels(labels)} {snapshot['count']}")
+        return lines
+
+
+STAGE_SECONDS = Histogram(
+    "rag_stage_duration_seconds", "Time spent in each request or ingestion stage", labelnames=("stage",)
+)
+HTTP_REQUESTS = Counter(
+    "http_requests_total", "HTTP requests by route and status", labelnames=("method", "route", "status")
+)
+HTTP_REQUEST_SECONDS = Histogram(
+    "http_request_duration_seconds", "HTTP request latency by route", labelnames=("method", "route")
+)
+LLM_TOKENS = Counter("llm_tokens_total", "LLM tokens by direction (in = prompt, out = completion)", labelnames=("direction",))
+LLM_ERRORS = Counter("llm_errors_total", "Failed LLM calls")
+LLM_RETRIES = Counter("llm_retries_total", "Retried LLM requests by reason", labelnames=("reason",))
+LLM_COALESCED = Counter("llm_coalesced_total", "LLM requests served by an identical in-flight request")
+LLM_IN_FLIGHT = Gauge("llm_in_flight", "Upstream LLM requests currently in flight")
+LLM_TIME_TO_FIRST_TOKEN = Histogram("llm_time_to_first_token_seconds", "Time until the first streamed LLM token")
+CHUNKS_RETRIEVED = Histogram("rag_chunks_retrieved", "Chunks retrieved per query", buckets=[0, 1, 2, 3, 5, 10, 20, 50, 100])
+QUERY_REWRITES = Counter("rag_query_rewrites_total", "Follow-up questions rewritten into standalone queries", labelnames=("method",))
+RETRIEVAL_REUSED = Counter("rag_retrieval_reused_total", "Chat turns answered from the previous turn's chunks without a new search")
+UPLOAD_BYTES = Counter("upload_bytes_total", "Bytes received by document uploads")
+UPLOAD_BYTES_PER_SECOND = Histogram(
+    "upload_bytes_per_second", "Upload receive throughput",
+    buckets=[1e5, 5e5, 1e6, 5e6, 1e7, 5e7, 1e8, 5e8]
+)
+RATE_LIMITED = Counter("rag_rate_limited_total", "Requests rejected with 429 by rate-limit scope", labelnames=("scope",))
+ADMISSION_SHED = Counter(
+    "rag_admission_shed_total", "Requests shed with 503 by lane and reason", labelnames=("lane", "reason")
+)
+ADMISSION_QUEUE_DEPTH = Gauge("rag_admission_queue_depth", "Requests waiting for (or queued in) each backend lane", labelnames=("lane",))
+ADMISSION_ACTIVE = Gauge("rag_admission_active", "Requests holding a slot in each backend lane", labelnames=("lane",))
+ADMISSION_CACHE_SERVED = Counter("rag_admission_cache_served_total", "Answers served from the cache without entering the LLM lane")
+CACHE_EVENTS = Gauge("rag_cache_events", "Cache hits, misses and evictions since start", labelnames=("cache", "event"))
+CACHE_SIZE = Gauge("rag_cache_entries", "Entries currently cached", labelnames=("cache",))
+
+
+def record_span(stage: str, seconds: float):
+    STAGE_SECONDS.labels(stage=stage).observe(seconds)
+    spans = request_spans.get()
+    if spans is not None:
+        spans.append((stage, round(seconds, 6)))
+
+
+@contextmanager
+def timed(stage: str) -> Iterator[None]:
+    """Time a block as `stage`, feeding the stage histogram and the current request's spans."""
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        record_span(stage, time.perf_counter() - started)
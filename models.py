@@ -1,8 +1,8 @@
-from sqlalchemy import Column, Integer, String, DateTime, ForeignKey, Text
+from sqlalchemy import Column, Integer, String, DateTime, ForeignKey, Text, Index
 from sqlalchemy.orm import relationship
 from datetime import datetime
-from pydantic import BaseModel
-from typing import List, Optional
+from pydantic import BaseModel, Field
+from typing import Dict, List, Literal, Optional
 from database import Base
 
 # SQLAlchemy Models
@@ -23,9 +23,46 @@ class Document(Base):
     subject_id = Column(Integer, ForeignKey("subjects.id"))
     filename = Column(String)
     file_type = Column(String)
+    file_hash = Column(String)
+    chunk_count = Column(Integer, default=0)
     uploaded_at = Column(DateTime, default=datetime.utcnow)
 
     subject = relationship("Subject", back_populates="documents")
+    versions = relationship(
+        "DocumentVersion", back_populates="document", order_by="DocumentVersion.version", cascade="all, delete-orphan"
+    )
+
+    __table_args__ = (
+        Index("ix_documents_subject_hash", "subject_id", "file_hash"),
+    )
+
+    @property
+    def version(self) -> int:
+        # Documents ingested before versions were recorded count as version 1.
+        return self.versions[-1].version if self.versions else 1
+
+    def record_version(self):
+        """Append a version entry for the document's current filename, hash and chunk count."""
+        number = self.version + 1 if self.versions or self.id is not None else 1
+        self.versions.append(DocumentVersion(
+            version=number,
+            filename=self.filename,
+            file_hash=self.file_hash,
+            chunk_count=self.chunk_count
+        ))
+
+class DocumentVersion(Base):
+    __tablename__ = "document_versions"
+
+    id = Column(Integer, primary_key=True, index=True)
+    document_id = Column(Integer, ForeignKey("documents.id"), index=True)
+    version = Column(Integer)
+    filename = Column(String)
+    file_hash = Column(String)
+    chunk_count = Column(Integer, default=0)
+    created_at = Column(DateTime, default=datetime.utcnow)
+
+    document = relationship("Document", back_populates="versions")
 
 # Pydantic Models
 class SubjectBase(BaseModel):
@@ -46,14 +83,100 @@ class DocumentResponse(BaseModel):
     id: int
     filename: str
     file_type: str
+    file_hash: Optional[str] = None
+    chunk_count: Optional[int] = None
     uploaded_at: datetime
+    version: int = 1
+
+    class Config:
+        orm_mode = True
+
+class DocumentVersionResponse(BaseModel):
+    version: int
+    filename: str
+    file_hash: Optional[str] = None
+    chunk_count: Optional[int] = None
+    created_at: datetime
 
     class Config:
         orm_mode = True
 
+class DocumentDetailResponse(DocumentResponse):
+    versions: List[DocumentVersionResponse] = []
+
+class DocumentDeleteResponse(BaseModel):
+    document_id: int
+    filename: str
+    removed_chunks: int
+
+class CompactionResponse(BaseModel):
+    subject_id: int
+    before: Dict[str, int]
+    after: Dict[str, int]
+    orphans_removed: int
+    seconds: float
+
 class ChatRequest(BaseModel):
     question: str
+    retrieval_mode: Optional[Literal["vector", "keyword", "hybrid"]] = None
+    token_budget: Optional[int] = Field(None, ge=1)
+    session_id: Optional[str] = Field(None, max_length=128)
+    top_k: Optional[int] = Field(None, ge=1, le=50)
+    rerank: Optional[bool] = None
+    rerank_depth: Optional[int] = Field(None, ge=1, le=200)
 
 class ChatResponse(BaseModel):
     answer: str
     sources: List[str] = []
+    cached: bool = False
+    usage: Optional[Dict[str, int]] = None
+    session_id: Optional[str] = None
+    standalone_question: Optional[str] = None
+    timings: Optional[Dict[str, float]] = None
+
+class MultiChatRequest(ChatRequest):
+    subject_ids: List[int]
+
+class SubjectSources(BaseModel):
+    subject_id: int
+    subject_name: str
+    sources: List[str] = []
+    retrieved_chunks: int = 0
+
+class MultiChatResponse(ChatResponse):
+    subject_sources: List[SubjectSources] = []
+
+class ConversationTurn(BaseModel):
+    question: str
+    standalone_question: str
+    answer: str
+    chunk_ids: List[str] = []
+
+class ConversationResponse(BaseModel):
+    session_id: str
+    turn_count: int
+    summary: List[str] = []
+    turns: List[ConversationTurn] = []
+
+class UploadResponse(BaseModel):
+    message: str
+    job_id: Optional[str] = None
+    status: str
+    document_id: Optional[int] = None
+
+class JobResponse(BaseModel):
+    id: str
+    subject_id: int
+    filename: str
+    status: str
+    stage: str
+    progress: float
+    error: Optional[str] = None
+    document_id: Optional[int] = None
+    chunk_count: Optional[int] = None
+    embedded_count: Optional[int] = None
+    created_at: datetime
+    started_at: Optional[datetime] = None
+    finished_at: Optional[datetime] = None
+    duration_seconds: Optional[float] = None
+    stage_timings: Dict[str, float] = {}
@@ -1,86 +1,789 @@
-import chromadb
-from chromadb.config import Settings
-from sentence_transformers import SentenceTransformer
 import os
-from groq import Groq
-from typing import List, Dict, Any
+import contextvars
+import hashlib
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Dict, Any, Iterator, Iterable, Callable, Optional, Tuple
+import numpy as np
 from dotenv import load_dotenv
 from logger_config import setup_logger
+from cache import LRUCache
+from document_processor import DocumentProcessor
+from embedding_service import EmbeddingService
+from keyword_index import BM25Index, rrf_scores
+from context_builder import ContextBuilder
+from reranker import Reranker
+from chunking import Chunk, Chunker, create_chunker
+from conversation import Conversation, ConversationStore, Turn, cosine_similarity, is_follow_up
+from vector_store import MemmapVectorStore
+from llm_gateway import LLMError, LLMGateway
+from admission import Lane, Overloaded, check_backlog
+from metrics import (
+    ADMISSION_CACHE_SERVED, CHUNKS_RETRIEVED, LLM_ERRORS, LLM_TIME_TO_FIRST_TOKEN, LLM_TOKENS, QUERY_REWRITES,
+    RETRIEVAL_REUSED, record_span, timed
+)
 
 logger = setup_logger(__name__)
 
 load_dotenv()
 
 class RAGService:
+    """Retrieval and answer generation for all subjects.
+
+    Construction is cheap: the vector store, the embedding model and the LLM gateway are
+    opened on first use (or by `warm_up`), so the service can be created at import time,
+    before worker processes are forked.
+    """
+
     def __init__(self):
 
-        self.chroma_client = chromadb.PersistentClient(path=os.getenv("CHROMA_PERSIST_DIR", "./chroma_db"))
-        
+        self.vector_backend = os.getenv("VECTOR_BACKEND", "chroma")
+        self._vector_client = None
+        self._client = None
+        self._client_created = False
+        self._chunker: Optional[Chunker] = None
+        self._init_lock = threading.Lock()
 
-        self.embedding_model = SentenceTransformer('all-MiniLM-L6-v2')
+        self.embedder = EmbeddingService()
 
-        api_key = os.getenv("GROQ_API_KEY")
-        if api_key:
-            self.client = Groq(api_key=api_key)
-            self.model = "llama-3.1-8b-instant"
-            logger.info("Groq API configured successfully")
-        else:
+        self.model = "llama-3.1-8b-instant"
+        if not os.getenv("GROQ_API_KEY"):
             logger.warning("GROQ_API_KEY not found in environment variables.")
-            print("Warning: GROQ_API_KEY not found in environment variables.")
-            self.client = None
+
+        self.embedding_batch_size = int(os.getenv("EMBEDDING_BATCH_SIZE", "64"))
+        # Admission control: answer-cache misses queue for an LLM slot; query embeddings are
+        # refused while the embedding batcher is too far behind. Cache hits skip both.
+        self.llm_lane = Lane(
+            "llm",
+            slots=int(os.getenv("LLM_QUEUE_SLOTS", os.getenv("LLM_MAX_CONCURRENCY", "8"))),
+            max_queue=int(os.getenv("LLM_QUEUE_MAX", "32")),
+            queue_timeout=float(os.getenv("LLM_QUEUE_TIMEOUT", "10"))
+        )
+        self.embedding_max_backlog = int(os.getenv("EMBEDDING_MAX_BACKLOG", "256"))
+        self.embedding_cache = LRUCache(maxsize=int(os.getenv("EMBEDDING_CACHE_SIZE", "2048")))
+        self.answer_cache = LRUCache(
+            maxsize=int(os.getenv("ANSWER_CACHE_SIZE", "1024")),
+            ttl=float(os.getenv("ANSWER_CACHE_TTL", "3600"))
+        )
+
+        self.keyword_index_dir = os.getenv("KEYWORD_INDEX_DIR", "./keyword_index")
+        self.retrieval_mode = os.getenv("RETRIEVAL_MODE", "hybrid")
+        self.rrf_k = int(os.getenv("RRF_K", "60"))
+        self._keyword_indexes: Dict[int, BM25Index] = {}
+        self._keyword_lock = threading.Lock()
+        self._subject_locks: Dict[int, threading.RLock] = {}
+        self.context_builder = ContextBuilder()
+        self.reranker = Reranker()
+        self.conversations = ConversationStore(self.context_builder.count_tokens)
+        self.rewrite_mode = os.getenv("CONVERSATION_REWRITE", "llm")  # llm, heuristic or off
+        self.history_tokens = int(os.getenv("CONVERSATION_HISTORY_TOKENS", "400"))
+        self.reuse_similarity = float(os.getenv("CONVERSATION_REUSE_SIMILARITY", "0.9"))
+        # Per-subject searches of a multi-subject query run concurrently on this pool.
+        self._search_pool = ThreadPoolExecutor(
+            max_workers=int(os.getenv("MULTI_SUBJECT_WORKERS", "8")),
+            thread_name_prefix="subject-search"
+        )
+
+    @property
+    def vector_client(self):
+        if self._vector_client is None:
+            with self._init_lock:
+                if self._vector_client is None:
+                    self._vector_client = self._open_vector_client()
+        return self._vector_client
+
+    def _open_vector_client(self):
+        if self.vector_backend == "memmap":
+            client = MemmapVectorStore(
+                os.getenv("VECTOR_STORE_DIR", "./vector_store"),
+                dtype=os.getenv("VECTOR_STORE_DTYPE", "int8"),
+                rescore=os.getenv("VECTOR_STORE_RESCORE", "true").lower() == "true",
+                rescore_factor=int(os.getenv("VECTOR_STORE_RESCORE_FACTOR", "4"))
+            )
+        else:
+            import chromadb
+
+            client = chromadb.PersistentClient(path=os.getenv("CHROMA_PERSIST_DIR", "./chroma_db"))
+        logger.info(f"Using {self.vector_backend} vector backend")
+        return client
+
+    @property
+    def chunker(self) -> Chunker:
+        """The configured chunker (`CHUNKER`), sized with the embedding model's tokenizer."""
+        if self._chunker is None:
+            with self._init_lock:
+                if self._chunker is None:
+                    name = os.getenv("CHUNKER", "structured")
+                    token_counter, max_tokens = self.embedder.token_counter() if name == "structured" else (None, None)
+                    self._chunker = create_chunker(name, token_counter, max_tokens)
+        return self._chunker
+
+    @property
+    def client(self):
+        """The LLM client, or None when GROQ_API_KEY is not set. Can be replaced (e.g. with a stub)."""
+        if not self._client_created:
+            with self._init_lock:
+                if not self._client_created:
+                    api_key = os.getenv("GROQ_API_KEY")
+                    if api_key:
+                        self._client = LLMGateway(api_key=api_key)
+                        logger.info("Groq API configured successfully")
+                    self._client_created = True
+        return self._client
+
+    @client.setter
+    def client(self, value):
+        self._client = value
+        self._client_created = True
+
+    def warm_up(self):
+        """Open the vector store and LLM client and load the embedding model ahead of the first request."""
+        started = time.perf_counter()
+        self.vector_client
+        self.client
+        self.embedder.warm_up()
+        if self.reranker.enabled:
+            self.reranker.warm_up()
+        logger.info(f"RAG service warm in {time.perf_counter() - started:.2f}s")
+
+    def readiness(self) -> Dict[str, bool]:
+        checks = {
+            "vector_store": self._vector_client is not None,
+            "embedding_model": self.embedder.ready,
+        }
+        if self.reranker.enabled:
+            checks["rerank_model"] = self.reranker.ready
+        return checks
+
+    def close(self):
+        self._search_pool.shutdown(wait=False)
+        self.embedder.close()
+        if hasattr(self._client, "close"):
+            self._client.close()
 
     def _get_collection_name(self, subject_id: int) -> str:
         return f"subject_{subject_id}"
 
+    def subject_lock(self, subject_id: int) -> threading.RLock:
+        """Serializes writes to one subject's collection, keyword index and Document rows (ingestion, deletion, compaction)."""
+        with self._keyword_lock:
+            return self._subject_locks.setdefault(subject_id, threading.RLock())
+
+    def _keyword_index(self, subject_id: int) -> BM25Index:
+        """The subject's BM25 index, loaded from disk on first use and reloaded if another process (e.g. `bulk_ingest.py`) rewrote it."""
+        with self._keyword_lock:
+            index = self._keyword_indexes.get(subject_id)
+            if index is None or index.is_stale():
+                path = os.path.join(self.keyword_index_dir, f"{self._get_collection_name(subject_id)}.pkl")
+                index = BM25Index.load(path)
+                self._keyword_indexes[subject_id] = index
+            return index
+
+    @staticmethod
+    def _normalize_query(query_text: str) -> str:
+        return " ".join(query_text.lower().split())
+
+    def _embed_query(self, query_text: str) -> List[float]:
+        """Encode a query, reusing the cached embedding for equivalent text."""
+        key = self._normalize_query(query_text)
+        embedding = self.embedding_cache.get(key)
+        if embedding is None:
+            check_backlog("embedding", self.embedder.pending, self.embedding_max_backlog)
+            with timed("embed"):
+                embedding = self.embedder.encode([query_text])[0]
+            self.embedding_cache.set(key, embedding)
+        return embedding
+
+    def invalidate_subject(self, subject_id: int) -> int:
+        """Drop cached answers and re-ranking scores for a subject whose collection has changed."""
+        removed = self.answer_cache.invalidate(
+            lambda key: key[0] == subject_id or (isinstance(key[0], tuple) and subject_id in key[0])
+        )
+        self.reranker.invalidate(subject_id)
+        if removed:
+            logger.info(f"Invalidated {removed} cached answers for subject {subject_id}")
+        return removed
+
+    def cache_stats(self) -> Dict[str, Any]:
+        return {
+            "embeddings": self.embedding_cache.stats(),
+            "answers": self.answer_cache.stats(),
+            "rerank": self.reranker.cache.stats(),
+            "conversations": self.conversations.stats()
+        }
+
+    @staticmethod
+    def hash_text(text: str) -> str:
+        return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+    @staticmethod
+    def _chunk_id(subject_id: int, filename: str, chunk_hash: str) -> str:
+        """Stable id for a chunk: the same text in the same document always maps to the same id."""
+        document_key = hashlib.sha256(filename.encode("utf-8")).hexdigest()[:16]
+        return f"{subject_id}_{document_key}_{chunk_hash[:32]}"
+
     def add_documents(self, subject_id: int, documents: List[str], metadatas: List[Dict[str, Any]]):
         """Add document chunks to the subject's vector collection."""
-        collection = self.chroma_client.get_or_create_collection(
+        collection = self.vector_client.get_or_create_collection(
             name=self._get_collection_name(subject_id)
         )
+
+        unique = {}
+        for doc, metadata in zip(documents, metadatas):
+            chunk_hash = self.hash_text(doc)
+            chunk_id = self._chunk_id(subject_id, metadata.get("filename", ""), chunk_hash)
+            unique.setdefault(chunk_id, (doc, dict(metadata, chunk_hash=chunk_hash)))
+        ids = list(unique)
+        documents = [unique[chunk_id][0] for chunk_id in ids]
         
-        embeddings = self.embedding_model.encode(documents).tolist()
-        ids = [f"{subject_id}_{i}_{hash(doc)}" for i, doc in enumerate(documents)]
+        embeddings = self.embedder.encode_batch(documents, batch_size=self.embedding_batch_size)
         
-        collection.add(
+        collection.upsert(
             documents=documents,
             embeddings=embeddings,
-            metadatas=metadatas,
+            metadatas=[unique[chunk_id][1] for chunk_id in ids],
             ids=ids
         )
+        keyword_index = self._keyword_index(subject_id)
+        keyword_index.add(ids, documents)
+        keyword_index.save()
+        keyword_index.warm()
         logger.info(f"Added {len(documents)} documents to subject {subject_id}")
+        self.invalidate_subject(subject_id)
+
+    def add_document_batch(self, subject_id: int, documents: List[Dict[str, Any]], replace: Iterable[str] = ()) -> Dict[str, int]:
+        """Store many documents' chunks with one embedding pass and bulk vector/keyword writes.
 
-    def query(self, subject_id: int, query_text: str, n_results: int = 5) -> Dict[str, Any]:
-        """Query the subject's documents and generate a response."""
+        Each entry has `metadata` (including its `filename`) and `chunks` (`Chunk`s or
+        strings). Chunks already stored are not re-embedded, so re-running a batch after a
+        crash is cheap. For filenames in `replace` (documents being re-ingested), stored
+        chunks that are no longer present are deleted.
+        """
+        with self.subject_lock(subject_id):
+            collection = self.vector_client.get_or_create_collection(
+                name=self._get_collection_name(subject_id)
+            )
+            entries: Dict[str, tuple] = {}
+            for document in documents:
+                metadata = document["metadata"]
+                for chunk_index, chunk in enumerate(document["chunks"]):
+                    doc, chunk_metadata = (chunk.text, chunk.metadata()) if isinstance(chunk, Chunk) else (chunk, {})
+                    chunk_hash = self.hash_text(doc)
+                    chunk_id = self._chunk_id(subject_id, metadata["filename"], chunk_hash)
+                    chunk_metadata.update(metadata, chunk_index=chunk_index, chunk_hash=chunk_hash)
+                    entries.setdefault(chunk_id, (doc, chunk_metadata))
+
+            ids = list(entries)
+            write_size = getattr(self.vector_client, "get_max_batch_size", lambda: 0)() or max(len(ids), 1)
+            existing = set()
+            for start in range(0, len(ids), write_size):
+                existing.update(collection.get(ids=ids[start:start + write_size], include=[])["ids"])
+            stale = []
+            for filename in replace:
+                stale.extend(
+                    chunk_id for chunk_id in collection.get(where={"filename": filename}, include=[])["ids"]
+                    if chunk_id not in entries
+                )
+
+            new_ids = [chunk_id for chunk_id in ids if chunk_id not in existing]
+            kept_ids = [chunk_id for chunk_id in ids if chunk_id in existing]
+            with timed("embed_batch"):
+                embeddings = self.embedder.encode_batch(
+                    [entries[chunk_id][0] for chunk_id in new_ids], batch_size=self.embedding_batch_size
+                ) if new_ids else []
+            with timed("vector_write"):
+                for start in range(0, len(new_ids), write_size):
+                    batch_ids = new_ids[start:start + write_size]
+                    collection.add(
+                        ids=batch_ids,
+                        embeddings=embeddings[start:start + write_size],
+                        documents=[entries[chunk_id][0] for chunk_id in batch_ids],
+                        metadatas=[entries[chunk_id][1] for chunk_id in batch_ids]
+                    )
+                for start in range(0, len(kept_ids), write_size):
+                    batch_ids = kept_ids[start:start + write_size]
+                    collection.update(ids=batch_ids, metadatas=[entries[chunk_id][1] for chunk_id in batch_ids])
+                for start in range(0, len(stale), write_size):
+                    collection.delete(ids=stale[start:start + write_size])
+
+            keyword_index = self._keyword_index(subject_id)
+            # Kept chunks may be missing from the keyword index if a previous run stopped before saving it.
+            unindexed = [chunk_id for chunk_id in ids if chunk_id not in keyword_index.doc_lengths]
+            keyword_index.add(unindexed, [entries[chunk_id][0] for chunk_id in unindexed])
+            keyword_index.remove(stale)
+            keyword_index.save()
+            keyword_index.warm()
+            if new_ids or stale:
+                self.invalidate_subject(subject_id)
+            return {"chunks": len(ids), "embedded": len(new_ids), "reused": len(kept_ids), "removed": len(stale)}
+
+    def add_documents_stream(
+        self,
+        subject_id: int,
+        chunks: Iterable[Any],
+        metadata: Dict[str, Any],
+        batch_size: Optional[int] = None,
+        on_batch: Optional[Callable[[int], None]] = None
+    ) -> Dict[str, int]:
+        """Embed and store a stream of chunks from one document, one batch at a time.
+
+        `metadata` must contain the document's `filename`. Chunks already stored for that
+        document (same content hash) are kept without re-embedding, and chunks no longer
+        present are deleted, so re-uploading a revised file only embeds what changed.
+        Each chunk gets a copy of `metadata` plus its `chunk_index` and `chunk_hash`, and
+        for `Chunk` items (rather than plain strings) their page and heading metadata;
+        `on_batch` is called with the running chunk count after every batch.
+        Returns counts of `chunks`, `embedded`, `reused` and `removed`.
+        """
+        with self.subject_lock(subject_id):
+            batch_size = batch_size or self.embedding_batch_size
+            filename = metadata["filename"]
+            collection = self.vector_client.get_or_create_collection(
+                name=self._get_collection_name(subject_id)
+            )
+            existing = set(collection.get(where={"filename": filename}, include=[])["ids"])
+            keyword_index = self._keyword_index(subject_id)
+
+            seen = set()
+            stats = {"chunks": 0, "embedded": 0, "reused": 0, "removed": 0}
+            for batch in DocumentProcessor.iter_batches(chunks, batch_size):
+                new_ids, new_docs, new_metadatas = [], [], []
+                kept_ids, kept_metadatas = [], []
+                for offset, chunk in enumerate(batch):
+                    doc, chunk_metadata = (chunk.text, chunk.metadata()) if isinstance(chunk, Chunk) else (chunk, {})
+                    chunk_hash = self.hash_text(doc)
+                    chunk_id = self._chunk_id(subject_id, filename, chunk_hash)
+                    if chunk_id in seen:
+                        continue
+                    seen.add(chunk_id)
+                    chunk_metadata.update(metadata, chunk_index=stats["chunks"] + offset, chunk_hash=chunk_hash)
+                    if chunk_id in existing:
+                        kept_ids.append(chunk_id)
+                        kept_metadatas.append(chunk_metadata)
+                    else:
+                        new_ids.append(chunk_id)
+                        new_docs.append(doc)
+                        new_metadatas.append(chunk_metadata)
+
+                if new_ids:
+                    with timed("embed_batch"):
+                        embeddings = self.embedder.encode_batch(new_docs, batch_size=batch_size)
+                    with timed("vector_write"):
+                        collection.add(
+                            documents=new_docs,
+                            embeddings=embeddings,
+                            metadatas=new_metadatas,
+                            ids=new_ids
+                        )
+                    keyword_index.add(new_ids, new_docs)
+                if kept_ids:
+                    collection.update(ids=kept_ids, metadatas=kept_metadatas)
+
+                stats["chunks"] += len(batch)
+                stats["embedded"] += len(new_ids)
+                stats["reused"] += len(kept_ids)
+                if on_batch:
+                    on_batch(stats["chunks"])
+
+            stale = list(existing - seen)
+            if stale:
+                collection.delete(ids=stale)
+                keyword_index.remove(stale)
+                stats["removed"] = len(stale)
+            if stats["embedded"] or stats["removed"]:
+                keyword_index.save()
+                keyword_index.warm()
+
+            logger.info(
+                f"Stored {stats['chunks']} chunks of {filename} for subject {subject_id}: "
+                f"{stats['embedded']} embedded, {stats['reused']} reused, {stats['removed']} removed"
+            )
+            if stats["embedded"] or stats["removed"]:
+                self.invalidate_subject(subject_id)
+            return stats
+
+    def delete_document(self, subject_id: int, filename: str) -> int:
+        """Remove all chunks of a document (matched by `filename` metadata) from the vector store and keyword index."""
+        with self.subject_lock(subject_id):
+            try:
+                collection = self.vector_client.get_collection(name=self._get_collection_name(subject_id))
+            except:
+                return 0
+            ids = collection.get(where={"filename": filename}, include=[])["ids"]
+            if ids:
+                with timed("vector_delete"):
+                    collection.delete(where={"filename": filename})
+                keyword_index = self._keyword_index(subject_id)
+                keyword_index.remove(ids)
+                keyword_index.save()
+                keyword_index.warm()
+                self.invalidate_subject(subject_id)
+            logger.info(f"Deleted {len(ids)} chunks of {filename} from subject {subject_id}")
+            return len(ids)
+
+    @staticmethod
+    def _disk_usage(path: str) -> int:
+        if os.path.isfile(path):
+            return os.path.getsize(path)
+        total = 0
+        for root, _, files in os.walk(path):
+            for name in files:
+                try:
+                    total += os.path.getsize(os.path.join(root, name))
+                except OSError:
+                    pass
+        return total
+
+    def subject_stats(self, subject_id: int) -> Dict[str, int]:
+        """Index size figures for a subject. Chroma keeps all subjects in one directory, so `vector_store_bytes` covers the whole store there."""
+        name = self._get_collection_name(subject_id)
+        try:
+            chunks = self.vector_client.get_collection(name=name).count()
+        except:
+            chunks = 0
+        keyword_index = self._keyword_index(subject_id)
+        if self.vector_backend == "memmap":
+            vector_path = os.path.join(self.vector_client.path, name)
+        else:
+            vector_path = os.getenv("CHROMA_PERSIST_DIR", "./chroma_db")
+        return {
+            "chunks": chunks,
+            "keyword_documents": len(keyword_index),
+            "keyword_terms": len(keyword_index.postings),
+            "keyword_index_bytes": self._disk_usage(keyword_index.path),
+            "vector_store_bytes": self._disk_usage(vector_path),
+        }
+
+    def _rebuild_chroma_collection(self, name: str):
+        """Copy a Chroma collection into a fresh one (a new HNSW index without deleted entries) and swap it in."""
+        source = self.vector_client.get_collection(name=name)
+        temp_name = f"{name}_compacting"
         try:
-            collection = self.chroma_client.get_collection(name=self._get_collection_name(subject_id))
+            self.vector_client.delete_collection(name=temp_name)
+        except Exception:
+            pass  # no leftover from an interrupted compaction
+        target = self.vector_client.create_collection(name=temp_name, metadata=source.metadata)
+        page = self.vector_client.get_max_batch_size()
+        offset = 0
+        while True:
+            records = source.get(limit=page, offset=offset, include=["embeddings", "documents", "metadatas"])
+            if not records["ids"]:
+                break
+            target.add(
+                ids=records["ids"],
+                embeddings=records["embeddings"],
+                documents=records["documents"],
+                metadatas=records["metadatas"]
+            )
+            offset += len(records["ids"])
+        self.vector_client.delete_collection(name=name)
+        target.modify(name=name)
+
+    def compact_subject(self, subject_id: int, filenames: Iterable[str]) -> Dict[str, Any]:
+        """Rebuild a subject's indexes, keeping only chunks of the documents in `filenames`.
+
+        Chunks of any other file (left behind by deleted documents or interrupted
+        ingestion) are removed, the vector index is rewritten without deleted entries, and
+        the keyword index is rebuilt from the remaining chunks. Returns index sizes
+        `before` and `after`, the number of orphaned chunks removed and the time taken.
+        """
+        started = time.perf_counter()
+        live = set(filenames)
+        with self.subject_lock(subject_id):
+            before = self.subject_stats(subject_id)
+            name = self._get_collection_name(subject_id)
+            try:
+                collection = self.vector_client.get_collection(name=name)
+            except:
+                collection = None
+
+            orphans: List[str] = []
+            if collection is not None:
+                records = collection.get(include=["metadatas"])
+                orphans = [
+                    chunk_id for chunk_id, metadata in zip(records["ids"], records["metadatas"])
+                    if (metadata or {}).get("filename") not in live
+                ]
+                write_size = getattr(self.vector_client, "get_max_batch_size", lambda: 0)() or max(len(orphans), 1)
+                for start in range(0, len(orphans), write_size):
+                    collection.delete(ids=orphans[start:start + write_size])
+                with timed("compact_vectors"):
+                    if self.vector_backend == "memmap":
+                        collection.compact()
+                    else:
+                        self._rebuild_chroma_collection(name)
+                        collection = self.vector_client.get_collection(name=name)
+
+            with timed("compact_keywords"):
+                keyword_index = BM25Index(self._keyword_index(subject_id).path)
+                if collection is not None:
+                    records = collection.get(include=["documents"])
+                    keyword_index.add(records["ids"], records["documents"])
+                keyword_index.save()
+                keyword_index.warm()
+                with self._keyword_lock:
+                    self._keyword_indexes[subject_id] = keyword_index
+            self.invalidate_subject(subject_id)
+            after = self.subject_stats(subject_id)
+
+        seconds = round(time.perf_counter() - started, 3)
+        logger.info(f"Compacted subject {subject_id} in {seconds}s, removed {len(orphans)} orphaned chunks: {before} -> {after}")
+        return {"subject_id": subject_id, "before": before, "after": after, "orphans_removed": len(orphans), "seconds": seconds}
+
+    def _retrieve(
+        self,
+        subject_id: int,
+        query_text: str,
+        n_results: int,
+        retrieval_mode: Optional[str] = None,
+        query_embedding: Optional[List[float]] = None
+    ) -> Dict[str, Any]:
+        """Search the subject's collection. Returns either a final `answer` or the retrieved chunks.
+
+        `retrieval_mode` is `vector`, `keyword` (BM25) or `hybrid`, which over-fetches from
+        both and merges the rankings by reciprocal rank fusion. Each chunk gets a score
+        (negated vector distance in `vector` mode, the fused rank score otherwise).
+        """
+        retrieval_mode = retrieval_mode or self.retrieval_mode
+        try:
+            collection = self.vector_client.get_collection(name=self._get_collection_name(subject_id))
         except:
             logger.warning(f"No collection found for subject {subject_id}")
             return {"answer": "No documents found for this subject.Please upload documents first", "sources": []}
 
-        # Generate query embedding
-        query_embedding = self.embedding_model.encode([query_text]).tolist()
+        depth = n_results if retrieval_mode == "vector" else max(n_results * 4, 20)
+        rankings = []
+        chunks: Dict[str, tuple] = {}
+        distances: Dict[str, float] = {}
 
-        # Query vector DB
-        results = collection.query(
-            query_embeddings=query_embedding,
-            n_results=n_results
-        )
+        if retrieval_mode in ("vector", "hybrid"):
+            # Generate query embedding
+            if query_embedding is None:
+                query_embedding = self._embed_query(query_text)
+
+            # Query vector DB
+            with timed("vector_search"):
+                results = collection.query(
+                    query_embeddings=[query_embedding],
+                    n_results=depth
+                )
+            rankings.append(results['ids'][0])
+            for chunk_id, doc, metadata, distance in zip(
+                results['ids'][0], results['documents'][0], results['metadatas'][0], results['distances'][0]
+            ):
+                chunks[chunk_id] = (doc, metadata)
+                distances[chunk_id] = distance
+
+        if retrieval_mode in ("keyword", "hybrid"):
+            with timed("keyword_search"):
+                keyword_hits = [chunk_id for chunk_id, _ in self._keyword_index(subject_id).search(query_text, depth)]
+            rankings.append(keyword_hits)
+
+        if retrieval_mode == "vector":
+            scores = {chunk_id: -distances[chunk_id] for chunk_id in rankings[0]}
+        else:
+            scores = rrf_scores(rankings, self.rrf_k)
+        ranked_ids = sorted(scores, key=scores.get, reverse=True)[:n_results]
+        missing = [chunk_id for chunk_id in ranked_ids if chunk_id not in chunks]
+        if missing:
+            with timed("fetch_chunks"):
+                fetched = collection.get(ids=missing, include=["documents", "metadatas"])
+            for chunk_id, doc, metadata in zip(fetched['ids'], fetched['documents'], fetched['metadatas']):
+                chunks[chunk_id] = (doc, metadata)
+        ranked_ids = [chunk_id for chunk_id in ranked_ids if chunk_id in chunks]
+        CHUNKS_RETRIEVED.observe(len(ranked_ids))
 
-        if not results['documents'][0]:
+        if not ranked_ids:
             logger.info(f"No matching documents found for query: {query_text}")
             return {"answer": "No information found in the subject documents.", "sources": []}
 
-        retrieved_docs = results['documents'][0]
-        sources = [m.get('filename', 'unknown') for m in results['metadatas'][0]]
+        return {
+            "ids": ranked_ids,
+            "documents": [chunks[chunk_id][0] for chunk_id in ranked_ids],
+            "metadatas": [chunks[chunk_id][1] for chunk_id in ranked_ids],
+            "scores": [scores[chunk_id] for chunk_id in ranked_ids]
+        }
+
+    def _retrieve_many(
+        self,
+        subject_ids: List[int],
+        query_text: str,
+        n_results: int,
+        retrieval_mode: Optional[str] = None
+    ) -> Tuple[Dict[str, Any], Dict[int, int]]:
+        """Search several subjects concurrently with one query embedding and merge the hits by score.
+
+        Each subject contributes up to `n_results` chunks. Vector scores are distances in
+        the same embedding space, so they compare directly across subjects; fused scores
+        are rank-based, so in `keyword` and `hybrid` modes subjects interleave by rank.
+        Returns the merged chunks (best first) and the number of hits per subject.
+        """
+        retrieval_mode = retrieval_mode or self.retrieval_mode
+        query_embedding = self._embed_query(query_text) if retrieval_mode in ("vector", "hybrid") else None
+
+        futures = {
+            subject_id: self._search_pool.submit(
+                contextvars.copy_context().run,
+                self._retrieve, subject_id, query_text, n_results, retrieval_mode, query_embedding
+            )
+            for subject_id in subject_ids
+        }
+
+        hits = []
+        hit_counts: Dict[int, int] = {}
+        for subject_id, future in futures.items():
+            retrieved = future.result()
+            if "answer" in retrieved:
+                hit_counts[subject_id] = 0
+                continue
+            hit_counts[subject_id] = len(retrieved["ids"])
+            for chunk_id, doc, metadata, score in zip(
+                retrieved["ids"], retrieved["documents"], retrieved["metadatas"], retrieved["scores"]
+            ):
+                hits.append((score, chunk_id, doc, dict(metadata, subject_id=subject_id)))
+
+        hits.sort(key=lambda hit: hit[0], reverse=True)
+        return {
+            "ids": [hit[1] for hit in hits],
+            "documents": [hit[2] for hit in hits],
+            "metadatas": [hit[3] for hit in hits]
+        }, hit_counts
+
+    def _contextualize(
+        self, session_id: Optional[str], subject_key: Any, query_text: str, retrieval_key: Any = None
+    ) -> Dict[str, Any]:
+        """Resolve a question against its chat session before retrieval.
+
+        A follow-up ("and for contractors?") is rewritten into a standalone question, and
+        the session's bounded history is prepared for the prompt. If the previous turn was
+        about the same subject, with the same retrieval settings (`retrieval_key`), and its
+        query embedding is within `reuse_similarity` of this one, its chunk ids are reused
+        instead of searching again.
+        """
+        session = {
+            "conversation": None, "question": query_text, "history": "", "query_embedding": None, "reuse_ids": None,
+            "retrieval_key": retrieval_key
+        }
+        if not session_id:
+            return session
+
+        conversation = self.conversations.get(session_id)
+        previous = conversation.last_turn()
+        session["conversation"] = conversation
+        if previous is None:
+            session["query_embedding"] = self._embed_query(query_text)
+            session["anchor_embedding"] = session["query_embedding"]
+            return session
+
+        if self.rewrite_mode != "off" and is_follow_up(query_text):
+            with timed("query_rewrite"):
+                session["question"] = self._rewrite_question(query_text, conversation, previous)
+            logger.info(f"Rewrote follow-up {query_text!r} as {session['question']!r}")
+        session["history"] = conversation.history(self.history_tokens)
+        session["query_embedding"] = self._embed_query(session["question"])
+        session["anchor_embedding"] = session["query_embedding"]
+
+        if (
+            previous.subject_key == subject_key
+            and previous.retrieval_key == retrieval_key
+            and previous.chunk_ids
+            and previous.embedding is not None
+        ):
+            similarity = cosine_similarity(previous.embedding, np.asarray(session["query_embedding"], dtype=np.float32))
+            if similarity >= self.reuse_similarity:
+                session["reuse_ids"] = list(previous.chunk_ids)
+                # Compare later turns with the query that actually retrieved these chunks, so reuse cannot drift.
+                session["anchor_embedding"] = previous.embedding
+        return session
+
+    def _retrieval_key(
+        self, n_results: int, retrieval_mode: Optional[str], rerank: Optional[bool], rerank_depth: Optional[int]
+    ) -> Tuple[Any, ...]:
+        """The settings that decide which chunks a query retrieves; a turn's chunks are only reused under the same ones."""
+        rerank = self.reranker.enabled if rerank is None else rerank
+        return (n_results, retrieval_mode or self.retrieval_mode, rerank, (rerank_depth or self.reranker.depth) if rerank else None)
+
+    def _rewrite_question(self, question: str, conversation: Conversation, previous: Turn) -> str:
+        """Standalone version of a follow-up question: asked of the LLM, or the previous question plus the follow-up.
 
+        The LLM call takes a slot in `llm_lane` like any other; when the lane sheds it, the
+        heuristic rewrite is used instead.
+        """
+        if self.rewrite_mode == "llm" and self.client:
+            messages = [
+                {
+                    "role": "system",
+                    "content": "Rewrite the user's follow-up question as one standalone question that can be understood "
+                               "without the conversation. Keep the user's wording where possible. Output only the question."
+                },
+                {
+                    "role": "user",
+                    "content": f"Conversation:\n{conversation.history(self.history_tokens)}\n\nFollow-up question: {question}"
+                }
+            ]
+            try:
+                with self.llm_lane.admit():
+                    completion = self.client.chat.completions.create(
+                        messages=messages, model=self.model, temperature=0, max_tokens=96
+                    )
+                lines = (completion.choices[0].message.content or "").strip().splitlines()
+                rewritten = lines[0].strip().strip('"') if lines else ""
+                if rewritten:
+                    QUERY_REWRITES.labels(method="llm").inc()
+                    return rewritten
+            except (LLMError, Overloaded) as e:
+                logger.warning(f"Query rewrite failed, falling back to heuristic rewrite: {str(e)}")
+        QUERY_REWRITES.labels(method="heuristic").inc()
+        return f"{previous.standalone_question.rstrip('?.! ')} {question.strip()}"
+
+    def _fetch_chunks(self, subject_id: int, chunk_ids: List[str]) -> Optional[Dict[str, Any]]:
+        """Load chunks by id, in order; None if any of them is gone (the documents changed since)."""
+        try:
+            collection = self.vector_client.get_collection(name=self._get_collection_name(subject_id))
+        except:
+            return None
+        with timed("fetch_chunks"):
+            fetched = collection.get(ids=chunk_ids, include=["documents", "metadatas"])
+        chunks = {
+            chunk_id: (doc, metadata)
+            for chunk_id, doc, metadata in zip(fetched['ids'], fetched['documents'], fetched['metadatas'])
+        }
+        if len(chunks) < len(chunk_ids):
+            return None
+        return {
+            "ids": chunk_ids,
+            "documents": [chunks[chunk_id][0] for chunk_id in chunk_ids],
+            "metadatas": [chunks[chunk_id][1] for chunk_id in chunk_ids]
+        }
+
+    def _remember(self, session: Dict[str, Any], question: str, answer: str, subject_key: Any, chunk_ids: List[str]):
+        if session["conversation"] is not None:
+            self.conversations.record(
+                session["conversation"], question, session["question"], answer, subject_key,
+                chunk_ids, session.get("anchor_embedding"), session.get("retrieval_key")
+            )
+
+    @staticmethod
+    def _session_fields(session: Dict[str, Any]) -> Dict[str, Any]:
+        if session["conversation"] is None:
+            return {}
+        return {"session_id": session["conversation"].session_id, "standalone_question": session["question"]}
+
+    @staticmethod
+    def _build_messages(retrieved_docs: List[str], query_text: str, history: str = "") -> List[Dict[str, str]]:
         # Construct Prompt
         context = "\n\n".join(retrieved_docs)
+        history_block = (
+            f"Conversation so far (use it only to understand the Question):\n{history}\n\n        "
+            if history else ""
+        )
         
         system_prompt = "You are a precise assistant. You answer questions based ONLY on the provided context."
         user_prompt = f"""Context:
         {context}
         
-        Question: {query_text}
+        {history_block}Question: {query_text}
         
         Instructions:
         1. **Greeting Check**: If the user's input is primarily a greeting (e.g., "Hi", "Hello", "Good morning"), respond with a polite greeting and ask how you can help. Do NOT greet if the user asks a specific question.
@@ -88,33 +791,374 @@ class RAGService:
         3. **Answering**: If the answer IS in the Context, provide the answer detaily and directly. Do NOT start with "Hello" or "Based on the documents".
         4. **Strictness**: Do not use outside knowledge. Do not hallucinate."""
 
+        return [
+            {
+                "role": "system",
+                "content": system_prompt
+            },
+            {
+                "role": "user",
+                "content": user_prompt
+            }
+        ]
+
+    @staticmethod
+    def _answer_cache_key(subject_id: Any, chunk_ids: List[str], messages: List[Dict[str, str]]) -> tuple:
+        prompt = "\n".join(message["content"] for message in messages)
+        return (subject_id, tuple(chunk_ids), hashlib.sha256(prompt.encode("utf-8")).hexdigest())
+
+    def _prepare(
+        self,
+        subject_id: int,
+        query_text: str,
+        n_results: int,
+        retrieval_mode: Optional[str],
+        token_budget: Optional[int],
+        session: Optional[Dict[str, Any]] = None,
+        rerank: Optional[bool] = None,
+        rerank_depth: Optional[int] = None
+    ) -> Dict[str, Any]:
+        """Retrieve and pack context. Returns either a final `answer` or the prompt `messages` with sources, cache key, usage and timings.
+
+        With `rerank`, `rerank_depth` candidates are retrieved and the cross-encoder keeps
+        the best `n_results`.
+        """
+        session = session or {}
+        rerank = self.reranker.enabled if rerank is None else rerank
+        timings: Dict[str, float] = {}
+        retrieved = self._fetch_chunks(subject_id, session["reuse_ids"]) if session.get("reuse_ids") else None
+        reused = retrieved is not None
+        if reused:
+            RETRIEVAL_REUSED.inc()
+            logger.info(f"Reusing {len(retrieved['ids'])} chunks from the previous turn for subject {subject_id}")
+        else:
+            depth = max(rerank_depth or self.reranker.depth, n_results) if rerank else n_results
+            started = time.perf_counter()
+            retrieved = self._retrieve(subject_id, query_text, depth, retrieval_mode, session.get("query_embedding"))
+            timings["retrieval_ms"] = round((time.perf_counter() - started) * 1000, 2)
+            if "answer" in retrieved:
+                return retrieved
+            if rerank:
+                started = time.perf_counter()
+                retrieved = self.reranker.rerank(
+                    (subject_id, self._normalize_query(query_text)), query_text, retrieved, n_results
+                )
+                timings["rerank_ms"] = round((time.perf_counter() - started) * 1000, 2)
+
+        with timed("context_packing"):
+            context = self.context_builder.build(
+                retrieved['ids'], retrieved['documents'], retrieved['metadatas'], token_budget
+            )
+        messages = self._build_messages(context['documents'], query_text, session.get("history", ""))
+        usage = {
+            "retrieved_chunks": context['retrieved_chunks'],
+            "context_segments": context['segments'],
+            "context_tokens": context['context_tokens'],
+            "prompt_tokens": sum(self.context_builder.count_tokens(message["content"]) for message in messages),
+        }
+        if session.get("conversation") is not None:
+            usage["history_tokens"] = self.context_builder.count_tokens(session["history"])
+            usage["reused_chunks"] = len(retrieved['ids']) if reused else 0
+        if "rerank_candidates" in retrieved:
+            usage["rerank_candidates"] = retrieved["rerank_candidates"]
+            usage["rerank_cached"] = retrieved["rerank_cached"]
+        return {
+            "chunk_ids": retrieved['ids'],
+            "sources": list(set(m.get('filename', 'unknown') for m in context['metadatas'])),
+            "messages": messages,
+            "cache_key": self._answer_cache_key(subject_id, context['ids'], messages),
+            "usage": usage,
+            "timings": timings,
+        }
+
+    @staticmethod
+    def _record_llm_usage(usage: Dict[str, int]):
+        LLM_TOKENS.labels(direction="in").inc(usage.get("prompt_tokens", 0))
+        LLM_TOKENS.labels(direction="out").inc(usage.get("completion_tokens", 0))
+
+    def query(
+        self,
+        subject_id: int,
+        query_text: str,
+        n_results: int = 5,
+        retrieval_mode: Optional[str] = None,
+        token_budget: Optional[int] = None,
+        session_id: Optional[str] = None,
+        rerank: Optional[bool] = None,
+        rerank_depth: Optional[int] = None
+    ) -> Dict[str, Any]:
+        """Query the subject's documents and generate a response.
+
+        With a `session_id`, the question is resolved against that chat session (see
+        `_contextualize`) and the turn is added to it. `rerank` and `rerank_depth`
+        override the re-ranking defaults; `timings` reports the time spent per step, and
+        `chunk_ids` the retrieved chunks in rank order.
+        """
+        session = self._contextualize(
+            session_id, subject_id, query_text, self._retrieval_key(n_results, retrieval_mode, rerank, rerank_depth)
+        )
+        prepared = self._prepare(
+            subject_id, session["question"], n_results, retrieval_mode, token_budget, session, rerank, rerank_depth
+        )
+        if "answer" in prepared:
+            self._remember(session, query_text, prepared["answer"], subject_id, [])
+            return dict(prepared, **self._session_fields(session))
+
+        started = time.perf_counter()
+        answer, cached = self._generate(prepared, f"subject {subject_id}")
+        prepared["timings"]["generation_ms"] = round((time.perf_counter() - started) * 1000, 2)
+        self._remember(session, query_text, answer, subject_id, prepared["chunk_ids"])
+        return {
+            "answer": answer,
+            "sources": prepared["sources"],
+            "chunk_ids": prepared["chunk_ids"],
+            "cached": cached,
+            "usage": prepared["usage"],
+            "timings": prepared["timings"],
+            **self._session_fields(session)
+        }
+
+    def _generate(self, prepared: Dict[str, Any], label: str) -> Tuple[str, bool]:
+        """Answer prepared `messages` with one LLM call (or from the answer cache). Returns the answer and whether it was cached."""
+        usage = prepared["usage"]
+        cached_answer = self.answer_cache.get(prepared["cache_key"])
+        if cached_answer is not None:
+            logger.info(f"Answer cache hit for {label}")
+            ADMISSION_CACHE_SERVED.inc()
+            return cached_answer, True
+
         if self.client:
             try:
-                logger.info("Generating response from Groq")
-                chat_completion = self.client.chat.completions.create(
-                    messages=[
-                        {
-                            "role": "system",
-                            "content": system_prompt
-                        },
-                        {
-                            "role": "user",
-                            "content": user_prompt
-                        }
-                    ],
-                    model=self.model,
-                    temperature=0.7,
-                    max_tokens=1024,
-                )
+                logger.info(f"Generating response from Groq (~{usage['prompt_tokens']} prompt tokens)")
+                with self.llm_lane.admit(), timed("llm"):
+                    chat_completion = self.client.chat.completions.create(
+                        messages=prepared["messages"],
+                        model=self.model,
+                        temperature=0.7,
+                        max_tokens=1024,
+                    )
                 answer = chat_completion.choices[0].message.content
+                if getattr(chat_completion, "usage", None):
+                    usage["prompt_tokens"] = chat_completion.usage.prompt_tokens
+                    usage["completion_tokens"] = chat_completion.usage.completion_tokens
+                else:
+                    usage["completion_tokens"] = self.context_builder.count_tokens(answer)
+                self._record_llm_usage(usage)
                 logger.info("Generated response from Groq")
-            except Exception as e:
+                self.answer_cache.set(prepared["cache_key"], answer)
+            except LLMError as e:
+                LLM_ERRORS.inc()
                 logger.error(f"Error generating response from LLM: {str(e)}")
-                answer = f"Error generating response from LLM: {str(e)}"
+                raise
         else:
             answer = "LLM not configured. Please set GROQ_API_KEY."
+        return answer, False
+
+    def query_multi(
+        self,
+        subjects: Dict[int, str],
+        query_text: str,
+        n_results: int = 5,
+        retrieval_mode: Optional[str] = None,
+        token_budget: Optional[int] = None,
+        session_id: Optional[str] = None,
+        rerank: Optional[bool] = None,
+        rerank_depth: Optional[int] = None
+    ) -> Dict[str, Any]:
+        """Answer one question from several subjects (`{subject_id: name}`) with a single LLM call.
+
+        The question is embedded once, the subject collections are searched concurrently,
+        and the merged chunks are packed into one context in which every passage is
+        labelled with its subject and file. `subject_sources` attributes the files used to
+        each subject. Follow-ups in a chat session are rewritten as for `query`; retrieval
+        is not reused across multi-subject turns. With re-ranking, each subject contributes
+        `rerank_depth` candidates and the cross-encoder, whose scores compare across
+        subjects, keeps the best `n_results` per subject queried.
+        """
+        subject_ids = list(subjects)
+        subject_key = tuple(sorted(subject_ids))
+        session = self._contextualize(
+            session_id, subject_key, query_text, self._retrieval_key(n_results, retrieval_mode, rerank, rerank_depth)
+        )
+        question = session["question"]
+        rerank = self.reranker.enabled if rerank is None else rerank
+        depth = max(rerank_depth or self.reranker.depth, n_results) if rerank else n_results
+        timings: Dict[str, float] = {}
+        started = time.perf_counter()
+        retrieved, hit_counts = self._retrieve_many(subject_ids, question, depth, retrieval_mode)
+        timings["retrieval_ms"] = round((time.perf_counter() - started) * 1000, 2)
+        if rerank and retrieved["ids"]:
+            started = time.perf_counter()
+            retrieved = self.reranker.rerank(
+                (subject_key, self._normalize_query(question)), question, retrieved, n_results * len(subject_ids)
+            )
+            timings["rerank_ms"] = round((time.perf_counter() - started) * 1000, 2)
+            hit_counts = {subject_id: 0 for subject_id in subject_ids}
+            for metadata in retrieved["metadatas"]:
+                hit_counts[metadata["subject_id"]] += 1
+        if not retrieved["ids"]:
+            logger.info(f"No matching documents found in subjects {subject_ids} for query: {question}")
+            answer = "No information found in the subject documents."
+            self._remember(session, query_text, answer, subject_key, [])
+            return {
+                "answer": answer,
+                "sources": [],
+                "subject_sources": [],
+                **self._session_fields(session)
+            }
+
+        with timed("context_packing"):
+            context = self.context_builder.build(
+                retrieved['ids'], retrieved['documents'], retrieved['metadatas'], token_budget
+            )
+        labelled = [
+            f"[Subject: {subjects[m['subject_id']]} | Source: {m.get('filename', 'unknown')}]\n{doc}"
+            for doc, m in zip(context['documents'], context['metadatas'])
+        ]
+        messages = self._build_messages(labelled, question, session["history"])
+
+        subject_files: Dict[int, List[str]] = {subject_id: [] for subject_id in subject_ids}
+        for m in context['metadatas']:
+            filename = m.get('filename', 'unknown')
+            if filename not in subject_files[m['subject_id']]:
+                subject_files[m['subject_id']].append(filename)
+        subject_sources = [
+            {
+                "subject_id": subject_id,
+                "subject_name": subjects[subject_id],
+                "sources": subject_files[subject_id],
+                "retrieved_chunks": hit_counts.get(subject_id, 0)
+            }
+            for subject_id in subject_ids
+        ]
 
+        prepared = {
+            "messages": messages,
+            "cache_key": self._answer_cache_key(subject_key, context['ids'], messages),
+            "usage": {
+                "subjects": len(subject_ids),
+                "retrieved_chunks": context['retrieved_chunks'],
+                "context_segments": context['segments'],
+                "context_tokens": context['context_tokens'],
+                "prompt_tokens": sum(self.context_builder.count_tokens(message["content"]) for message in messages),
+            },
+        }
+        if session["conversation"] is not None:
+            prepared["usage"]["history_tokens"] = self.context_builder.count_tokens(session["history"])
+        if "rerank_candidates" in retrieved:
+            prepared["usage"]["rerank_candidates"] = retrieved["rerank_candidates"]
+            prepared["usage"]["rerank_cached"] = retrieved["rerank_cached"]
+        started = time.perf_counter()
+        answer, cached = self._generate(prepared, f"subjects {subject_ids}")
+        timings["generation_ms"] = round((time.perf_counter() - started) * 1000, 2)
+        self._remember(session, query_text, answer, subject_key, [])
         return {
             "answer": answer,
-            "sources": list(set(sources))
+            "sources": sorted({filename for files in subject_files.values() for filename in files}),
+            "subject_sources": subject_sources,
+            "cached": cached,
+            "usage": prepared["usage"],
+            "timings": timings,
+            **self._session_fields(session)
         }
+
+    def query_stream(
+        self,
+        subject_id: int,
+        query_text: str,
+        n_results: int = 5,
+        retrieval_mode: Optional[str] = None,
+        token_budget: Optional[int] = None,
+        session_id: Optional[str] = None,
+        rerank: Optional[bool] = None,
+        rerank_depth: Optional[int] = None
+    ) -> Iterator[Dict[str, Any]]:
+        """Like `query`, but yields a `sources` event, then `token` events as the LLM produces them, then `done`.
+
+        In a chat session the `sources` event also carries the `session_id` and the
+        `standalone_question`, and the turn is recorded once the answer is complete. The
+        retrieval and re-ranking `timings` are sent with the `sources` event.
+        """
+        session = self._contextualize(
+            session_id, subject_id, query_text, self._retrieval_key(n_results, retrieval_mode, rerank, rerank_depth)
+        )
+        prepared = self._prepare(
+            subject_id, session["question"], n_results, retrieval_mode, token_budget, session, rerank, rerank_depth
+        )
+        parts = []
+        for event in self._stream_answer(subject_id, prepared):
+            if event["type"] == "sources":
+                event.update(self._session_fields(session))
+                if prepared.get("timings"):
+                    event["timings"] = prepared["timings"]
+            elif event["type"] == "token":
+                parts.append(event["content"])
+            elif event["type"] == "done":
+                self._remember(session, query_text, "".join(parts), subject_id, prepared.get("chunk_ids", []))
+            yield event
+
+    def _stream_answer(self, subject_id: int, prepared: Dict[str, Any]) -> Iterator[Dict[str, Any]]:
+        if "answer" in prepared:
+            yield {"type": "sources", "sources": prepared["sources"]}
+            yield {"type": "token", "content": prepared["answer"]}
+            yield {"type": "done", "cached": False}
+            return
+
+        usage = prepared["usage"]
+        yield {"type": "sources", "sources": prepared["sources"]}
+
+        cached_answer = self.answer_cache.get(prepared["cache_key"])
+        if cached_answer is not None:
+            logger.info(f"Answer cache hit for subject {subject_id}")
+            ADMISSION_CACHE_SERVED.inc()
+            yield {"type": "token", "content": cached_answer}
+            yield {"type": "done", "cached": True, "usage": usage}
+            return
+
+        if not self.client:
+            yield {"type": "token", "content": "LLM not configured. Please set GROQ_API_KEY."}
+            yield {"type": "done", "cached": False, "usage": usage}
+            return
+
+        try:
+            acquired_at = self.llm_lane.acquire()
+        except Overloaded as e:
+            yield {"type": "error", "detail": str(e), "retry_after": e.retry_after}
+            return
+
+        parts = []
+        started = time.perf_counter()
+        try:
+            logger.info(f"Streaming response from Groq (~{usage['prompt_tokens']} prompt tokens)")
+            stream = self.client.chat.completions.create(
+                messages=prepared["messages"],
+                model=self.model,
+                temperature=0.7,
+                max_tokens=1024,
+                stream=True,
+            )
+            for chunk in stream:
+                token = chunk.choices[0].delta.content if chunk.choices else None
+                if token:
+                    if not parts:
+                        LLM_TIME_TO_FIRST_TOKEN.observe(time.perf_counter() - started)
+                    parts.append(token)
+                    yield {"type": "token", "content": token}
+        except Exception as e:
+            LLM_ERRORS.inc()
+            logger.error(f"Error streaming response from LLM: {str(e)}")
+            event = {"type": "error", "detail": f"Error generating response from LLM: {str(e)}"}
+            if getattr(e, "retry_after", None) is not None:
+                event["retry_after"] = e.retry_after
+            yield event
+            return
+        finally:
+            self.llm_lane.release(acquired_at)
+
+        record_span("llm", time.perf_counter() - started)
+        answer = "".join(parts)
+        usage["completion_tokens"] = self.context_builder.count_tokens(answer)
+        self._record_llm_usage(usage)
+        logger.info("Streamed response from Groq")
+        self.answer_cache.set(prepared["cache_key"], answer)
+        yield {"type": "done", "cached": False, "usage": usage}
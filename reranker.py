@@ -0,0 +1,94 @@
+import os
+import threading
+import time
+from typing import Any, Dict, Hashable, List, Optional, Tuple
+
+from cache import LRUCache
+from logger_config import setup_logger
+from metrics import timed
+
+logger = setup_logger(__name__)
+
+
+class Reranker:
+    """Re-orders retrieved chunks by cross-encoder relevance to the question.
+
+    The first-stage search over-fetches `depth` candidates; the cross-encoder scores
+    each (question, chunk) pair in batches of `batch_size` and the best `k` are kept.
+    Scores are cached per (subject, normalized question) and chunk id, so a repeated
+    question only scores candidates it has not seen before. The model is loaded on first
+    use (or by `warm_up`).
+    """
+
+    def __init__(
+        self,
+        model_name: Optional[str] = None,
+        enabled: Optional[bool] = None,
+        depth: Optional[int] = None,
+        batch_size: Optional[int] = None,
+        cache_size: Optional[int] = None
+    ):
+        self.model_name = model_name or os.getenv("RERANK_MODEL", "cross-encoder/ms-marco-MiniLM-L-6-v2")
+        self.enabled = os.getenv("RERANK_ENABLED", "false").lower() == "true" if enabled is None else enabled
+        self.depth = depth or int(os.getenv("RERANK_DEPTH", "50"))
+        self.batch_size = batch_size or int(os.getenv("RERANK_BATCH_SIZE", "32"))
+        self.cache = LRUCache(
+            maxsize=int(os.getenv("RERANK_CACHE_SIZE", "1024")) if cache_size is None else cache_size,
+            ttl=float(os.getenv("ANSWER_CACHE_TTL", "3600"))
+        )
+        self._model = None
+        self._lock = threading.Lock()
+
+    @property
+    def model(self):
+        if self._model is None:
+            with self._lock:
+                if self._model is None:
+                    # Imported here: importing sentence_transformers (and torch) alone takes seconds.
+                    from sentence_transformers import CrossEncoder
+
+                    started = time.perf_counter()
+                    self._model = CrossEncoder(self.model_name)
+                    logger.info(f"Loaded re-ranking model {self.model_name} in {time.perf_counter() - started:.2f}s")
+        return self._model
+
+    @property
+    def ready(self) -> bool:
+        return self._model is not None
+
+    def warm_up(self):
+        self.model.predict([("warm up", "warm up")], batch_size=1)
+
+    def scores(self, cache_key: Hashable, query_text: str, ids: List[str], documents: List[str]) -> Tuple[List[float], int]:
+        """Cross-encoder score of each candidate; returns the scores and how many came from the cache."""
+        cached: Dict[str, float] = self.cache.get(cache_key) or {}
+        missing = [i for i, chunk_id in enumerate(ids) if chunk_id not in cached]
+        if missing:
+            with timed("rerank"):
+                predicted = self.model.predict(
+                    [(query_text, documents[i]) for i in missing], batch_size=self.batch_size
+                )
+            cached = dict(cached)
+            for i, score in zip(missing, predicted):
+                cached[ids[i]] = float(score)
+            self.cache.set(cache_key, cached)
+        return [cached[chunk_id] for chunk_id in ids], len(ids) - len(missing)
+
+    def rerank(self, cache_key: Hashable, query_text: str, retrieved: Dict[str, Any], k: int) -> Dict[str, Any]:
+        """The best `k` of the `retrieved` chunks (ids, documents, metadatas) by cross-encoder score.
+
+        The result has the same keys, `scores` replaced by the cross-encoder scores, plus
+        `rerank_candidates` and `rerank_cached` counts.
+        """
+        scores, cached = self.scores(cache_key, query_text, retrieved["ids"], retrieved["documents"])
+        order = sorted(range(len(scores)), key=scores.__getitem__, reverse=True)[:k]
+        reranked = {key: [retrieved[key][i] for i in order] for key in ("ids", "documents", "metadatas")}
+        reranked["scores"] = [scores[i] for i in order]
+        reranked["rerank_candidates"] = len(scores)
+        reranked["rerank_cached"] = cached
+        return reranked
+
+    def invalidate(self, subject_id: int) -> int:
+        return self.cache.invalidate(
+            lambda key: key[0] == subject_id or (isinstance(key[0], tuple) and subject_id in key[0])
+        )
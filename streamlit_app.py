@@ -1,6 +1,9 @@
 import streamlit as st
 import requests
 import os
+import time
+import json
+import uuid
 from logger_config import setup_logger
 
 logger = setup_logger("streamlit_app")
@@ -57,6 +60,9 @@ if response.status_code == 200:
             # Initialize chat history
             if "messages" not in st.session_state:
                 st.session_state.messages = []
+            # The API keeps the conversation under this id to resolve follow-up questions
+            if "session_id" not in st.session_state:
+                st.session_state.session_id = str(uuid.uuid4())
             
             # Display chat messages
             for message in st.session_state.messages:
@@ -71,28 +77,51 @@ if response.status_code == 200:
                     st.markdown(prompt)
 
                 with st.chat_message("assistant"):
-                    with st.spinner("Thinking..."):
-                        response = requests.post(
-                            f"{API_URL}/subjects/{subject_id}/chat",
-                            json={"question": prompt}
-                        )
-                        
-                        if response.status_code == 200:
-                            data = response.json()
-                            answer = data['answer']
-                            sources = data.get('sources', [])
-                            
-                            st.markdown(answer)
-                            if sources:
-                                st.caption(f"Sources: {', '.join(sources)}")
-                            
-                            st.session_state.messages.append({"role": "assistant", "content": answer})
-                            st.rerun()
-                        else:
-                            error_msg = "Error getting response."
-                            logger.error(f"Chat error: {response.status_code}")
-                            st.error(error_msg)
-                            st.session_state.messages.append({"role": "assistant", "content": error_msg})
+                    placeholder = st.empty()
+                    placeholder.markdown("Thinking...")
+                    answer = ""
+                    sources = []
+                    error_msg = None
+                    try:
+                        with requests.post(
+                            f"{API_URL}/subjects/{subject_id}/chat/stream",
+                            json={"question": prompt, "session_id": st.session_state.session_id},
+                            headers={"X-Client-ID": st.session_state.session_id},
+                            stream=True
+                        ) as response:
+                            if response.status_code in (429, 503):
+                                error_msg = f"The assistant is busy, please retry in {response.headers.get('Retry-After', 'a few')} seconds."
+                                logger.warning(f"Chat throttled: {response.status_code}")
+                            elif response.status_code != 200:
+                                error_msg = "Error getting response."
+                                logger.error(f"Chat error: {response.status_code}")
+                            else:
+                                for line in response.iter_lines(decode_unicode=True):
+                                    if not line or not line.startswith("data: "):
+                                        continue
+                                    event = json.loads(line[len("data: "):])
+                                    if event["type"] == "sources":
+                                        sources = event["sources"]
+                                    elif event["type"] == "token":
+                                        answer += event["content"]
+                                        placeholder.markdown(answer + "▌")
+                                    elif event["type"] == "error":
+                                        error_msg = event["detail"]
+                                        logger.error(f"Chat error: {error_msg}")
+                    except requests.RequestException as e:
+                        error_msg = "Error getting response."
+                        logger.error(f"Chat error: {str(e)}")
+
+                    if error_msg:
+                        placeholder.empty()
+                        st.error(error_msg)
+                        st.session_state.messages.append({"role": "assistant", "content": error_msg})
+                    else:
+                        placeholder.markdown(answer)
+                        if sources:
+                            st.caption(f"Sources: {', '.join(sources)}")
+                        st.session_state.messages.append({"role": "assistant", "content": answer})
+                        st.rerun()
 
         with tab2:
             st.header("Upload Documents")
@@ -108,8 +137,24 @@ if response.status_code == 200:
                             files=files
                         )
                         
-                        if response.status_code == 200:
-                            st.success("Document uploaded successfully!")
+                        if response.status_code == 202:
+                            job_id = response.json()["job_id"]
+                            progress = st.progress(0.0, text="Queued")
+                            while True:
+                                job = requests.get(f"{API_URL}/jobs/{job_id}").json()
+                                progress.progress(job["progress"], text=job["stage"].capitalize())
+                                if job["status"] in ("completed", "failed"):
+                                    break
+                                time.sleep(1)
+
+                            if job["status"] == "completed":
+                                st.success(f"Document processed successfully in {job['duration_seconds']:.1f}s!")
+                            else:
+                                logger.error(f"Ingestion failed: {job['error']}")
+                                st.error(f"Processing failed: {job['error']}")
+                        elif response.status_code == 200 and response.json().get("status") == "skipped":
+                            logger.info(f"Upload skipped, content already ingested: {uploaded_file.name}")
+                            st.info("This document is already ingested with the same content; skipped.")
                         else:
                             logger.error(f"Upload failed: {response.text}")
                             st.error(f"Upload failed: {response.text}")
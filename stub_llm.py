@@ -0,0 +1,181 @@
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from types import SimpleNamespace
+from typing import Any, Dict, List, Optional
+
+
+class _Completions:
+    def __init__(self, owner: "StubLLMClient"):
+        self._owner = owner
+
+    def create(self, messages: List[Dict[str, str]], model: str = "stub", stream: bool = False, **kwargs: Any):
+        return self._owner._complete(messages, stream)
+
+
+class StubLLMClient:
+    """Offline stand-in for the Groq client used by benchmarks and evaluation runs.
+
+    Mirrors the `client.chat.completions.create(...)` surface (including `stream=True`)
+    with a fixed first-token latency and a steady token rate, so LLM time is predictable
+    and the rest of the pipeline can be measured in isolation.
+    """
+
+    def __init__(
+        self,
+        answer: Optional[str] = None,
+        first_token_latency: float = 0.0,
+        tokens_per_second: Optional[float] = None,
+        chars_per_token: float = 4.0
+    ):
+        self.answer = answer or "This is a stubbed answer generated from the provided context."
+        self.first_token_latency = first_token_latency
+        self.tokens_per_second = tokens_per_second
+        self.chars_per_token = chars_per_token
+        self.calls = 0
+        self.chat = SimpleNamespace(completions=_Completions(self))
+
+    def _tokens(self) -> List[str]:
+        return [word + " " for word in self.answer.split()]
+
+    def _usage(self, messages: List[Dict[str, str]]) -> SimpleNamespace:
+        prompt_chars = sum(len(message["content"]) for message in messages)
+        return SimpleNamespace(
+            prompt_tokens=int(prompt_chars / self.chars_per_token),
+            completion_tokens=len(self._tokens())
+        )
+
+    def _complete(self, messages: List[Dict[str, str]], stream: bool):
+        self.calls += 1
+        if stream:
+            return self._stream()
+        if self.first_token_latency:
+            time.sleep(self.first_token_latency)
+        if self.tokens_per_second:
+            time.sleep(len(self._tokens()) / self.tokens_per_second)
+        return SimpleNamespace(
+            choices=[SimpleNamespace(message=SimpleNamespace(content=self.answer))],
+            usage=self._usage(messages)
+        )
+
+    def _stream(self):
+        if self.first_token_latency:
+            time.sleep(self.first_token_latency)
+        for token in self._tokens():
+            if self.tokens_per_second:
+                time.sleep(1 / self.tokens_per_second)
+            yield SimpleNamespace(choices=[SimpleNamespace(delta=SimpleNamespace(content=token))])
+
+
+class StubLLMServer:
+    """Local OpenAI-compatible `/chat/completions` endpoint for exercising `LLMGateway` over real HTTP.
+
+    Answers with `client`'s stubbed answer and timing (streaming when the request asks
+    for it). `failures` is a list of HTTP status codes returned, in order, before the
+    server starts answering; `retry_after` is sent as the `Retry-After` header on those.
+    `disconnect_after` cuts streaming responses off after that many tokens, without
+    finishing the body, to simulate a connection dropped mid-answer.
+    `requests` counts every request received. Use as a context manager or call `start()`
+    and `stop()`; `url` is the base URL to pass to the gateway.
+    """
+
+    def __init__(
+        self,
+        client: Optional[StubLLMClient] = None,
+        failures: Optional[List[int]] = None,
+        retry_after: Optional[float] = None,
+        disconnect_after: Optional[int] = None,
+        host: str = "127.0.0.1",
+        port: int = 0
+    ):
+        self.client = client or StubLLMClient()
+        self.failures = list(failures or [])
+        self.retry_after = retry_after
+        self.disconnect_after = disconnect_after
+        self.requests = 0
+        self._lock = threading.Lock()
+        self._server = ThreadingHTTPServer((host, port), self._handler())
+        self._server.daemon_threads = True
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+
+    @property
+    def url(self) -> str:
+        host, port = self._server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def start(self) -> "StubLLMServer":
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def __enter__(self) -> "StubLLMServer":
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def _next_failure(self) -> Optional[int]:
+        with self._lock:
+            self.requests += 1
+            return self.failures.pop(0) if self.failures else None
+
+    def _handler(self):
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, format: str, *args: Any):
+                pass
+
+            def _send_json(self, status: int, body: Dict[str, Any], headers: Optional[Dict[str, str]] = None):
+                data = json.dumps(body).encode("utf-8")
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                for name, value in (headers or {}).items():
+                    self.send_header(name, value)
+                self.end_headers()
+                self.wfile.write(data)
+
+            def do_POST(self):
+                request = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+                failure = stub._next_failure()
+                if failure is not None:
+                    headers = {"Retry-After": str(stub.retry_after)} if stub.retry_after is not None else {}
+                    self._send_json(failure, {"error": {"message": f"stubbed HTTP {failure}"}}, headers)
+                    return
+
+                messages = request.get("messages", [])
+                if not request.get("stream"):
+                    completion = stub.client.chat.completions.create(messages=messages)
+                    self._send_json(200, {
+                        "choices": [{"index": 0, "message": {"role": "assistant", "content": completion.choices[0].message.content}}],
+                        "usage": vars(completion.usage),
+                    })
+                    return
+
+                self.send_response(200)
+                self.send_header("Content-Type", "text/event-stream")
+                self.send_header("Transfer-Encoding", "chunked")
+                self.send_header("Connection", "close")
+                self.end_headers()
+                self.close_connection = True
+                stream = stub.client.chat.completions.create(messages=messages, stream=True)
+                for sent, chunk in enumerate(stream):
+                    if sent == stub.disconnect_after:
+                        return  # drop the connection without the terminating chunk
+                    event = {"choices": [{"index": 0, "delta": {"content": chunk.choices[0].delta.content}}]}
+                    self._write_chunk(f"data: {json.dumps(event)}\n\n".encode("utf-8"))
+                self._write_chunk(b"data: [DONE]\n\n")
+                self.wfile.write(b"0\r\n\r\n")
+
+            def _write_chunk(self, data: bytes):
+                self.wfile.write(f"{len(data):x}\r\n".encode("ascii") + data + b"\r\n")
+                self.wfile.flush()
+
+        return Handler
@@ -1,17 +1,41 @@
 from fastapi.testclient import TestClient
-from app import app
 import os
+import pytest
 import shutil
+import time
+import json
 
-client = TestClient(app)
-
-# Clean up before tests
+# Clean up before tests (must run before the app creates its tables)
 if os.path.exists("chatbot.db"):
     os.remove("chatbot.db")
 if os.path.exists("chroma_db"):
     shutil.rmtree("chroma_db")
 if os.path.exists("uploads"):
     shutil.rmtree("uploads")
+if os.path.exists("keyword_index"):
+    shutil.rmtree("keyword_index")
+if os.path.exists("vector_store"):
+    shutil.rmtree("vector_store")
+
+import app as app_module
+from app import app
+
+client = TestClient(app)
+
+@pytest.fixture(scope="module", autouse=True)
+def app_lifespan():
+    # Runs the lifespan startup (table creation, warm-up) and shutdown around the tests
+    with client:
+        yield
+
+def wait_for_job(job_id, timeout=30):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        job = client.get(f"/jobs/{job_id}").json()
+        if job["status"] in ("completed", "failed"):
+            return job
+        time.sleep(0.1)
+    raise AssertionError(f"Job {job_id} did not finish in {timeout}s")
 
 def test_create_subject():
     response = client.post("/subjects/", json={"name": "Test Subject", "description": "Test Description"})
@@ -28,9 +52,97 @@ def test_upload_document():
     file_content = b"This is a test document content for RAG chatbot."
     files = {"file": ("test.txt", file_content, "text/plain")}
     
+    response = client.post("/subjects/2/documents/", files=files)
+    assert response.status_code == 202
+    data = response.json()
+    assert data["message"] == "Document queued for processing"
+
+    job = wait_for_job(data["job_id"])
+    assert job["status"] == "completed"
+    assert job["document_id"] is not None
+    assert job["chunk_count"] == 1
+    assert "embedding" in job["stage_timings"]
+
+def test_upload_duplicate_is_skipped():
+    files = {"file": ("test.txt", b"This is a test document content for RAG chatbot.", "text/plain")}
     response = client.post("/subjects/2/documents/", files=files)
     assert response.status_code == 200
-    assert response.json()["message"] == "Document uploaded and processed successfully"
+    assert response.json()["status"] == "skipped"
+    assert response.json()["document_id"] is not None
+
+def test_upload_revision_only_embeds_changed_chunks():
+    sections = [" ".join(f"Rule {i} applies to section {name}." for i in range(60)) for name in ("alpha", "beta", "gamma")]
+    first = "\n\n".join(sections)
+    revised = "\n\n".join(sections[:2] + [sections[2].replace("gamma", "delta")])
+    files = {"file": ("policy.txt", first.encode(), "text/plain")}
+    job = wait_for_job(client.post("/subjects/2/documents/", files=files).json()["job_id"])
+    assert job["status"] == "completed"
+    assert job["embedded_count"] == job["chunk_count"]
+
+    files = {"file": ("policy.txt", revised.encode(), "text/plain")}
+    revision = wait_for_job(client.post("/subjects/2/documents/", files=files).json()["job_id"])
+    assert revision["status"] == "completed"
+    assert revision["document_id"] == job["document_id"]
+    assert 0 < revision["embedded_count"] < revision["chunk_count"]
+
+def test_upload_unsupported_format():
+    files = {"file": ("test.docx", b"binary", "application/octet-stream")}
+    response = client.post("/subjects/2/documents/", files=files)
+    assert response.status_code == 400
+
+def test_upload_is_spooled_hashed_and_size_limited(monkeypatch):
+    import hashlib
+    import uploads
+    body = b"Expense claims are filed with form EX-7 within 30 days."
+    response = client.post("/subjects/2/documents/", files={"file": ("../../claims.txt", body, "text/plain")})
+    job = wait_for_job(response.json()["job_id"])
+    assert job["status"] == "completed"
+    document = next(d for d in client.get("/subjects/2/documents/").json() if d["id"] == job["document_id"])
+    # The path is stripped from the client's filename; the hash is computed while spooling
+    assert document["filename"] == "claims.txt"
+    assert document["file_hash"] == hashlib.sha256(body).hexdigest()
+    with open(os.path.join(uploads.UPLOAD_DIR, "2_claims.txt"), "rb") as f:
+        assert f.read() == body
+
+    # Concurrent uploads of one filename each ingest their own spool file
+    bodies = [f"Expense form EX-{n} is due within {n} days. ".encode() * 50 for n in (8, 9)]
+    jobs = [client.post("/subjects/2/documents/", files={"file": ("claims.txt", b, "text/plain")}).json()["job_id"] for b in bodies]
+    assert all(wait_for_job(job_id)["status"] == "completed" for job_id in jobs)
+    with open(os.path.join(uploads.UPLOAD_DIR, "2_claims.txt"), "rb") as f:
+        assert f.read() in bodies
+    assert [d["filename"] for d in client.get("/subjects/2/documents/").json()].count("claims.txt") == 1
+    assert not [name for name in os.listdir(uploads.UPLOAD_DIR) if name.endswith(".part")]
+
+    monkeypatch.setattr(uploads, "MAX_UPLOAD_BYTES", 64)
+    response = client.post("/subjects/2/documents/", files={"file": ("big.txt", b"x" * 1000, "text/plain")})
+    assert response.status_code == 413
+    assert not [name for name in os.listdir(uploads.UPLOAD_DIR) if name.endswith(".part")]
+
+def test_init_db_upgrades_existing_database(tmp_path):
+    from sqlalchemy import create_engine, inspect, text
+    import database
+    import models
+
+    engine = create_engine(f"sqlite:///{tmp_path / 'old.db'}")
+    with engine.begin() as connection:
+        # The documents table as created before file hashes and chunk counts were stored
+        connection.execute(text(
+            "CREATE TABLE documents (id INTEGER PRIMARY KEY, subject_id INTEGER, filename VARCHAR, file_type VARCHAR, uploaded_at DATETIME)"
+        ))
+        connection.execute(text("INSERT INTO documents (subject_id, filename, file_type) VALUES (1, 'old.txt', 'txt')"))
+    for _ in range(2):
+        database.init_db(models.Base.metadata, bind=engine)
+    inspector = inspect(engine)
+    assert {"file_hash", "chunk_count"} <= {column["name"] for column in inspector.get_columns("documents")}
+    assert "ix_documents_subject_hash" in {index["name"] for index in inspector.get_indexes("documents")}
+    assert "document_versions" in inspector.get_table_names()
+    with engine.connect() as connection:
+        assert connection.execute(text("SELECT file_hash, chunk_count FROM documents")).one() == (None, 0)
+    engine.dispose()
+
+def test_job_not_found():
+    response = client.get("/jobs/does-not-exist")
+    assert response.status_code == 404
 
 def test_chat_no_info():
     # Create subject
@@ -47,3 +159,463 @@ def test_list_subjects():
     response = client.get("/subjects/")
     assert response.status_code == 200
     assert len(response.json()) >= 3
+
+def test_query_embedding_cache():
+    before = client.get("/cache/stats").json()["embeddings"]
+    for question in ("What is in the test document?", "  what is IN the test document? "):
+        response = client.post("/subjects/2/chat", json={"question": question})
+        assert response.status_code == 200
+    after = client.get("/cache/stats").json()["embeddings"]
+    assert after["misses"] == before["misses"] + 1
+    assert after["hits"] == before["hits"] + 1
+
+def test_chat_stream():
+    response = client.post("/subjects/2/chat/stream", json={"question": "What is in the test document?"})
+    assert response.status_code == 200
+    assert response.headers["content-type"].startswith("text/event-stream")
+    events = [json.loads(line[len("data: "):]) for line in response.text.splitlines() if line.startswith("data: ")]
+    assert events[0]["type"] == "sources"
+    assert "test.txt" in events[0]["sources"]
+    assert events[-1]["type"] == "done"
+    assert any(event["type"] == "token" for event in events)
+
+def test_embedding_stats():
+    response = client.get("/embeddings/stats")
+    assert response.status_code == 200
+    data = response.json()
+    assert data["batch_size"]["count"] > 0
+    assert data["direct_batch_size"]["count"] > 0  # uploads, kept out of the query batching histogram
+    assert "queue_wait_seconds" in data
+    assert data["pending"] == 0
+
+def test_keyword_retrieval_finds_exact_codes():
+    files = {"file": ("forms.txt", b"Travel claims must be filed on form FIN-2023-04 within 30 days.", "text/plain")}
+    job = wait_for_job(client.post("/subjects/2/documents/", files=files).json()["job_id"])
+    assert job["status"] == "completed"
+
+    response = client.post("/subjects/2/chat", json={"question": "FIN-2023-04", "retrieval_mode": "keyword"})
+    assert response.status_code == 200
+    assert response.json()["sources"] == ["forms.txt"]
+
+    response = client.post("/subjects/2/chat", json={"question": "Which form is FIN-2023-04?", "retrieval_mode": "hybrid"})
+    assert "forms.txt" in response.json()["sources"]
+
+def test_context_packing_respects_token_budget():
+    client.post("/subjects/", json={"name": "Packing Subject", "description": "Context packing"})
+    subject_id = next(s["id"] for s in client.get("/subjects/").json() if s["name"] == "Packing Subject")
+    text = " ".join(f"Clause {i} covers expense rule number {i} for staff travel." for i in range(300))
+    files = {"file": ("handbook.txt", text.encode(), "text/plain")}
+    job = wait_for_job(client.post(f"/subjects/{subject_id}/documents/", files=files).json()["job_id"])
+    assert job["status"] == "completed"
+
+    response = client.post(f"/subjects/{subject_id}/chat", json={"question": "travel expense rule", "token_budget": 150})
+    usage = response.json()["usage"]
+    assert usage["retrieved_chunks"] == 5
+    assert 0 < usage["context_tokens"] <= 150
+    assert usage["prompt_tokens"] > usage["context_tokens"]
+    for budget in (0, -5):
+        assert client.post(f"/subjects/{subject_id}/chat", json={"question": "travel", "token_budget": budget}).status_code == 422
+
+def test_merge_overlap_requires_minimum_overlap():
+    from context_builder import _merge_overlap
+
+    overlap = "Receipts are required for claims. "
+    assert _merge_overlap("Staff may claim travel. " + overlap, overlap + "Meals are capped.") == (
+        "Staff may claim travel. " + overlap + "Meals are capped."
+    )
+    # A shared letter or word is not an overlap between chunks
+    assert _merge_overlap("Claims are paid in", "in thirty days.") == "Claims are paid in\nin thirty days."
+
+def test_metrics_endpoint_and_request_id(monkeypatch, caplog):
+    from stub_llm import StubLLMClient
+    response = client.post("/subjects/2/chat", json={"question": "What is in the test document?"}, headers={"X-Request-ID": "req-123"})
+    assert response.headers["X-Request-ID"] == "req-123"
+
+    # A streamed answer is logged and timed when its last token has been sent
+    monkeypatch.setattr(app_module.rag_service, "client", StubLLMClient(first_token_latency=0.2))
+    with caplog.at_level("INFO", logger="app"):
+        client.post("/subjects/2/chat/stream", json={"question": "Who signs the test document?"}, headers={"X-Request-ID": "req-stream"})
+    record = next(r for r in caplog.records if r.getMessage().startswith("POST /subjects/2/chat/stream"))
+    assert record.request_id == "req-stream"
+    assert record.duration_ms >= 200
+    assert "llm" in [stage for stage, _ in record.spans]
+
+    body = client.get("/metrics").text
+    assert 'rag_stage_duration_seconds_count{stage="vector_search"}' in body
+    assert 'http_requests_total{method="POST",route="/subjects/{subject_id}/chat",status="200"}' in body
+    assert "embedding_batch_size_bucket" in body
+    assert "upload_bytes_total" in body
+
+def test_multi_subject_chat():
+    packing_id = next(s["id"] for s in client.get("/subjects/").json() if s["name"] == "Packing Subject")
+    misses = client.get("/cache/stats").json()["embeddings"]["misses"]
+
+    response = client.post("/chat", json={"question": "staff travel expense document", "subject_ids": [2, packing_id]})
+    assert response.status_code == 200
+    data = response.json()
+    by_subject = {entry["subject_id"]: entry for entry in data["subject_sources"]}
+    assert by_subject[packing_id]["sources"] == ["handbook.txt"]
+    assert by_subject[packing_id]["subject_name"] == "Packing Subject"
+    assert "test.txt" in by_subject[2]["sources"]
+    assert data["usage"]["subjects"] == 2
+    # The question is embedded once for all subjects
+    assert client.get("/cache/stats").json()["embeddings"]["misses"] == misses + 1
+
+    response = client.post("/chat", json={"question": "anything", "subject_ids": [2, 999]})
+    assert response.status_code == 404
+    assert client.post("/chat", json={"question": "anything", "subject_ids": []}).status_code == 400
+
+def test_memmap_vector_store(tmp_path):
+    import pickle
+    import numpy as np
+    from vector_store import MemmapVectorStore
+
+    rng = np.random.default_rng(0)
+    vectors = rng.normal(size=(500, 32)).astype(np.float32)
+    ids = [f"chunk-{i}" for i in range(500)]
+    store = MemmapVectorStore(str(tmp_path), dtype="int8")
+    collection = store.get_or_create_collection("subject_1")
+    collection.add(
+        ids=ids,
+        embeddings=vectors.tolist(),
+        documents=[f"doc {i}" for i in range(500)],
+        metadatas=[{"filename": "a.txt" if i % 2 else "b.txt"} for i in range(500)]
+    )
+
+    # Only ids and the live-row mask are kept in the sidecar; texts are in the record file
+    with open(tmp_path / "subject_1" / "meta.pkl", "rb") as f:
+        assert "documents" not in pickle.load(f)
+
+    # Later writes append to the journal instead of rewriting the checkpoint, and a
+    # collection opened elsewhere replays them
+    reader = MemmapVectorStore(str(tmp_path)).get_collection("subject_1")
+    checkpoint = (tmp_path / "subject_1" / "meta.pkl").read_bytes()
+    collection.add(ids=["extra"], embeddings=[vectors[0].tolist()], documents=["extra"], metadatas=[{"filename": "x.txt"}])
+    assert reader.count() == 501
+    collection.delete(ids=["extra"])
+    assert (tmp_path / "subject_1" / "meta.pkl").read_bytes() == checkpoint
+    assert reader.count() == 500
+
+    query = vectors[7] + 0.1 * rng.normal(size=32).astype(np.float32)
+    normalized = vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+    expected = [ids[i] for i in np.argsort(-(normalized @ (query / np.linalg.norm(query))))[:5]]
+    results = collection.query(query_embeddings=[query.tolist()], n_results=5)
+    assert results["ids"][0] == expected
+    assert results["distances"][0] == sorted(results["distances"][0])
+
+    collection.delete(ids=["chunk-7"])
+    collection.update(ids=["chunk-9"], metadatas=[{"filename": "c.txt"}])
+    offsets_before, generation_before = collection._offsets, collection.generation
+    collection.compact()
+    # The previous generation stays on disk for readers that still have it mapped
+    assert collection._read_entries([9], None, offsets_before, generation_before)[0][1]["filename"] == "c.txt"
+    reopened = MemmapVectorStore(str(tmp_path)).get_collection("subject_1")
+    assert reopened.count() == 499
+    assert "chunk-7" not in reopened.query(query_embeddings=[query.tolist()], n_results=5)["ids"][0]
+    assert reopened.get(where={"filename": "c.txt"})["ids"] == ["chunk-9"]
+    assert len(reopened.get(where={"filename": "b.txt"}, include=[])["ids"]) == 250
+
+def test_llm_gateway_against_stub_server(monkeypatch):
+    from concurrent.futures import ThreadPoolExecutor
+    from llm_gateway import LLMError, LLMGateway, LLMRateLimited, LLMTimeout
+    from stub_llm import StubLLMClient, StubLLMServer
+
+    messages = [{"role": "user", "content": "hello"}]
+    with StubLLMServer(StubLLMClient(answer="pooled answer"), failures=[429, 503], retry_after=0) as server:
+        gateway = LLMGateway(api_key="test", base_url=server.url, backoff_base=0.01)
+        try:
+            completion = gateway.chat.completions.create(messages=messages, model="stub")
+            assert completion.choices[0].message.content == "pooled answer"
+            assert server.requests == 3
+
+            stream = gateway.chat.completions.create(messages=messages, model="stub", stream=True)
+            assert "".join(chunk.choices[0].delta.content for chunk in stream).strip() == "pooled answer"
+        finally:
+            gateway.close()
+
+    # A stream cut off after the first tokens fails instead of restarting the answer
+    with StubLLMServer(StubLLMClient(answer="one two three four"), disconnect_after=2) as server:
+        gateway = LLMGateway(api_key="test", base_url=server.url, backoff_base=0.01)
+        try:
+            stream = gateway.chat.completions.create(messages=messages, model="stub", stream=True)
+            received = []
+            with pytest.raises(LLMError, match="interrupted"):
+                for chunk in stream:
+                    received.append(chunk.choices[0].delta.content)
+            assert len(received) == 2
+            assert server.requests == 1
+        finally:
+            gateway.close()
+
+    # Identical in-flight prompts share one upstream call
+    with StubLLMServer(StubLLMClient(first_token_latency=0.3)) as server:
+        gateway = LLMGateway(api_key="test", base_url=server.url)
+        try:
+            with ThreadPoolExecutor(max_workers=5) as pool:
+                answers = list(pool.map(lambda _: gateway.complete(messages, "stub").choices[0].message.content, range(5)))
+            assert len(set(answers)) == 1
+            assert server.requests == 1
+        finally:
+            gateway.close()
+
+    with StubLLMServer(StubLLMClient(first_token_latency=1.0)) as server:
+        gateway = LLMGateway(api_key="test", base_url=server.url, timeout=0.2)
+        try:
+            with pytest.raises(LLMTimeout):
+                gateway.complete(messages, "stub")
+        finally:
+            gateway.close()
+
+    with StubLLMServer(failures=[429] * 5, retry_after=0) as server:
+        gateway = LLMGateway(api_key="test", base_url=server.url, max_retries=1)
+        monkeypatch.setattr(app_module.rag_service, "client", gateway)
+        monkeypatch.setattr(app_module.rag_service, "model", "stub")
+        try:
+            with pytest.raises(LLMRateLimited):
+                gateway.complete(messages, "stub")
+            response = client.post("/subjects/2/chat", json={"question": "rate limited question"})
+            assert response.status_code == 503
+            assert "Retry-After" in response.headers
+        finally:
+            gateway.close()
+
+def test_health_checks():
+    assert client.get("/health/live").json() == {"status": "alive"}
+    app_module.warm_up()
+    response = client.get("/health/ready")
+    assert response.status_code == 200
+    data = response.json()
+    assert data["status"] == "ready"
+    assert all(data["checks"].values())
+    assert data["warm_up"]["status"] == "done"
+
+def test_structured_chunker_keeps_sentences_and_pages():
+    from chunking import StructuredChunker, is_heading
+
+    chunker = StructuredChunker(max_tokens=20, overlap_tokens=6, token_counter=lambda texts: [len(t.split()) for t in texts])
+    pages = [
+        "TRAVEL POLICY\nStaff may claim travel costs. Receipts are required for claims over fifty dollars.\n\n"
+        "2. Meals\nMeals are reimbursed up to a daily limit. The limit is thirty dollars in most cities.",
+        "Alcohol is never reimbursed. Taxis need a receipt."
+    ]
+    chunks = list(chunker.iter_chunks(pages))
+    assert all(chunk.text.rstrip().endswith(".") for chunk in chunks)
+    assert all(len(chunk.text.split()) <= 20 for chunk in chunks)
+    assert chunks[0].metadata() == {"page": 1, "page_offset": 0, "page_end": 1, "heading": "TRAVEL POLICY"}
+    meals = [chunk for chunk in chunks if chunk.heading == "2. Meals"]
+    assert meals[0].text.startswith("2. Meals")
+    assert meals[-1].page_end == 2
+    # Page furniture is not a heading
+    assert not any(is_heading(line) for line in ("Page 3 of 10", "Page 3", "- 3 -", "3 / 10"))
+    assert pages[0][meals[0].page_offset:].startswith("2. Meals")
+
+def test_bulk_ingest_directory_and_zip(tmp_path):
+    import zipfile
+    import bulk_ingest
+
+    source = tmp_path / "legacy"
+    (source / "hr").mkdir(parents=True)
+    (source / "hr" / "leave.txt").write_text("Annual leave requests use form LV-7781. Managers approve leave within five days.")
+    (source / "travel.txt").write_text("Mileage is reimbursed with form TR-5521. Claims are paid monthly.")
+    (source / "notes.docx").write_bytes(b"ignored")
+    checkpoint = str(tmp_path / "run.checkpoint.jsonl")
+    args = [str(source), "--subject", "Bulk Subject", "--create-subject", "--processes", "2", "--batch-docs", "1", "--checkpoint", checkpoint]
+
+    assert bulk_ingest.main(args) == 0
+    subject_id = next(s["id"] for s in client.get("/subjects/").json() if s["name"] == "Bulk Subject")
+    with open(checkpoint) as f:
+        entries = [json.loads(line) for line in f]
+    assert sorted(entry["name"] for entry in entries) == ["hr/leave.txt", "travel.txt"]
+    assert all(entry["status"] == "stored" for entry in entries)
+
+    response = client.post(f"/subjects/{subject_id}/chat", json={"question": "LV-7781", "retrieval_mode": "keyword"})
+    assert response.json()["sources"] == ["hr/leave.txt"]
+
+    # Resuming with the same checkpoint does nothing; a zip of the same files is recognised as duplicates
+    summary = bulk_ingest.run(bulk_ingest.argparse.Namespace(
+        source=str(source), subject_id=subject_id, subject=None, create_subject=False, processes=1,
+        batch_docs=64, batch_chunks=4096, checkpoint=checkpoint, retry_failed=False
+    ))
+    assert summary["stored"] == 0 and summary["skipped"] == 0
+    archive = tmp_path / "legacy.zip"
+    with zipfile.ZipFile(archive, "w") as zf:
+        zf.write(source / "travel.txt", "travel.txt")
+    assert bulk_ingest.main([str(archive), "--subject-id", str(subject_id), "--checkpoint", str(tmp_path / "zip.jsonl")]) == 0
+    with open(tmp_path / "zip.jsonl") as f:
+        assert json.loads(f.readline())["status"] == "skipped"
+
+def test_conversation_sessions():
+    from conversation import ConversationStore, is_follow_up
+    from stub_llm import StubLLMClient
+
+    first = client.post("/subjects/2/chat", json={"question": "Which form is used for travel claims?", "session_id": "s1"}).json()
+    assert first["session_id"] == "s1"
+    assert first["standalone_question"] == "Which form is used for travel claims?"
+    assert first["usage"]["history_tokens"] == 0 and first["usage"]["reused_chunks"] == 0
+
+    # Without an LLM client the follow-up is rewritten by prefixing the previous question
+    follow_up = client.post("/subjects/2/chat", json={"question": "and the deadline?", "session_id": "s1"}).json()
+    assert follow_up["standalone_question"] == "Which form is used for travel claims and the deadline?"
+    assert follow_up["usage"]["history_tokens"] > 0
+
+    # Same topic again: the previous turn's chunks are reused instead of searching
+    again = client.post("/subjects/2/chat", json={"question": "Which form is used for travel claims and the deadline?", "session_id": "s1"}).json()
+    assert again["usage"]["reused_chunks"] == again["usage"]["retrieved_chunks"] > 0
+    assert "forms.txt" in again["sources"]
+    # ... but not when the retrieval settings changed
+    other_k = client.post("/subjects/2/chat", json={"question": "Which form is used for travel claims and the deadline?", "session_id": "s1", "top_k": 3}).json()
+    assert other_k["usage"]["reused_chunks"] == 0
+
+    # Short or "there"-questions that stand on their own are not follow-ups
+    assert not is_follow_up("What is entropy?") and not is_follow_up("Is there a formula for claims?")
+    assert is_follow_up("How does it work?") and is_follow_up("which one?")
+
+    original_client = app_module.rag_service.client
+    app_module.rag_service.client = StubLLMClient(answer="Within how many days must travel claims be filed?")
+    try:
+        rewritten = client.post("/subjects/2/chat", json={"question": "how long do I have for it?", "session_id": "s1"}).json()
+    finally:
+        app_module.rag_service.client = original_client
+    assert rewritten["standalone_question"] == "Within how many days must travel claims be filed?"
+
+    session = client.get("/sessions/s1").json()
+    assert session["turn_count"] == 5
+    assert [turn["question"] for turn in session["turns"]][-1] == "how long do I have for it?"
+    assert client.delete("/sessions/s1").status_code == 204
+    assert client.get("/sessions/s1").status_code == 404
+    # Requests without a session stay stateless
+    assert client.post("/subjects/2/chat", json={"question": "FIN-2023-04"}).json()["session_id"] is None
+
+    # Old turns are folded into a bounded summary, and history respects its token budget
+    store = ConversationStore(lambda text: len(text) // 4, max_turns=2, summary_tokens=40, answer_chars=80)
+    conversation = store.get("bounded")
+    for i in range(50):
+        store.record(conversation, f"Question {i}?", f"Question {i}?", "Answer " * 100, 2, [f"c{i}"])
+    assert len(conversation.turns) == 2 and conversation.turn_count == 50
+    assert sum(len(line) // 4 for line in conversation.summary) <= 40
+    assert all(len(turn.answer) <= 80 for turn in conversation.turns)
+    assert len(conversation.history(60)) // 4 <= 60
+    assert "Question 49?" in conversation.history(60)
+
+def test_cross_encoder_reranking():
+    question = "Which form must travel claims be filed on?"
+    request = {"question": question, "rerank": True, "rerank_depth": 20, "top_k": 1}
+    data = client.post("/subjects/2/chat", json=request).json()
+    assert data["sources"] == ["forms.txt"]
+    assert data["usage"]["retrieved_chunks"] == 1
+    assert data["usage"]["rerank_candidates"] > 1 and data["usage"]["rerank_cached"] == 0
+    assert set(data["timings"]) >= {"retrieval_ms", "rerank_ms", "generation_ms"}
+
+    # Repeated questions reuse the cached cross-encoder scores
+    again = client.post("/subjects/2/chat", json=request).json()
+    assert again["usage"]["rerank_cached"] == again["usage"]["rerank_candidates"]
+    assert "rerank_ms" not in client.post("/subjects/2/chat", json={"question": question}).json()["timings"]
+
+    packing_id = next(s["id"] for s in client.get("/subjects/").json() if s["name"] == "Packing Subject")
+    data = client.post("/chat", json={"question": question, "subject_ids": [2, packing_id], "rerank": True, "top_k": 1}).json()
+    assert data["usage"]["retrieved_chunks"] <= 2
+    assert "forms.txt" in data["sources"]
+    assert 'rag_stage_duration_seconds_count{stage="rerank"}' in client.get("/metrics").text
+    assert client.post("/subjects/2/chat", json={"question": question, "top_k": 0}).status_code == 422
+
+def test_document_delete_replace_and_compaction():
+    client.post("/subjects/", json={"name": "Lifecycle Subject", "description": "Versions"})
+    subject_id = next(s["id"] for s in client.get("/subjects/").json() if s["name"] == "Lifecycle Subject")
+    for name, body in [("policy.txt", "Remote work needs approval code ZX1001."), ("old.txt", "Archived rule uses code AR-2002.")]:
+        job = wait_for_job(client.post(f"/subjects/{subject_id}/documents/", files={"file": (name, body.encode(), "text/plain")}).json()["job_id"])
+        assert job["status"] == "completed"
+    documents = {d["filename"]: d for d in client.get(f"/subjects/{subject_id}/documents/").json()}
+    assert documents["policy.txt"]["version"] == 1
+
+    # Replace with new content under a new name: version 2, old chunks gone
+    policy_id = documents["policy.txt"]["id"]
+    files = {"file": ("policy-v2.txt", b"Remote work now needs approval code QY3003.", "text/plain")}
+    response = client.put(f"/subjects/{subject_id}/documents/{policy_id}", files=files)
+    assert response.status_code == 202
+    assert wait_for_job(response.json()["job_id"])["document_id"] == policy_id
+    detail = client.get(f"/subjects/{subject_id}/documents/{policy_id}").json()
+    assert detail["filename"] == "policy-v2.txt" and detail["version"] == 2
+    assert [v["filename"] for v in detail["versions"]] == ["policy.txt", "policy-v2.txt"]
+    ask = lambda q: client.post(f"/subjects/{subject_id}/chat", json={"question": q, "retrieval_mode": "keyword"}).json()["sources"]
+    assert ask("ZX1001") == [] and ask("QY3003") == ["policy-v2.txt"]
+    clash = client.put(f"/subjects/{subject_id}/documents/{policy_id}", files={"file": ("old.txt", b"x", "text/plain")})
+    assert clash.status_code == 409
+
+    deleted = client.delete(f"/subjects/{subject_id}/documents/{documents['old.txt']['id']}").json()
+    assert deleted["removed_chunks"] == 1
+    assert ask("AR-2002") == []
+    assert client.get(f"/subjects/{subject_id}/documents/{documents['old.txt']['id']}").status_code == 404
+
+    # Chunks with no Document row (e.g. from an interrupted ingestion) are dropped by compaction
+    app_module.rag_service.add_documents(subject_id, ["Ghost chunk GH-4004."], [{"filename": "ghost.txt"}])
+    assert ask("GH-4004") == ["ghost.txt"]
+    report = client.post(f"/subjects/{subject_id}/compact").json()
+    assert report["orphans_removed"] == 1
+    assert report["before"]["chunks"] == 2 and report["after"]["chunks"] == 1
+    assert report["after"]["keyword_documents"] == 1
+    assert ask("GH-4004") == [] and ask("QY3003") == ["policy-v2.txt"]
+
+def test_evaluation_harness_sweeps_configurations(tmp_path):
+    import argparse
+    import evaluate
+    documents = tmp_path / "docs" / "hr"
+    documents.mkdir(parents=True)
+    (documents / "travel.txt").write_text("Travel claims use form TR5150 and are due within 30 days.")
+    (documents / "leave.txt").write_text("Parental leave requests use form PL6262 signed by a manager.")
+    dataset = tmp_path / "eval.jsonl"
+    dataset.write_text("\n".join(json.dumps(item) for item in [
+        {"subject": "hr", "question": "Which form is TR5150?", "source": "travel.txt", "passage": "form TR5150"},
+        {"subject": "hr", "question": "Who signs PL6262?", "source": "leave.txt"},
+    ]))
+    args = argparse.Namespace(
+        dataset=str(dataset), documents=str(tmp_path / "docs"), k=[1], parallel=2, metric=None, tolerance=0.0,
+        grid=["CHUNKER=character,structured", "retrieval_mode=keyword", "n_results=1,2"]
+    )
+    report = evaluate.run(args)
+    assert len(report["results"]) == 4
+    for row in report["results"]:
+        assert row["metrics"]["recall@1"] == 1.0 and row["metrics"]["mrr"] == 1.0
+        assert row["ingestion"]["documents"] == 2 and row["metrics"]["prompt_tokens_mean"] > 0
+    assert report["recommended"]["config"]["retrieval_mode"] == "keyword"
+    assert "recall@1" in evaluate.render(report)
+
+def test_chat_rate_limits_and_load_shedding(monkeypatch):
+    from admission import Lane, RateLimiter
+    from conversation import ConversationStore
+    from stub_llm import StubLLMClient
+    ask = lambda question, client_id="tenant-a": client.post(
+        "/subjects/2/chat", json={"question": question}, headers={"X-Client-ID": client_id}
+    )
+
+    # Per-client token bucket: a burst of 2, then 429 for that client only
+    monkeypatch.setattr(app_module, "chat_limiter", RateLimiter({"client": (60, 2), "subject": (6000, 100)}))
+    assert ask("How are expense claims filed?").status_code == 200
+    assert ask("How are expense claims filed?").status_code == 200
+    limited = ask("How are expense claims filed?")
+    assert limited.status_code == 429 and int(limited.headers["Retry-After"]) >= 1
+    # The client header is ignored unless configured, so it cannot be used to dodge the limit
+    assert ask("How are expense claims filed?", "tenant-b").status_code == 429
+    monkeypatch.setattr(app_module, "RATE_LIMIT_CLIENT_HEADER", "X-Client-ID")
+    assert ask("How are expense claims filed?", "tenant-b").status_code == 200
+
+    # With the only LLM slot taken and no queue, new questions are shed but cached answers are still served
+    monkeypatch.setattr(app_module, "chat_limiter", RateLimiter({}))
+    monkeypatch.setattr(app_module.rag_service, "client", StubLLMClient())
+    monkeypatch.setattr(app_module.rag_service, "llm_lane", Lane("llm", slots=1, max_queue=0, queue_timeout=0.1))
+    assert ask("When are expense claims due?").json()["cached"] is False
+    held = app_module.rag_service.llm_lane.acquire()
+    try:
+        shed = ask("Which form is used for expense claims?")
+        assert shed.status_code == 503 and "Retry-After" in shed.headers
+        assert ask("When are expense claims due?").json()["cached"] is True
+        # Follow-up rewrites are shed too, falling back to the heuristic rewrite
+        store = ConversationStore(lambda text: len(text) // 4)
+        conversation = store.get("shed")
+        store.record(conversation, "Which form is used?", "Which form is used?", "Form EX-7.", 2, ["c1"])
+        rewritten = app_module.rag_service._rewrite_question("and the deadline?", conversation, conversation.turns[-1])
+        assert rewritten == "Which form is used and the deadline?"
+    finally:
+        app_module.rag_service.llm_lane.release(held)
+    assert ask("Which form is used for expense claims?").status_code == 200
+    assert 'rag_admission_shed_total{lane="llm",reason="queue_full"} 2' in client.get("/metrics").text
+    assert 'rag_rate_limited_total{scope="client"} 2' in client.get("/metrics").text
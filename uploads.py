@@ -0,0 +1,238 @@
+import hashlib
+import os
+import tempfile
+import time
+from typing import Callable, Iterator, Optional
+
+import anyio
+from fastapi import Request
+
+try:
+    import python_multipart as multipart
+    from python_multipart.multipart import parse_options_header
+except ModuleNotFoundError:  # python-multipart < 0.0.13
+    import multipart
+    from multipart.multipart import parse_options_header
+
+import metrics
+from logger_config import setup_logger
+from metrics import timed
+
+logger = setup_logger(__name__)
+
+UPLOAD_DIR = os.getenv("UPLOAD_DIR", "uploads")
+MAX_UPLOAD_BYTES = int(os.getenv("MAX_UPLOAD_BYTES", str(200 * 1024 * 1024)))
+UPLOAD_RETAIN = os.getenv("UPLOAD_RETAIN", "true").lower() == "true"
+
+# OpenAPI description of the multipart body, which the upload endpoints parse themselves.
+UPLOAD_REQUEST_BODY = {
+    "requestBody": {
+        "required": True,
+        "content": {
+            "multipart/form-data": {
+                "schema": {
+                    "type": "object",
+                    "required": ["file"],
+                    "properties": {"file": {"type": "string", "format": "binary"}},
+                }
+            }
+        },
+    }
+}
+
+
+class UploadError(Exception):
+    def __init__(self, message: str, status_code: int = 400):
+        super().__init__(message)
+        self.status_code = status_code
+
+
+class SpooledUpload:
+    """An uploaded file written to disk once, with its SHA-256 and size computed on the way."""
+
+    def __init__(self, filename: str, path: str, file_hash: str, size: int):
+        self.filename = filename
+        self.path = path
+        self.file_hash = file_hash
+        self.size = size
+
+    def discard(self):
+        discard_upload(self.path)
+
+
+def retain_upload(path: str, subject_id: int, filename: str) -> Optional[str]:
+    """Keep an ingested upload as `UPLOAD_DIR/<subject>_<filename>` (a rename, not a copy), or delete it if `UPLOAD_RETAIN` is off.
+
+    Called only once ingestion has succeeded, so until then every upload keeps its own
+    spool file and two uploads of the same name cannot overwrite each other's input.
+    """
+    if not UPLOAD_RETAIN:
+        discard_upload(path)
+        return None
+    target = os.path.join(UPLOAD_DIR, f"{subject_id}_{filename}")
+    os.replace(path, target)
+    return target
+
+
+def discard_upload(path: str):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+def _header_text(value) -> str:
+    return value.decode("latin-1") if isinstance(value, bytes) else value
+
+
+class _MultipartSpooler:
+    """Streams the `file` part of a multipart body straight into a spool file, hashing and counting as it goes."""
+
+    def __init__(self, boundary: bytes, field: str, max_bytes: int, accept: Optional[Callable[[str], bool]] = None):
+        self.field = field
+        self.max_bytes = max_bytes
+        self.accept = accept
+        self.filename: Optional[str] = None
+        self.path: Optional[str] = None
+        self.size = 0
+        self._digest = hashlib.sha256()
+        self._file = None
+        self._in_target = False
+        self._done = False
+        self._header_field = b""
+        self._header_value = b""
+        self._headers = {}
+        self.parser = multipart.MultipartParser(boundary, {
+            "on_part_begin": self._on_part_begin,
+            "on_part_data": self._on_part_data,
+            "on_part_end": self._on_part_end,
+            "on_header_field": self._on_header_field,
+            "on_header_value": self._on_header_value,
+            "on_header_end": self._on_header_end,
+            "on_headers_finished": self._on_headers_finished,
+        })
+
+    def _on_part_begin(self):
+        self._headers = {}
+
+    def _on_header_field(self, data: bytes, start: int, end: int):
+        self._header_field += data[start:end]
+
+    def _on_header_value(self, data: bytes, start: int, end: int):
+        self._header_value += data[start:end]
+
+    def _on_header_end(self):
+        self._headers[self._header_field.lower()] = self._header_value
+        self._header_field = self._header_value = b""
+
+    def _on_headers_finished(self):
+        _, options = parse_options_header(self._headers.get(b"content-disposition", b""))
+        options = {_header_text(key): _header_text(value) for key, value in options.items()}
+        self._in_target = not self._done and options.get("name") == self.field and "filename" in options
+        if self._in_target:
+            # Only the base name: a client-supplied path must not escape UPLOAD_DIR.
+            self.filename = os.path.basename(options["filename"].replace("\\", "/"))
+            if self.accept and not self.accept(self.filename):
+                raise UploadError("Unsupported file format. Only PDF and TXT are supported.")
+            fd, self.path = tempfile.mkstemp(dir=UPLOAD_DIR, prefix="upload-", suffix=".part")
+            self._file = os.fdopen(fd, "wb")
+
+    def _on_part_data(self, data: bytes, start: int, end: int):
+        if not self._in_target:
+            return
+        self.size += end - start
+        if self.size > self.max_bytes:
+            raise UploadError(f"File exceeds the {self.max_bytes} byte upload limit", status_code=413)
+        block = memoryview(data)[start:end]
+        self._digest.update(block)
+        self._file.write(block)
+
+    def _on_part_end(self):
+        if self._in_target:
+            self._file.close()
+            self._file = None
+            self._in_target = False
+            self._done = True
+
+    def close(self):
+        """Remove the spool file after a failed upload."""
+        if self._file is not None:
+            self._file.close()
+        if self.path and not self._done:
+            try:
+                os.remove(self.path)
+            except FileNotFoundError:
+                pass
+
+    def result(self) -> SpooledUpload:
+        if not self._done:
+            self.close()
+            raise UploadError("Multipart body has no complete 'file' part")
+        return SpooledUpload(self.filename, self.path, self._digest.hexdigest(), self.size)
+
+
+def _iter_body(request: Request) -> Iterator[bytes]:
+    """The request body as it arrives, read from a sync endpoint's worker thread."""
+    stream = request.stream().__aiter__()
+
+    async def next_chunk() -> Optional[bytes]:
+        try:
+            return await stream.__anext__()
+        except StopAsyncIteration:
+            return None
+
+    while True:
+        chunk = anyio.from_thread.run(next_chunk)
+        if chunk is None:
+            return
+        if chunk:
+            yield chunk
+
+
+def receive_upload(
+    request: Request,
+    field: str = "file",
+    max_bytes: Optional[int] = None,
+    accept: Optional[Callable[[str], bool]] = None
+) -> SpooledUpload:
+    """Stream a multipart upload to a spool file in UPLOAD_DIR in one pass.
+
+    The body is parsed as it arrives. The `field` file part is hashed, size-checked and
+    written in the same pass, without being buffered in memory or copied again. Raises
+    `UploadError`: 413 once the file passes `max_bytes` (default `MAX_UPLOAD_BYTES`), or
+    400 for a malformed body or a filename rejected by `accept` (checked before any data
+    is written).
+    """
+    max_bytes = max_bytes or MAX_UPLOAD_BYTES
+    content_type, options = parse_options_header(request.headers.get("content-type", ""))
+    boundary = options.get(b"boundary") or options.get("boundary")
+    if _header_text(content_type) != "multipart/form-data" or not boundary:
+        raise UploadError("Expected a multipart/form-data body with a 'file' part")
+    declared = request.headers.get("content-length")
+    if declared and declared.isdigit() and int(declared) > max_bytes + 64 * 1024:
+        raise UploadError(f"File exceeds the {max_bytes} byte upload limit", status_code=413)
+
+    os.makedirs(UPLOAD_DIR, exist_ok=True)
+    spooler = _MultipartSpooler(
+        boundary if isinstance(boundary, bytes) else boundary.encode("latin-1"), field, max_bytes, accept
+    )
+    started = time.perf_counter()
+    try:
+        with timed("upload_write"):
+            for chunk in _iter_body(request):
+                spooler.parser.write(chunk)
+            spooler.parser.finalize()
+    except UploadError:
+        spooler.close()
+        raise
+    except Exception as e:
+        spooler.close()
+        raise UploadError(f"Could not read the upload: {str(e)}")
+    upload = spooler.result()
+
+    elapsed = time.perf_counter() - started
+    metrics.UPLOAD_BYTES.inc(upload.size)
+    if elapsed > 0:
+        metrics.UPLOAD_BYTES_PER_SECOND.observe(upload.size / elapsed)
+    logger.info(f"Received {upload.filename} ({upload.size} bytes) in {elapsed:.3f}s")
+    return upload
@@ -0,0 +1,471 @@
+import json
+import mmap
+import os
+import pickle
+import shutil
+import struct
+import threading
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+from logger_config import setup_logger
+
+logger = setup_logger(__name__)
+
+_SCAN_BLOCK_ROWS = 65536
+
+
+def _matches(metadata: Dict[str, Any], where: Optional[Dict[str, Any]]) -> bool:
+    return not where or all(metadata.get(key) == value for key, value in where.items())
+
+
+class MemmapCollection:
+    """One subject's embeddings as a quantized, memory-mapped matrix plus a pickled sidecar.
+
+    Files live in `<root>/<name>/`:
+
+    - `vectors-<gen>.bin`: one row per chunk, int8 (symmetric per-row scale) or float16
+    - `scales-<gen>.f32`: the int8 row scales
+    - `full-<gen>.f32`: float32 rows, only read for the shortlist when `rescore` is on
+    - `records-<gen>.bin`: append-only JSON `[document, metadata]` records
+    - `offsets-<gen>.i64`: the (start, end) byte range of each row's record
+    - `journal-<gen>.log`: append-only, length-prefixed `("add" | "delete", ids)` entries
+    - `meta.pkl`: a checkpoint of the ids, live-row mask and generation, plus how much of
+      the journal it already covers
+
+    Only the ids and live-row mask are held in memory; documents and metadata are read
+    from the memory-mapped record file when a row is returned or filtered. A batch
+    appends its rows, records and offsets and then one journal entry, so a write costs
+    the size of the batch rather than of the collection, and a reader that stops at the
+    last complete journal entry never sees half-written rows. A metadata update appends
+    a new record and repoints the row in place. The checkpoint is only rewritten when
+    a collection is created or compacted; readers replay new journal entries (and remap
+    the record file if it grew) before every call. Compaction writes a new generation
+    and keeps the previous one on disk, so queries scanning it without the lock, and
+    other processes that have not yet noticed the new checkpoint, can finish; the
+    generation before that is removed. Rows are L2-normalised; distances are cosine
+    distances (1 - similarity), smaller is closer, as with Chroma.
+
+    Implements the subset of Chroma's collection API that `RAGService` uses.
+    """
+
+    def __init__(self, path: str, name: str, dtype: str = "int8", rescore: bool = True, rescore_factor: int = 4):
+        if dtype not in ("int8", "float16"):
+            raise ValueError(f"Unsupported vector dtype: {dtype}")
+        self.path = path
+        self.name = name
+        self.dtype = dtype
+        self.rescore = rescore
+        self.rescore_factor = rescore_factor
+        self._lock = threading.RLock()
+        self._meta_mtime = None
+        self._journal_offset = 0
+        self._reset()
+        self._refresh()
+
+    def _reset(self):
+        self.dim: Optional[int] = None
+        self.generation = 0
+        self.ids: List[str] = []
+        self.alive: List[bool] = []
+        self._rows: Dict[str, int] = {}
+        self._vectors = self._scales = self._full = None
+        self._records = self._offsets = None
+
+    @property
+    def _meta_path(self) -> str:
+        return os.path.join(self.path, "meta.pkl")
+
+    def _file(self, kind: str, generation: Optional[int] = None) -> str:
+        generation = self.generation if generation is None else generation
+        suffix = {"scales": "f32", "full": "f32", "offsets": "i64", "journal": "log"}.get(kind, "bin")
+        return os.path.join(self.path, f"{kind}-{generation}.{suffix}")
+
+    def _storage_dtype(self):
+        return np.int8 if self.dtype == "int8" else np.float16
+
+    # -- persistence -------------------------------------------------------------
+
+    def _refresh(self):
+        """Pick up changes made by another process: a new checkpoint, journal entries or records."""
+        try:
+            mtime = os.stat(self._meta_path).st_mtime_ns
+        except FileNotFoundError:
+            return
+        changed = False
+        if mtime != self._meta_mtime:
+            with open(self._meta_path, "rb") as f:
+                state = pickle.load(f)
+            self.dim = state["dim"]
+            self.dtype = state["dtype"]
+            self.generation = state["generation"]
+            self.ids = state["ids"]
+            self.alive = state["alive"]
+            self._rows = {chunk_id: row for row, chunk_id in enumerate(self.ids) if self.alive[row]}
+            self._journal_offset = state.get("journal_offset", 0)
+            self._meta_mtime = mtime
+            if "documents" in state:
+                # Sidecar from before records were split out: move them to the record file once.
+                self._append_records(list(zip(state["documents"], state["metadatas"])), 0)
+                self._checkpoint()
+            changed = True
+        if self._replay_journal() or changed:
+            self._map()
+        elif self._records is not None and os.path.getsize(self._file("records")) > len(self._records):
+            self._records = self._map_records(self.generation)  # another process updated metadata
+
+    def _replay_journal(self) -> bool:
+        """Apply journal entries written since the last replay; returns whether there were any."""
+        try:
+            with open(self._file("journal"), "rb") as f:
+                f.seek(self._journal_offset)
+                data = f.read()
+        except FileNotFoundError:
+            return False
+        position = 0
+        while position + 8 <= len(data):
+            (length,) = struct.unpack_from("<Q", data, position)
+            if position + 8 + length > len(data):
+                break  # still being written
+            op, ids = pickle.loads(data[position + 8:position + 8 + length])
+            self._apply(op, ids)
+            position += 8 + length
+        self._journal_offset += position
+        return position > 0
+
+    def _apply(self, op: str, ids: List[str]):
+        for chunk_id in ids:
+            row = self._rows.pop(chunk_id, None)
+            if row is not None:
+                self.alive[row] = False
+            if op == "add":
+                self._rows[chunk_id] = len(self.ids)
+                self.ids.append(chunk_id)
+                self.alive.append(True)
+
+    def _log(self, op: str, ids: List[str]):
+        """Append one entry to the journal (dropping any torn tail left by a crash) and apply it."""
+        payload = pickle.dumps((op, list(ids)), protocol=pickle.HIGHEST_PROTOCOL)
+        with open(self._file("journal"), "ab") as f:
+            f.truncate(self._journal_offset)
+            f.write(struct.pack("<Q", len(payload)) + payload)
+        self._journal_offset += 8 + len(payload)
+        self._apply(op, ids)
+
+    def _map(self):
+        rows = len(self.ids)
+        if not rows:
+            self._vectors = self._scales = self._full = None
+            self._records = self._offsets = None
+            return
+        self._vectors = np.memmap(self._file("vectors"), dtype=self._storage_dtype(), mode="r", shape=(rows, self.dim))
+        self._scales = (
+            np.memmap(self._file("scales"), dtype=np.float32, mode="r", shape=(rows,)) if self.dtype == "int8" else None
+        )
+        full_path = self._file("full")
+        self._full = (
+            np.memmap(full_path, dtype=np.float32, mode="r", shape=(rows, self.dim)) if os.path.exists(full_path) else None
+        )
+        self._offsets = np.memmap(self._file("offsets"), dtype=np.int64, mode="r", shape=(rows, 2))
+        self._records = self._map_records(self.generation)
+
+    def _map_records(self, generation: int) -> Optional[mmap.mmap]:
+        with open(self._file("records", generation), "rb") as f:
+            if not os.fstat(f.fileno()).st_size:
+                return None
+            return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def _checkpoint(self):
+        state = {
+            "dim": self.dim,
+            "dtype": self.dtype,
+            "generation": self.generation,
+            "ids": self.ids,
+            "alive": self.alive,
+            "journal_offset": self._journal_offset,
+        }
+        os.makedirs(self.path, exist_ok=True)
+        tmp_path = f"{self._meta_path}.tmp"
+        with open(tmp_path, "wb") as f:
+            pickle.dump(state, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, self._meta_path)
+        self._meta_mtime = os.stat(self._meta_path).st_mtime_ns
+
+    def _quantize(self, vectors: np.ndarray):
+        if self.dtype == "float16":
+            return vectors.astype(np.float16), None
+        scales = np.abs(vectors).max(axis=1) / 127.0
+        scales[scales == 0] = 1.0
+        quantized = np.clip(np.rint(vectors / scales[:, None]), -127, 127).astype(np.int8)
+        return quantized, scales.astype(np.float32)
+
+    def _append_rows(self, vectors: np.ndarray, rows: int, generation: Optional[int] = None):
+        """Append to the generation's files after `rows` existing rows (dropping any unreferenced tail left by a crash)."""
+        quantized, scales = self._quantize(vectors)
+        parts = [("vectors", quantized)]
+        if scales is not None:
+            parts.append(("scales", scales))
+        if self.rescore:
+            parts.append(("full", vectors.astype(np.float32)))
+        for kind, data in parts:
+            self._append_array(kind, data, rows, generation)
+
+    def _append_array(self, kind: str, data: np.ndarray, rows: int, generation: Optional[int] = None):
+        with open(self._file(kind, generation), "ab") as f:
+            f.truncate(rows * data[:1].nbytes)
+            f.write(data.tobytes())
+
+    def _write_records(self, entries: List[Tuple[str, Dict[str, Any]]], generation: Optional[int] = None, truncate: bool = False) -> np.ndarray:
+        """Append `[document, metadata]` records to the record file; returns their (start, end) offsets."""
+        encoded = [json.dumps(entry).encode("utf-8") for entry in entries]
+        with open(self._file("records", generation), "ab") as f:
+            if truncate:
+                f.truncate(0)
+            start = f.seek(0, os.SEEK_END)
+            f.write(b"".join(encoded))
+        lengths = np.array([len(data) for data in encoded], dtype=np.int64)
+        ends = start + np.cumsum(lengths)
+        return np.stack([ends - lengths, ends], axis=1)
+
+    def _append_records(self, entries: List[Tuple[str, Dict[str, Any]]], rows: int, generation: Optional[int] = None):
+        """Append records for new rows after `rows` existing rows (a fresh file when `rows` is 0)."""
+        offsets = self._write_records(entries, generation, truncate=not rows)
+        self._append_array("offsets", offsets, rows, generation)
+
+    def _read_entries(self, rows: Sequence[int], records, offsets, generation: int) -> List[Tuple[str, Dict[str, Any]]]:
+        entries = []
+        for row in rows:
+            start, end = (int(value) for value in offsets[row])
+            if records is None or end > len(records):
+                records = self._map_records(generation)  # a record appended since this mapping was made
+            entries.append(tuple(json.loads(records[start:end])))
+        return entries
+
+    def _entries(self, rows: Sequence[int]) -> List[Tuple[str, Dict[str, Any]]]:
+        return self._read_entries(rows, self._records, self._offsets, self.generation)
+
+    @staticmethod
+    def _normalize(embeddings: Sequence[Sequence[float]]) -> np.ndarray:
+        vectors = np.asarray(embeddings, dtype=np.float32)
+        norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+        norms[norms == 0] = 1.0
+        return vectors / norms
+
+    # -- Chroma-compatible API ---------------------------------------------------
+
+    def count(self) -> int:
+        with self._lock:
+            self._refresh()
+            return len(self._rows)
+
+    def add(self, ids: List[str], embeddings, documents: List[str], metadatas: List[Dict[str, Any]]):
+        self.upsert(ids=ids, embeddings=embeddings, documents=documents, metadatas=metadatas)
+
+    def upsert(self, ids: List[str], embeddings, documents: List[str], metadatas: List[Dict[str, Any]]):
+        if not ids:
+            return
+        vectors = self._normalize(embeddings)
+        with self._lock:
+            self._refresh()
+            if self.dim is None:
+                self.dim = vectors.shape[1]
+                os.makedirs(self.path, exist_ok=True)
+                self._checkpoint()
+            elif vectors.shape[1] != self.dim:
+                raise ValueError(f"Embedding dimension {vectors.shape[1]} does not match collection dimension {self.dim}")
+            self._append_rows(vectors, len(self.ids))
+            self._append_records([(doc, dict(metadata)) for doc, metadata in zip(documents, metadatas)], len(self.ids))
+            self._log("add", ids)
+            self._map()
+            self._maybe_compact()
+
+    def update(self, ids: List[str], metadatas: List[Dict[str, Any]]):
+        with self._lock:
+            self._refresh()
+            changes = [(self._rows[chunk_id], metadata) for chunk_id, metadata in zip(ids, metadatas) if chunk_id in self._rows]
+            if not changes:
+                return
+            rows = [row for row, _ in changes]
+            entries = [(doc, dict(old, **metadata)) for (doc, old), (_, metadata) in zip(self._entries(rows), changes)]
+            offsets = self._write_records(entries)
+            with open(self._file("offsets"), "r+b") as f:
+                for row, offset in zip(rows, offsets):
+                    f.seek(row * offset.nbytes)
+                    f.write(offset.tobytes())
+            self._records = self._map_records(self.generation)
+
+    def delete(self, ids: Optional[List[str]] = None, where: Optional[Dict[str, Any]] = None):
+        with self._lock:
+            self._refresh()
+            if ids is not None:
+                targets = list(ids)
+            else:
+                rows = list(self._rows.values())
+                targets = [
+                    self.ids[row] for row, (_, metadata) in zip(rows, self._entries(rows)) if _matches(metadata, where)
+                ]
+            targets = [chunk_id for chunk_id in targets if chunk_id in self._rows]
+            if not targets:
+                return
+            self._log("delete", targets)
+            self._maybe_compact()
+
+    def get(
+        self,
+        ids: Optional[List[str]] = None,
+        where: Optional[Dict[str, Any]] = None,
+        include: Sequence[str] = ("documents", "metadatas")
+    ) -> Dict[str, Any]:
+        with self._lock:
+            self._refresh()
+            if ids is not None:
+                rows = [self._rows[chunk_id] for chunk_id in ids if chunk_id in self._rows]
+            else:
+                rows = sorted(self._rows.values())
+            entries = self._entries(rows) if where or "documents" in include or "metadatas" in include else []
+            if where:
+                kept = [(row, entry) for row, entry in zip(rows, entries) if _matches(entry[1], where)]
+                rows, entries = [row for row, _ in kept], [entry for _, entry in kept]
+            result: Dict[str, Any] = {"ids": [self.ids[row] for row in rows]}
+            if "documents" in include:
+                result["documents"] = [doc for doc, _ in entries]
+            if "metadatas" in include:
+                result["metadatas"] = [metadata for _, metadata in entries]
+            return result
+
+    def query(self, query_embeddings, n_results: int = 10) -> Dict[str, List[List[Any]]]:
+        """Exact top-k by cosine similarity over the quantized rows, scanned in blocks.
+
+        With `rescore`, the best `n_results * rescore_factor` rows are re-scored against
+        their float32 copies before the final cut.
+        """
+        with self._lock:
+            self._refresh()
+            vectors, scales, full = self._vectors, self._scales, self._full
+            alive = np.fromiter(self.alive, dtype=bool, count=len(self.alive)) if self.alive else None
+            ids, records, offsets, generation = self.ids, self._records, self._offsets, self.generation
+
+        results = {"ids": [], "documents": [], "metadatas": [], "distances": []}
+        for query_vector in self._normalize(query_embeddings):
+            top_rows, top_scores = self._top_k(query_vector, n_results, vectors, scales, full, alive)
+            entries = self._read_entries(top_rows, records, offsets, generation)
+            results["ids"].append([ids[row] for row in top_rows])
+            results["documents"].append([doc for doc, _ in entries])
+            results["metadatas"].append([metadata for _, metadata in entries])
+            results["distances"].append([float(1.0 - score) for score in top_scores])
+        return results
+
+    def _top_k(self, query_vector: np.ndarray, k: int, vectors, scales, full, alive):
+        if vectors is None or not alive.any():
+            return [], []
+        shortlist = k * self.rescore_factor if full is not None else k
+        best_rows = np.empty(0, dtype=np.int64)
+        best_scores = np.empty(0, dtype=np.float32)
+        for start in range(0, vectors.shape[0], _SCAN_BLOCK_ROWS):
+            block = np.asarray(vectors[start:start + _SCAN_BLOCK_ROWS], dtype=np.float32)
+            scores = block @ query_vector
+            if scales is not None:
+                scores *= scales[start:start + len(block)]
+            scores[~alive[start:start + len(block)]] = -np.inf
+            rows = np.arange(start, start + len(block))
+            best_rows = np.concatenate([best_rows, rows])
+            best_scores = np.concatenate([best_scores, scores])
+            if len(best_scores) > shortlist:
+                keep = np.argpartition(-best_scores, shortlist)[:shortlist]
+                best_rows, best_scores = best_rows[keep], best_scores[keep]
+
+        valid = np.isfinite(best_scores)
+        best_rows, best_scores = best_rows[valid], best_scores[valid]
+        if full is not None and len(best_rows):
+            order = np.argsort(best_rows)
+            best_rows = best_rows[order]
+            best_scores = np.asarray(full[best_rows], dtype=np.float32) @ query_vector
+        order = np.argsort(-best_scores)[:k]
+        return best_rows[order].tolist(), best_scores[order].tolist()
+
+    # -- maintenance -------------------------------------------------------------
+
+    def _maybe_compact(self):
+        dead = len(self.alive) - len(self._rows)
+        if dead > 1000 and dead > len(self.alive) // 2:
+            self.compact()
+
+    def compact(self):
+        """Rewrite the live rows into a new generation and drop the tombstoned ones."""
+        with self._lock:
+            self._refresh()
+            old_generation = self.generation
+            live = sorted(self._rows.values())
+            new_generation = old_generation + 1
+            if live:
+                if self._full is not None:
+                    vectors = np.asarray(self._full[live], dtype=np.float32)
+                else:
+                    vectors = np.asarray(self._vectors[live], dtype=np.float32)
+                    if self._scales is not None:
+                        vectors *= np.asarray(self._scales[live])[:, None]
+                self._append_rows(vectors, 0, new_generation)
+                self._append_records(self._entries(live), 0, new_generation)
+            self.ids = [self.ids[row] for row in live]
+            self.alive = [True] * len(live)
+            self._rows = {chunk_id: row for row, chunk_id in enumerate(self.ids)}
+            self.generation = new_generation
+            self._journal_offset = 0
+            try:
+                os.remove(self._file("journal"))  # left behind by an interrupted compaction
+            except FileNotFoundError:
+                pass
+            self._checkpoint()
+            self._map()
+            self._remove_generations_before(old_generation)
+            logger.info(f"Compacted vector collection {self.name} to {len(live)} rows")
+
+
+    def _remove_generations_before(self, generation: int):
+        for filename in os.listdir(self.path):
+            stem, _, _ = filename.partition(".")
+            kind, _, file_generation = stem.rpartition("-")
+            if kind in ("vectors", "scales", "full", "records", "offsets", "journal") and file_generation.isdigit():
+                if int(file_generation) < generation:
+                    try:
+                        os.remove(os.path.join(self.path, filename))
+                    except FileNotFoundError:
+                        pass
+
+
+class MemmapVectorStore:
+    """Client for `MemmapCollection`s under one directory, mirroring Chroma's client methods."""
+
+    def __init__(self, path: str, dtype: str = "int8", rescore: bool = True, rescore_factor: int = 4):
+        self.path = path
+        self.dtype = dtype
+        self.rescore = rescore
+        self.rescore_factor = rescore_factor
+        self._collections: Dict[str, MemmapCollection] = {}
+        self._lock = threading.Lock()
+        os.makedirs(path, exist_ok=True)
+
+    def _open(self, name: str) -> MemmapCollection:
+        collection = self._collections.get(name)
+        if collection is None:
+            collection = MemmapCollection(
+                os.path.join(self.path, name), name, self.dtype, self.rescore, self.rescore_factor
+            )
+            self._collections[name] = collection
+        return collection
+
+    def get_collection(self, name: str) -> MemmapCollection:
+        with self._lock:
+            if name not in self._collections and not os.path.exists(os.path.join(self.path, name, "meta.pkl")):
+                raise ValueError(f"Collection {name} does not exist.")
+            return self._open(name)
+
+    def get_or_create_collection(self, name: str) -> MemmapCollection:
+        with self._lock:
+            return self._open(name)
+
+    def delete_collection(self, name: str):
+        with self._lock:
+            self._collections.pop(name, None)
+            shutil.rmtree(os.path.join(self.path, name), ignore_errors=True)